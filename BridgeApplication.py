@@ -1,21 +1,33 @@
 import logging
+import multiprocessing
+import os
+import signal
+import socket
+import tempfile
+import threading
 from optparse import OptionParser
-from twisted.internet import reactor
+
+import zmq
 
 import multiprocessing_logging
-import TwistedHttpBridge
-import ZMQBridge
-import BridgeInjector
+import BridgeConfig
+import BridgeProtocol
+
+# NOTE: anything pulling in Twisted's reactor (TwistedHttpBridge, ZMQBridge, txZMQ, BridgeInjector) is imported where
+# it's used; the reactor sets up its poller on import, and forked worker processes must not share the parent's
 
 logging.basicConfig(filename="zmq-https-bridge.log", filemode="a",
                     level=logging.INFO, format="%(name)-12s @ %(asctime)s: [%(levelname)-8s] %(message)s",
                     datefmt='%m/%d/%Y %I:%M:%S %p')
 multiprocessing_logging.install_mp_handler()
 
+# connections the shared HTTPS listener queues up for the workers to accept
+LISTEN_BACKLOG = 1024
+# loggers the bridges write a line to for every message; --no-message-logs quiets them
+MESSAGE_LOGGERS = ("ZMQ.messages", "Twist-HTTP.messages")
 
-def main():
-    LOG = logging.getLogger("BridgeMain")
 
+def make_parser() -> OptionParser:
     usage = "usage: %s <zmq bind address> <http bind address> <destination> [is-app-hosting]"
     parser = OptionParser(usage=usage)
     parser.add_option("-z", "--zmq-bind-addr", dest="zmq_bind_address", help="The address for the bridge's ZMQ "
@@ -33,56 +45,455 @@ def main():
     parser.add_option("-i", "--inject", dest="inject", help="If specified, the bridge will inject itself into the "
                                                             "source code of the specified Python application.",
                                                             default="")
+    parser.add_option("--install-hook", dest="install_hook", action="store_true", default=False,
+                      help="Instead of rewriting source files, install an import hook (a .pth file) which starts the "
+                           "bridge inside any Python application as it imports zmq. The given addresses are its "
+                           "defaults; ZMQ_HTTPS_BRIDGE_ZMQ_ADDR, ZMQ_HTTPS_BRIDGE_HTTP_ADDR and "
+                           "ZMQ_HTTPS_BRIDGE_DESTINATION override them per application, and ZMQ_HTTPS_BRIDGE_DISABLE "
+                           "turns the hook off.")
+    parser.add_option("--uninstall-hook", dest="uninstall_hook", action="store_true", default=False,
+                      help="Remove the import hook installed by --install-hook.")
+    parser.add_option("--site-dir", dest="site_dir", default=None,
+                      help="The site-packages directory the import hook is (un)installed in; defaults to this "
+                           "interpreter's.")
+    parser.add_option("--dry-run", dest="dry_run", action="store_true", default=False,
+                      help="With --inject, only report where the bridge would be injected, and how long the scan "
+                           "took.")
+    parser.add_option("--inject-jobs", dest="inject_jobs", type="int", default=0,
+                      help="The number of processes scanning for injection points; defaults to the number of CPUs.")
     parser.add_option("-c", "--connect", dest="connect", help="If \"true\", then we assume the app is hosting and "
                                                               "thus, we must connect to it.", default="false")
+    parser.add_option("--zmq-socket", dest="zmq_socket", type="choice", choices=list(BridgeProtocol.SOCKET_TYPES),
+                      default=None,
+                      help="The ZMQ socket the bridge presents to the application. router (the default, or dealer "
+                           "with -c true) carries requests and replies. sub and pull take a one-way stream from the "
+                           "application, and pub and push hand one on to the applications on this side, which don't "
+                           "need a destination. The one-way sockets bind, or connect with -c true.")
+    parser.add_option("--topic", dest="topics", action="append", default=None,
+                      help="With --zmq-socket sub or pull, only send on messages whose first frame starts with this "
+                           "prefix; may be given several times. A sub socket subscribes to these topics, so the "
+                           "publisher filters them.")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=1,
+                      help="Run this many bridge processes, sharing the HTTPS listener and (if the application "
+                           "connects to us) the ZMQ address between them.")
+    parser.add_option("--batch-window", dest="batch_window", type="float", default=0.0,
+                      help="If above zero, ZMQ messages are gathered for up to this many milliseconds and sent to "
+                           "the destination as a single batched POST.")
+    parser.add_option("--batch-max-bytes", dest="batch_max_bytes", type="int", default=1024 * 1024,
+                      help="Send a batch early once its messages reach this many bytes.")
+    parser.add_option("--batch-max-count", dest="batch_max_count", type="int", default=256,
+                      help="Send a batch early once it holds this many messages.")
+    parser.add_option("--pool-max-per-host", dest="pool_max_per_host", type="int", default=8,
+                      help="The most HTTP/1.1 connections to open to the destination, which are kept alive between "
+                           "requests; requests beyond that wait for one of them.")
+    parser.add_option("--pool-idle-timeout", dest="pool_idle_timeout", type="float", default=240.0,
+                      help="Seconds an idle keep-alive connection is held open before it's closed.")
+    parser.add_option("--stats-interval", dest="stats_interval", type="float", default=0.0,
+                      help="If above zero, log outbound connection and queue statistics every this many seconds.")
+    parser.add_option("--http2", dest="http2", action="store_true", default=False,
+                      help="Multiplex all data sent to the destination over one HTTP/2 connection. Requires the "
+                           "\"h2\" package on both bridges.")
+    parser.add_option("--raw-ingress", dest="raw_ingress", action="store_true", default=False,
+                      help="Also take data over a lean length-prefixed framing on the HTTPS listener, picked by the "
+                           "sending bridge through ALPN; HTTP keeps working alongside it.")
+    parser.add_option("--raw-max-length", dest="raw_max_length", type="int",
+                      default=BridgeProtocol.RAW_MAX_LENGTH,
+                      help="The largest raw framed request the listener takes, in bytes; each is held in memory "
+                           "whole. A sender's connection is dropped if it sends a bigger one.")
+    parser.add_option("--raw-egress", dest="raw_egress", action="store_true", default=False,
+                      help="Send data to the destination over the raw framing instead of HTTP, pipelined over one "
+                           "connection. The destination must be running with --raw-ingress.")
+    parser.add_option("--tls-cert", dest="tls_cert", default="bridge-ssl.pem",
+                      help="PEM file with the certificate the HTTPS listener presents, optionally followed by its "
+                           "chain.")
+    parser.add_option("--tls-key", dest="tls_key", default="bridge-ssl.key",
+                      help="PEM file with the private key for --tls-cert.")
+    parser.add_option("--tls-ciphers", dest="tls_ciphers", default=None,
+                      help="OpenSSL cipher string limiting the TLS 1.2 cipher suites, for both the listener and the "
+                           "connections to the destination. TLS 1.3 suites are left to OpenSSL.")
+    parser.add_option("--alpn", dest="alpn", default=None,
+                      help="Comma separated protocols the HTTPS listener offers through ALPN (default: h2,http/1.1 "
+                           "if the \"h2\" package is installed, otherwise http/1.1).")
+    parser.add_option("--tls-ca", dest="tls_ca", default=None,
+                      help="PEM file with the CA certificates to verify the destination's certificate and hostname "
+                           "against.")
+    parser.add_option("--tls-pin", dest="tls_pins", action="append", default=None,
+                      help="Only accept a destination presenting this certificate: its SHA-256 fingerprint (hex), or "
+                           "a PEM file with it. May be given several times. Without --tls-ca or --tls-pin, the "
+                           "destination's certificate isn't verified.")
+    parser.add_option("--no-tls-resumption", dest="tls_resumption", action="store_false", default=True,
+                      help="Don't resume TLS sessions (through session ids or tickets) when reconnecting, on either "
+                           "side.")
+    parser.add_option("--max-in-flight", dest="max_in_flight", type="int", default=64,
+                      help="The most requests to the destination that may be outstanding at once.")
+    parser.add_option("--max-queue", dest="max_queue", type="int", default=1024,
+                      help="Once this many requests are waiting for the destination, stop reading from ZMQ until "
+                           "half of them have been sent.")
+    parser.add_option("--zmq-hwm", dest="high_water_mark", type="int", default=1000,
+                      help="ZeroMQ high-water mark for the bridge's socket; bounds what ZeroMQ buffers while the "
+                           "bridge isn't reading.")
+    parser.add_option("--wire-format", dest="wire_format", type="choice", choices=list(BridgeProtocol.WIRE_FORMATS),
+                      default=BridgeProtocol.WIRE_FORMAT_BASE64,
+                      help="How data is encoded for the destination: \"binary\" sends raw bytes, \"base64\" is the "
+                           "compatible default. Binary is only used once the destination has advertised support.")
+    parser.add_option("--integrity", dest="integrity", type="choice", choices=list(BridgeProtocol.INTEGRITY_ALGORITHMS),
+                      default=BridgeProtocol.DEFAULT_INTEGRITY,
+                      help="The integrity check applied to each message: sha256 (default), blake2b, crc32 or none. "
+                           "crc32 and none rely on TLS for tamper protection.")
+    parser.add_option("--integrity-key", dest="integrity_key", default="",
+                      help="Shared key for blake2b integrity checks; must match on both bridges.")
+    parser.add_option("--compression", dest="compression", type="choice",
+                      choices=list(BridgeProtocol.COMPRESSION_ALGORITHMS), default=BridgeProtocol.COMPRESSION_NONE,
+                      help="Compress data for the destination with zstd, lz4 or deflate (zlib). zstd and lz4 need the "
+                           "\"zstandard\"/\"lz4\" packages; compression is only used once the destination has "
+                           "advertised support.")
+    parser.add_option("--compression-threshold", dest="compression_threshold", type="int", default=512,
+                      help="Only compress messages (or batches) of at least this many bytes.")
+    parser.add_option("--offload-threshold", dest="offload_threshold", type="int",
+                      default=256 * 1024,
+                      help="Hash and compress outgoing messages (or batches), and verify incoming batches, of at "
+                           "least this many bytes on a thread pool instead of the reactor thread, so they don't hold "
+                           "up other connections. Each peer's messages stay in order. 0 keeps everything on the "
+                           "reactor thread.")
+    parser.add_option("--offload-threads", dest="offload_threads", type="int", default=0,
+                      help="Size of the thread pool used by --offload-threshold (default: Twisted's, 10 threads).")
+    parser.add_option("--spool-dir", dest="spool_dir", default=None,
+                      help="Keep messages the destination couldn't take (or that don't fit in the send queue) in "
+                           "memory-mapped files in this directory, and replay them in order once it's back.")
+    parser.add_option("--spool-segment-size", dest="spool_segment_size", type="int", default=64 * 1024 * 1024,
+                      help="Size in bytes of each spool file; a file is deleted once everything in it was delivered.")
+    parser.add_option("--spool-max-bytes", dest="spool_max_bytes", type="int", default=1024 * 1024 * 1024,
+                      help="Most bytes of undelivered messages to spool; beyond it, new messages wait in memory "
+                           "(up to --max-queue) instead.")
+    parser.add_option("--at-least-once", dest="at_least_once", action="store_true", default=False,
+                      help="Spool every message before sending it, and only remove it once the destination has "
+                           "accepted it, so messages survive the bridge restarting. Needs --spool-dir; duplicates are "
+                           "dropped by the destination.")
+    parser.add_option("--dedupe-window", dest="dedupe_window", type="int", default=65536,
+                      help="Number of message ids remembered to drop messages a spooling sender delivers twice. 0 "
+                           "turns this off.")
+    parser.add_option("--config", dest="config", default=None,
+                      help="Run every route defined in this TOML or YAML file in one process, sharing the HTTPS "
+                           "listener and the connections to the destinations. Each route takes data for its ZMQ "
+                           "address on /zmq/<route>; see BridgeConfig.py for the settings.")
+    parser.add_option("--no-message-logs", dest="message_logs", action="store_false", default=True,
+                      help="Don't log a line for every message bridged; counts and latencies are still available "
+                           "from /metrics.")
+    return parser
+
+
+def main():
+    LOG = logging.getLogger("BridgeMain")
 
+    parser = make_parser()
     (options, args) = parser.parse_args()
 
+    if options.uninstall_hook:
+        import BridgeImportHook
+        if BridgeImportHook.uninstall_pth(options.site_dir):
+            print("Removed import hook %s" % BridgeImportHook.pth_path(options.site_dir))
+        else:
+            print("No import hook installed at %s" % BridgeImportHook.pth_path(options.site_dir))
+        return
+
+    routes = None
+    if options.config:
+        if options.inject or options.install_hook or options.workers > 1:
+            parser.error("--config can't be combined with --inject, --install-hook or --workers")
+        try:
+            options, routes = BridgeConfig.load_routes(options.config, parser, options)
+        except BridgeConfig.ConfigError as e:
+            parser.error(str(e))
+
+    if options.raw_egress and options.http2:
+        parser.error("--raw-egress and --http2 are different ways of reaching the destination; pick one")
+
+    if not options.message_logs:
+        for name in MESSAGE_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    if routes is not None:
+        http_bind_addr, http_bind_port = BridgeConfig.split_addr_port(options.http_bind_address)
+        tls_options, tls_policy = tls_from(parser, options)
+        start_routes(http_bind_addr, http_bind_port, routes, options, tls_options, tls_policy)
+        return
+
+    if options.at_least_once and not options.spool_dir:
+        parser.error("--at-least-once needs --spool-dir")
+
     # parse CLI options given
     if not options.zmq_bind_address:
         parser.error("ZMQ address not given")
-    zmq_addr, zmq_port = split_addr_port(options.zmq_bind_address)
+    zmq_addr, zmq_port = BridgeConfig.split_addr_port(options.zmq_bind_address)
     LOG.info("Parsed ZMQ address: %s:%d" % (zmq_addr, zmq_port))
 
     if not options.http_bind_address:
         parser.error("HTTP address not given")
-    http_bind_addr, http_bind_port = split_addr_port(options.http_bind_address)
+    http_bind_addr, http_bind_port = BridgeConfig.split_addr_port(options.http_bind_address)
     LOG.info("Parsed HTTP binding address: %s:%d" % (http_bind_addr, http_bind_port))
 
-    if not options.destination:
-        parser.error("Destination not given")
     destination = options.destination
-    # double check for HTTPS
-    if not destination.startswith("https"):
-        LOG.warning("INSECURE PROTOCOL: Destination is NOT using HTTPS.")
-    LOG.info("Destination: %s" % destination)
+    if destination:
+        # double check for HTTPS
+        if not destination.startswith("https"):
+            LOG.warning("INSECURE PROTOCOL: Destination is NOT using HTTPS.")
+        LOG.info("Destination: %s" % destination)
+    elif options.zmq_socket not in BridgeProtocol.STREAM_SINKS:
+        parser.error("Destination not given")
 
-    # then check to see if the ZMQ application is the one binding or if we're binding
+    # then check to see if the ZMQ application is the one binding or if we're binding; router and dealer sockets
+    # decide it themselves
     binding = options.connect == "true"
+    if options.zmq_socket in (BridgeProtocol.SOCKET_ROUTER, BridgeProtocol.SOCKET_DEALER):
+        binding = options.zmq_socket == BridgeProtocol.SOCKET_DEALER
+    stream = options.zmq_socket in BridgeProtocol.STREAM_SOURCES + BridgeProtocol.STREAM_SINKS
+    if stream and options.workers > 1:
+        parser.error("--workers only works with router and dealer sockets")
+    if options.topics and options.zmq_socket not in BridgeProtocol.STREAM_SOURCES:
+        parser.error("--topic only works with --zmq-socket sub or pull")
     if binding:
         LOG.info("Configured for connecting to the given ZMQ address")
     else:
         LOG.info("Configured for receiving ZMQ connection")
 
-    # check if we want to inject into a python app instead
-    if options.inject:
-        BridgeInjector.inject(options.inject, zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination)
+    # options tuning how the ZMQ side forwards data to the destination, and for the HTTP(S) side receiving data from
+    # the other bridge
+    zmq_options = zmq_options_from(options)
+    http_options = http_options_from(options)
+
+    # check if we want to inject into python apps instead
+    if options.install_hook:
+        import BridgeImportHook
+        path = BridgeImportHook.install_pth(options.site_dir, options.zmq_bind_address, options.http_bind_address,
+                                            destination)
+        LOG.info("Installed import hook %s" % path)
+        print("Installed import hook %s" % path)
+    elif options.inject:
+        import BridgeInjector
+        stats = BridgeInjector.inject(options.inject, zmq_addr, zmq_port, http_bind_addr, http_bind_port,
+                                      destination, dry_run=options.dry_run, jobs=options.inject_jobs)
+        if options.dry_run:
+            print("Scanned %(files)d files (%(candidates)d with a possible __main__ guard) in %(seconds).3fs: would "
+                  "inject %(injected)d new and refresh %(reinjected)d existing injection points (%(failed)d failures)"
+                  % stats)
+    elif options.workers > 1:
+        http_options["tls_options"], zmq_options["tls_policy"] = tls_from(parser, options)
+        start_workers(options.workers, zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, binding,
+                      zmq_options, http_options)
     else:
-        start_bridge(zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, binding)
+        http_options["tls_options"], zmq_options["tls_policy"] = tls_from(parser, options)
+        start_bridge(zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, binding, zmq_options,
+                     http_options)
+
+
+def zmq_options_from(options) -> dict:
+    return {
+        "batch_window": options.batch_window / 1000.0,
+        "batch_max_bytes": options.batch_max_bytes,
+        "batch_max_count": options.batch_max_count,
+        "pool_max_per_host": options.pool_max_per_host,
+        "pool_idle_timeout": options.pool_idle_timeout,
+        "stats_interval": options.stats_interval,
+        "http2": options.http2,
+        "raw_egress": options.raw_egress,
+        "wire_format": options.wire_format,
+        "integrity": options.integrity,
+        "integrity_key": options.integrity_key.encode(),
+        "max_in_flight": options.max_in_flight,
+        "max_queue": options.max_queue,
+        "high_water_mark": options.high_water_mark,
+        "compression": options.compression,
+        "compression_threshold": options.compression_threshold,
+        "offload_threshold": options.offload_threshold,
+        "offload_threads": options.offload_threads,
+        "spool_dir": options.spool_dir,
+        "spool_segment_size": options.spool_segment_size,
+        "spool_max_bytes": options.spool_max_bytes,
+        "at_least_once": options.at_least_once,
+        "socket_type": options.zmq_socket,
+        "topics": [topic.encode() for topic in options.topics or ()],
+    }
+
+
+def http_options_from(options) -> dict:
+    return {
+        "integrity_key": options.integrity_key.encode(),
+        "alpn": alpn_from(options),
+        "raw_ingress": options.raw_ingress,
+        "raw_max_length": options.raw_max_length,
+        "offload_threshold": options.offload_threshold,
+        "dedupe_window": options.dedupe_window,
+    }
+
+
+def alpn_from(options):
+    if not options.alpn:
+        return None
+    return [protocol.strip().encode() for protocol in options.alpn.split(",") if protocol.strip()]
 
 
-def start_bridge(zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, binding):
+def tls_from(parser, options) -> tuple:
+    # the HTTPS listener's certificate options and the policy for connecting to destinations; both are only loaded
+    # by the processes actually bridging
+    import BridgeTLS
+
+    try:
+        tls_options = BridgeTLS.server_options(options.tls_cert, options.tls_key, options.tls_ciphers,
+                                               options.tls_resumption)
+        tls_policy = BridgeTLS.ClientPolicy(options.tls_ca, options.tls_pins or (), options.tls_ciphers,
+                                            options.http2, options.tls_resumption, options.raw_egress)
+    except BridgeTLS.TLSConfigError as e:
+        parser.error(str(e))
+    return tls_options, tls_policy
+
+
+def start_bridge(zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, binding, zmq_options=None,
+                 http_options=None, ready=None):
+    from twisted.internet import reactor
+    import BridgeMetrics
+    import TwistedHttpBridge
+    import ZMQBridge
+
     logging.getLogger("BridgeMain").info("Starting bridge...")
+    # both bridges report into the same metrics, served from /metrics
+    metrics = BridgeMetrics.Metrics()
+    BridgeMetrics.ReactorLagMonitor(reactor, metrics).start()
     # create our bridges
-    zmq_bridge = ZMQBridge.Bridge(zmq_addr, zmq_port, destination, binding)
-    TwistedHttpBridge.Bridge(zmq_bridge, http_bind_addr, http_bind_port)
+    zmq_bridge = ZMQBridge.Bridge(zmq_addr, zmq_port, destination, binding, metrics=metrics, **(zmq_options or {}))
+    http_bridge = TwistedHttpBridge.Bridge(zmq_bridge, http_bind_addr, http_bind_port, metrics=metrics,
+                                           **(http_options or {}))
+    if ready is not None:
+        # let whoever started us know once the ZMQ socket (set up by now) and the HTTPS listener are both up
+        def listening(port):
+            report_ready(ready, None)
+
+        def listen_failed(fail):
+            report_ready(ready, fail.getErrorMessage())
+            reactor.callWhenRunning(reactor.stop)
+
+        http_bridge.listening.addCallbacks(listening, listen_failed)
     # start Twisted; with txZMQ, ZeroMQ is also managed by Twisted
     reactor.run()
 
 
-def split_addr_port(input_combo: str) -> (str, int):
-    splitted = input_combo.split(":", 1)
-    return splitted[0].strip(), int(splitted[1])
+def start_routes(http_bind_addr, http_bind_port, routes, options, tls_options=None, tls_policy=None):
+    from twisted.internet import reactor
+    from txzmq import ZmqFactory
+    import BridgeMetrics
+    import TwistedHttpBridge
+    import ZMQBridge
+
+    LOG = logging.getLogger("BridgeMain")
+    LOG.info("Starting bridge with %d routes..." % len(routes))
+    metrics = BridgeMetrics.Metrics()
+    BridgeMetrics.ReactorLagMonitor(reactor, metrics).start()
+    # the routes share one ZeroMQ context, one HTTPS listener and one agent, so routes to the same destination share
+    # its keep-alive connections (or HTTP/2 connection) too
+    zmq_factory = ZmqFactory()
+    agent, pool = ZMQBridge.make_agent(options.http2, options.pool_max_per_host, options.pool_idle_timeout, metrics,
+                                       tls_policy, options.raw_egress)
+    http_bridge = TwistedHttpBridge.Bridge(None, http_bind_addr, http_bind_port,
+                                           integrity_key=options.integrity_key.encode(), metrics=metrics,
+                                           tls_options=tls_options, alpn=alpn_from(options),
+                                           raw_ingress=options.raw_ingress, raw_max_length=options.raw_max_length)
+    for route in routes:
+        zmq_addr, zmq_port = BridgeConfig.split_addr_port(route.zmq_address)
+        if route.destination is None:
+            LOG.info("Route %s: /zmq/%s -> ZMQ %s (%s)" % (route.name, route.name, route.zmq_address,
+                                                          route.socket_type))
+        else:
+            if not route.destination.startswith("https"):
+                LOG.warning("INSECURE PROTOCOL: Destination of route %s is NOT using HTTPS." % route.name)
+            LOG.info("Route %s: ZMQ %s (%s) -> %s/zmq/%s" % (route.name, route.zmq_address, route.socket_type,
+                                                            route.destination, route.destination_route))
+        # each route's metrics carry its name as a label
+        zmq_bridge = ZMQBridge.Bridge(zmq_addr, zmq_port, route.destination, route.connect,
+                                      metrics=metrics.scoped(route=route.name),
+                                      destination_route=route.destination_route, agent=agent, pool=pool,
+                                      zmq_factory=zmq_factory, **dict(zmq_options_from(route.options),
+                                                                      socket_type=route.socket_type))
+        http_options = http_options_from(route.options)
+        http_bridge.add_route(route.name, zmq_bridge, http_options["offload_threshold"], http_options["dedupe_window"])
+    reactor.run()
+
+
+def report_ready(ready, error):
+    try:
+        ready.send(error)
+        ready.close()
+    except OSError:
+        # nobody is waiting any more
+        pass
+
+
+def start_workers(workers, zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, binding,
+                  zmq_options=None, http_options=None):
+    LOG = logging.getLogger("BridgeMain")
+
+    # bind the HTTPS listener once; every worker accepts connections from the same socket
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((http_bind_addr, http_bind_port))
+    listener.listen(LISTEN_BACKLOG)
+    listener.setblocking(False)
+    http_options = dict(http_options or {}, listen_fd=listener.fileno())
+
+    # if the application connects to us, a ROUTER/DEALER proxy owns the ZMQ address and spreads messages over the
+    # workers; since replies carry their routing envelope, any worker can send them back through the proxy. if we
+    # connect to the application instead, each worker simply opens its own connection to it
+    zmq_options = dict(zmq_options or {})
+    proxy_backend = None
+    if not binding:
+        proxy_backend = "ipc://%s" % os.path.join(tempfile.gettempdir(), "zmq-https-bridge-%d.ipc" % os.getpid())
+        zmq_options["proxy_backend"] = proxy_backend
+
+    # workers are forked so they inherit the listening socket and the multiprocessing_logging handler
+    context = multiprocessing.get_context("fork")
+    processes = []
+    for worker in range(workers):
+        worker_zmq_options = zmq_options
+        if zmq_options.get("spool_dir"):
+            # a spool belongs to one process; each worker replays its own after a restart
+            worker_zmq_options = dict(zmq_options, spool_dir=os.path.join(zmq_options["spool_dir"], "worker-%d" % worker))
+        process = context.Process(target=start_bridge, name="bridge-worker-%d" % worker,
+                                  args=(zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, binding,
+                                        worker_zmq_options, http_options))
+        process.start()
+        processes.append(process)
+    LOG.info("Started %d bridge workers sharing %s:%d" % (workers, http_bind_addr, http_bind_port))
+
+    if proxy_backend is not None:
+        threading.Thread(target=run_proxy, name="zmq-proxy", daemon=True,
+                         args=(zmq_addr, zmq_port, proxy_backend, zmq_options.get("high_water_mark", 1000))).start()
+
+    # take the workers down with us when we're told to stop
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for process in processes:
+            process.join()
+            LOG.warning("Bridge worker %s exited (code: %s)" % (process.name, process.exitcode))
+    except KeyboardInterrupt:
+        LOG.info("Stopping bridge workers...")
+        for process in processes:
+            process.terminate()
+    finally:
+        if proxy_backend is not None and os.path.exists(proxy_backend[len("ipc://"):]):
+            os.unlink(proxy_backend[len("ipc://"):])
+
+
+def run_proxy(zmq_addr, zmq_port, backend, high_water_mark):
+    context = zmq.Context()
+    frontend_socket = context.socket(zmq.ROUTER)
+    backend_socket = context.socket(zmq.DEALER)
+    for proxy_socket in (frontend_socket, backend_socket):
+        proxy_socket.set_hwm(high_water_mark)
+    frontend_socket.bind("tcp://%s:%d" % (zmq_addr, zmq_port))
+    backend_socket.bind(backend)
+    logging.getLogger("BridgeMain").info("Proxying tcp://%s:%d to workers on %s" % (zmq_addr, zmq_port, backend))
+    zmq.proxy(frontend_socket, backend_socket)
 
 
 if __name__ == "__main__":
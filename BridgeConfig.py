@@ -0,0 +1,196 @@
+import logging
+import os
+import re
+from optparse import OptionValueError, Values
+
+import BridgeProtocol
+
+LOG = logging.getLogger("Config")
+# a config file holds the process-wide settings and route defaults at its top level, and one table per route, e.g.:
+#
+#   http-bind-addr = "0.0.0.0:8443"
+#   compression = "zstd"
+#
+#   [routes.orders]
+#   zmq = "127.0.0.1:5555"
+#   destination = "https://bridge.example.com:8443"
+#
+#   [routes.prices]
+#   zmq = "127.0.0.1:5556"
+#   socket = "dealer"
+#   destination = "https://bridge.example.com:8443"
+#   destination-route = "quotes"
+#   batch-window = 2
+#
+#   [routes.ticks]
+#   zmq = "0.0.0.0:5557"
+#   socket = "pub"
+#
+# or the same as YAML, with a "routes" mapping. socket is one of BridgeProtocol.SOCKET_TYPES (router by default); a
+# router binds and a dealer connects to the application, and connect = true/false decides for the one-way sockets (sub
+# connects to the publisher by default, the others bind). pub and push routes don't take a destination
+
+# route names end up in URLs (/zmq/<route>) and spool directory names
+ROUTE_NAME = re.compile(r"^[A-Za-z0-9_.-]+$")
+# command line options a config file may set for every route (at its top level) or for a single route
+ROUTE_OPTIONS = (
+    "batch-window", "batch-max-bytes", "batch-max-count", "max-in-flight", "max-queue", "zmq-hwm", "wire-format",
+    "integrity", "compression", "compression-threshold", "offload-threshold", "spool-dir", "spool-segment-size",
+    "spool-max-bytes", "at-least-once", "dedupe-window", "topic",
+)
+# command line options a config file may only set at its top level; all routes share the HTTPS listener, the
+# connection pool to their destinations and the reactor
+PROCESS_OPTIONS = (
+    "http-bind-addr", "integrity-key", "pool-max-per-host", "pool-idle-timeout", "http2", "offload-threads",
+    "stats-interval", "no-message-logs", "tls-cert", "tls-key", "tls-ciphers", "alpn", "tls-ca", "tls-pin",
+    "no-tls-resumption", "raw-ingress", "raw-max-length", "raw-egress",
+)
+# settings which only make sense for a single route
+ROUTE_SETTINGS = ("zmq", "socket", "connect", "destination", "destination-route")
+
+
+class ConfigError(Exception):
+    pass
+
+
+class Route:
+    def __init__(self, name: str, zmq_address: str, socket_type: str, connect: bool, destination: str,
+                 destination_route: str, options: Values):
+        self.name = name
+        self.zmq_address = zmq_address
+        self.socket_type = socket_type
+        # whether we connect to the application, rather than bind for it to connect to us
+        self.connect = connect
+        # None for routes which only hand messages to the application
+        self.destination = destination
+        # the route on the destination bridge this route's data is posted to
+        self.destination_route = destination_route
+        # the command line options, with the config file's settings for this route applied
+        self.options = options
+
+
+def split_addr_port(input_combo: str) -> (str, int):
+    splitted = input_combo.split(":", 1)
+    return splitted[0].strip(), int(splitted[1])
+
+
+def load(path: str) -> dict:
+    # TOML needs Python 3.11 (or the "tomli" package), YAML the "PyYAML" package
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ConfigError("Reading TOML needs Python 3.11 or the \"tomli\" package")
+        try:
+            with open(path, "rb") as config_file:
+                settings = tomllib.load(config_file)
+        except (OSError, ValueError) as e:
+            raise ConfigError("Couldn't read %s: %s" % (path, e))
+    elif extension in (".yaml", ".yml"):
+        try:
+            import yaml
+        except ImportError:
+            raise ConfigError("Reading YAML needs the \"PyYAML\" package")
+        try:
+            with open(path) as config_file:
+                settings = yaml.safe_load(config_file)
+        except (OSError, yaml.YAMLError) as e:
+            raise ConfigError("Couldn't read %s: %s" % (path, e))
+    else:
+        raise ConfigError("Don't know how to read %s; config files must end in .toml, .yaml or .yml" % path)
+
+    if not isinstance(settings, dict):
+        raise ConfigError("%s doesn't hold a table of settings" % path)
+    return settings
+
+
+def load_routes(path: str, parser, options: Values) -> tuple:
+    # returns the command line options with the config file's top level applied, and its routes. settings are named
+    # after the command line options, with dashes or underscores; the config file wins over the command line
+    settings = load(path)
+    routes_settings = settings.pop("routes", None)
+    if not isinstance(routes_settings, dict) or not routes_settings:
+        raise ConfigError("%s doesn't define any routes" % path)
+
+    options = Values(vars(options))
+    _apply(parser, options, settings, PROCESS_OPTIONS + ROUTE_OPTIONS, path)
+    if not options.http_bind_address:
+        raise ConfigError("%s doesn't give an http-bind-addr" % path)
+
+    routes = []
+    for name, route_settings in routes_settings.items():
+        where = "%s, route %s" % (path, name)
+        if not ROUTE_NAME.match(str(name)):
+            raise ConfigError("%s: route names may only hold letters, digits, '_', '.' and '-'" % where)
+        if not isinstance(route_settings, dict):
+            raise ConfigError("%s: a route must be a table of settings" % where)
+        route_settings = {str(key).replace("_", "-"): value for key, value in route_settings.items()}
+        route_options = Values(vars(options))
+        _apply(parser, route_options, {key: value for key, value in route_settings.items()
+                                       if key not in ROUTE_SETTINGS}, ROUTE_OPTIONS, where)
+
+        zmq_address = route_settings.get("zmq")
+        if not isinstance(zmq_address, str) or ":" not in zmq_address:
+            raise ConfigError("%s: zmq must be the ZMQ address as host:port" % where)
+        socket_type = str(route_settings.get("socket", BridgeProtocol.SOCKET_ROUTER)).lower()
+        if socket_type not in BridgeProtocol.SOCKET_TYPES:
+            raise ConfigError("%s: socket must be one of %s" % (where, ", ".join(BridgeProtocol.SOCKET_TYPES)))
+        if socket_type in (BridgeProtocol.SOCKET_ROUTER, BridgeProtocol.SOCKET_DEALER):
+            if "connect" in route_settings:
+                raise ConfigError("%s: a %s socket decides whether it connects itself" % (where, socket_type))
+            connect = socket_type == BridgeProtocol.SOCKET_DEALER
+        else:
+            connect = route_settings.get("connect", socket_type == BridgeProtocol.SOCKET_SUB)
+            if not isinstance(connect, bool):
+                raise ConfigError("%s: connect must be true or false" % where)
+        if route_options.topics and socket_type not in BridgeProtocol.STREAM_SOURCES:
+            raise ConfigError("%s: topic only works with sub and pull sockets" % where)
+
+        destination = route_settings.get("destination")
+        if socket_type in BridgeProtocol.STREAM_SINKS:
+            if destination is not None:
+                raise ConfigError("%s: a %s route doesn't send anything to a destination" % (where, socket_type))
+        elif not isinstance(destination, str) or not destination.startswith("http"):
+            raise ConfigError("%s: destination must be an HTTP(S) URL" % where)
+        destination_route = str(route_settings.get("destination-route", name))
+        if not ROUTE_NAME.match(destination_route):
+            raise ConfigError("%s: destination-route may only hold letters, digits, '_', '.' and '-'" % where)
+        if route_options.spool_dir:
+            # a spool belongs to one route
+            route_options.spool_dir = os.path.join(route_options.spool_dir, name)
+        elif route_options.at_least_once:
+            raise ConfigError("%s: at-least-once needs spool-dir" % where)
+
+        routes.append(Route(name, zmq_address, socket_type, connect, destination, destination_route, route_options))
+    LOG.info("Loaded %d routes from %s" % (len(routes), path))
+    return options, routes
+
+
+def _apply(parser, options: Values, settings: dict, allowed, where: str):
+    for key, value in settings.items():
+        name = str(key).replace("_", "-")
+        if name not in allowed:
+            raise ConfigError("%s: unknown setting %s (or it can't be set here)" % (where, key))
+        option = parser.get_option("--" + name)
+        if option.action in ("store_true", "store_false"):
+            if not isinstance(value, bool):
+                raise ConfigError("%s: %s must be true or false" % (where, key))
+            setattr(options, option.dest, value if option.action == "store_true" else not value)
+            continue
+        if option.action == "append":
+            # a list, or a single value
+            values = value if isinstance(value, list) else [value]
+            if any(isinstance(item, (bool, dict, list)) for item in values):
+                raise ConfigError("%s: %s must be a list of values" % (where, key))
+            setattr(options, option.dest, [str(item) for item in values])
+            continue
+        if isinstance(value, (bool, dict, list)):
+            raise ConfigError("%s: %s must be a single value" % (where, key))
+        try:
+            setattr(options, option.dest, option.check_value("--" + name, str(value)))
+        except OptionValueError as e:
+            raise ConfigError("%s: %s" % (where, e))
@@ -0,0 +1,118 @@
+import importlib.abc
+import importlib.util
+import logging
+import os
+import sys
+import sysconfig
+
+LOG = logging.getLogger("ImportHook")
+BRIDGE_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+# name of the .pth file which installs the hook into every Python process using that site-packages directory
+PTH_NAME = "zmq_https_bridge.pth"
+# environment variables configuring the bridge for an application; they take precedence over what install() is given
+ENV_ZMQ_ADDR = "ZMQ_HTTPS_BRIDGE_ZMQ_ADDR"
+ENV_HTTP_ADDR = "ZMQ_HTTPS_BRIDGE_HTTP_ADDR"
+ENV_DESTINATION = "ZMQ_HTTPS_BRIDGE_DESTINATION"
+# seconds the application waits for its bridge to come up
+ENV_READY_TIMEOUT = "ZMQ_HTTPS_BRIDGE_READY_TIMEOUT"
+# set to anything to leave a process alone. the hook also sets it once it fires, so the application's own child
+# processes don't each try to start a bridge on the same addresses
+ENV_DISABLE = "ZMQ_HTTPS_BRIDGE_DISABLE"
+
+
+# hands the real zmq loader to the import system, and injects the bridge as soon as the module has been executed
+class _InjectingLoader(importlib.abc.Loader):
+    def __init__(self, loader, imported):
+        self._loader = loader
+        self._imported = imported
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        self._loader.exec_module(module)
+        self._imported()
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+
+# waits for the first import of zmq; it then takes itself off sys.meta_path, since zmq is only ever loaded once
+class BridgeFinder(importlib.abc.MetaPathFinder):
+    def __init__(self, imported):
+        self._imported = imported
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != "zmq":
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(fullname)
+        if spec is None or spec.loader is None:
+            return None
+        spec.loader = _InjectingLoader(spec.loader, self._imported)
+        return spec
+
+
+def install(zmq_addr: str = None, http_addr: str = None, destination: str = None) -> bool:
+    if os.environ.get(ENV_DISABLE):
+        return False
+    zmq_addr = os.environ.get(ENV_ZMQ_ADDR, zmq_addr)
+    http_addr = os.environ.get(ENV_HTTP_ADDR, http_addr)
+    destination = os.environ.get(ENV_DESTINATION, destination)
+    if not (zmq_addr and http_addr and destination):
+        # not configured for this process
+        return False
+    if any(isinstance(finder, BridgeFinder) for finder in sys.meta_path):
+        return True
+
+    def imported():
+        _inject(zmq_addr, http_addr, destination)
+
+    if "zmq" in sys.modules:
+        imported()
+    else:
+        sys.meta_path.insert(0, BridgeFinder(imported))
+    return True
+
+
+def _inject(zmq_addr: str, http_addr: str, destination: str):
+    # the bridge imports zmq as well; it mustn't try to bridge itself
+    main_file = getattr(sys.modules.get("__main__"), "__file__", None)
+    if main_file is not None and os.path.dirname(os.path.realpath(main_file)) == BRIDGE_DIRECTORY:
+        return
+    os.environ[ENV_DISABLE] = "1"
+
+    if BRIDGE_DIRECTORY not in sys.path:
+        sys.path.append(BRIDGE_DIRECTORY)
+    # not BridgeApplication: importing it sets up the bridge's own logging, which would take over the application's
+    import BridgeConfig
+    import BridgeInjector
+
+    zmq_host, zmq_port = BridgeConfig.split_addr_port(zmq_addr)
+    http_host, http_port = BridgeConfig.split_addr_port(http_addr)
+    ready_timeout = float(os.environ.get(ENV_READY_TIMEOUT, BridgeInjector.READY_TIMEOUT))
+    BridgeInjector.inject_zeromq_bridge(zmq_host, zmq_port, http_host, http_port, destination, ready_timeout)
+    LOG.info("Injected bridge into %s on import of zmq" % (main_file or sys.argv[0] or "<interactive>"))
+
+
+def pth_path(site_dir: str = None) -> str:
+    return os.path.join(site_dir or sysconfig.get_paths()["purelib"], PTH_NAME)
+
+
+def install_pth(site_dir: str = None, zmq_addr: str = None, http_addr: str = None, destination: str = None) -> str:
+    # a .pth file's plain lines are added to sys.path and its import lines are run at interpreter startup, before
+    # any application code; the addresses given here are the defaults, and the environment can still override them
+    path = pth_path(site_dir)
+    with open(path, "w") as pth_file:
+        pth_file.write(BRIDGE_DIRECTORY + "\n")
+        pth_file.write("import BridgeImportHook; BridgeImportHook.install(%r, %r, %r)\n"
+                       % (zmq_addr, http_addr, destination))
+    return path
+
+
+def uninstall_pth(site_dir: str = None) -> bool:
+    path = pth_path(site_dir)
+    if not os.path.exists(path):
+        return False
+    os.unlink(path)
+    return True
@@ -1,14 +1,25 @@
+import ast
+import io
 import os
 import logging
-import BridgeApplication
+import mmap
+import re
 import multiprocessing
 import shutil
-import threading
+import tempfile
 import time
-
-from txzmq import ZmqEndpointType
+import tokenize
 
 LOG = logging.getLogger("Injector")
+BRIDGE_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+# only files with a line that could start a module-level __main__ guard (an `if` in the first column, mentioning
+# __main__ before its colon) are read in and parsed; the rest are ruled out on the mapped file itself
+GUARD_PATTERN = re.compile(rb"^if\b[^:]*__main__", re.MULTILINE)
+# files are handed to the scanner processes this many at a time, to keep the inter-process overhead down
+SCAN_CHUNK_SIZE = 64
+# seconds an injected application waits for its bridge to be up before carrying on without it
+READY_TIMEOUT = 10.0
+INJECT_MARKER = "# ZMQ-HTTP-BRIDGE-INJECTED"
 INJECT_SOURCE = """    # ZMQ-HTTP-BRIDGE-INJECTED
     import sys
     sys.path.append("@__SCRIPT_DIRECTORY__@")
@@ -19,90 +30,176 @@ INJECT_SOURCE = """    # ZMQ-HTTP-BRIDGE-INJECTED
 """
 
 
-def inject(scan_dir, zmq_addr: str, zmq_port: int, http_addr: str, http_port: int, destination: str):
-    for dir, subdir, files in os.walk(scan_dir):
-        LOG.info("Scanning directory %s" % dir)
-        to_inject = dict()
-
+def inject(scan_dir, zmq_addr: str, zmq_port: int, http_addr: str, http_port: int, destination: str,
+           dry_run: bool = False, jobs: int = 0) -> dict:
+    source = (INJECT_SOURCE
+              .replace("@__SCRIPT_DIRECTORY__@", BRIDGE_DIRECTORY)
+              .replace("@__ZMQ_ADDR__@", zmq_addr)
+              .replace("@__ZMQ_PORT__@", str(zmq_port))
+              .replace("@__HTTP_ADDR__@", http_addr)
+              .replace("@__HTTP_PORT__@", str(http_port))
+              .replace("@__DESTINATION__@", destination))
+    stats = {"files": 0, "candidates": 0, "injected": 0, "reinjected": 0, "failed": 0}
+    started = time.perf_counter()
+
+    jobs = jobs or os.cpu_count() or 1
+    LOG.info("Scanning %s for injection points with %d processes%s"
+             % (scan_dir, jobs, " (dry run)" if dry_run else ""))
+    tasks = ((path, source, dry_run) for path in find_sources(scan_dir))
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        results = pool.imap_unordered(scan_file, tasks, SCAN_CHUNK_SIZE) if pool is not None else map(scan_file, tasks)
+        for result in results:
+            stats["files"] += 1
+            stats["candidates"] += result["candidate"]
+            if result["error"] is not None:
+                stats["failed"] += 1
+                LOG.warning("Couldn't inject into %s: %s" % (result["path"], result["error"]))
+            for line, reinject in result["points"]:
+                stats["reinjected" if reinject else "injected"] += 1
+                LOG.info("%s injection point at %s (line %d)"
+                         % ("Found" if dry_run else "Reinjected" if reinject else "Injected", result["path"], line))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    stats["seconds"] = time.perf_counter() - started
+    LOG.info("Scanned %(files)d files (%(candidates)d with a possible __main__ guard) in %(seconds).3fs: %(injected)d new and "
+             "%(reinjected)d existing injection points, %(failed)d failures" % stats)
+    return stats
+
+
+def find_sources(scan_dir):
+    for dir, subdirs, files in os.walk(scan_dir):
+        # never inject into the bridge itself
+        if os.path.realpath(dir) == BRIDGE_DIRECTORY:
+            continue
         for file in files:
             # skip files that aren't python files
-            if not file.lower().endswith(".py"):
-                continue
-
-            with open(file, "r") as file_stream:
-                line = file_stream.readline()
-                while line:
-                    if line.startswith("if __name__ == \"__main__\":"):
-                        reinject = False
-                        if "# ZMQ-HTTP-BRIDGE-INJECTED" in peek_nextline(file_stream):
-                            LOG.warning("File %s was already injected - reinjecting..." % file)
-                            reinject = True
-
-                        full_path = os.path.join(dir, file)
-                        offset = file_stream.tell()
-                        to_inject[full_path] = {offset: offset, reinject: reinject}
-                        LOG.info("Found injection point at %s (offset: %d)" % (full_path, offset))
-                    line = file_stream.readline()
-
-        for target, (offset, reinject) in to_inject.items():
-            if not reinject:
-                shutil.copyfile(target, target + ".noninjected")
-            with open(target, "r+") as file_stream:
-                file_stream.seek(offset)
-                if reinject:
-                    # if we're reinjecting, we need to skip the current code
-                    file_stream.seek(file_stream.tell() + len(INJECT_SOURCE.encode()))
-                remaining = collect_remaining(file_stream)
-
-                file_stream.seek(offset)
-                file_stream.write(INJECT_SOURCE
-                                  .replace("@__SCRIPT_DIRECTORY__@", os.path.dirname(os.path.realpath(__file__)))
-                                  .replace("@__ZMQ_ADDR__@", zmq_addr)
-                                  .replace("@__ZMQ_PORT__@", str(zmq_port))
-                                  .replace("@__HTTP_ADDR__@", http_addr)
-                                  .replace("@__HTTP_PORT__@", str(http_port))
-                                  .replace("@__DESTINATION__@", destination)
-                                  )
-                for line in remaining:
-                    file_stream.write(line)
-
-
-def peek_nextline(file_stream) -> str:
-    pos = file_stream.tell()
-    line = file_stream.readline()
-    file_stream.seek(pos)
-    return line
-
-
-def collect_remaining(file_stream) -> list:
-    line = file_stream.readline()
-    remaining = []
-    while line:
-        remaining.append(line)
-        line = file_stream.readline()
-    return remaining
+            if file.lower().endswith(".py"):
+                yield os.path.join(dir, file)
+
+
+# runs in the scanner processes: finds a file's __main__ guards and (unless this is a dry run) injects into them
+def scan_file(task) -> dict:
+    path, source, dry_run = task
+    result = {"path": path, "candidate": False, "points": [], "error": None}
+    try:
+        with open(path, "rb") as file_stream:
+            # empty files can't be mapped, and don't have a guard anyway
+            if os.fstat(file_stream.fileno()).st_size == 0:
+                return result
+            with mmap.mmap(file_stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                # most files have no guard; don't bother copying and parsing those. the parser needs the source in
+                # memory, and so does rewriting it
+                if GUARD_PATTERN.search(mapped) is None:
+                    return result
+                data = mapped[:]
+
+        result["candidate"] = True
+        lines = data.splitlines(keepends=True)
+        points = find_injection_points(ast.parse(data, path), lines)
+        if points and not dry_run:
+            rewrite(path, data, lines, points, source)
+        result["points"] = [(start + 1, reinject) for start, end, indent, reinject in points]
+    except (OSError, SyntaxError, ValueError) as e:
+        result["error"] = str(e)
+    return result
+
+
+def is_main_guard(test) -> bool:
+    # matches `__name__ == "__main__"` either way around, whatever the quotes
+    if not isinstance(test, ast.Compare) or len(test.ops) != 1 or not isinstance(test.ops[0], ast.Eq):
+        return False
+    operands = (test.left, test.comparators[0])
+    return any(isinstance(operand, ast.Name) and operand.id == "__name__" for operand in operands) \
+        and any(isinstance(operand, ast.Constant) and operand.value == "__main__" for operand in operands)
+
+
+def is_inject_call(statement) -> bool:
+    return isinstance(statement, ast.Expr) and isinstance(statement.value, ast.Call) \
+        and isinstance(statement.value.func, ast.Attribute) \
+        and statement.value.func.attr == "inject_zeromq_bridge" \
+        and isinstance(statement.value.func.value, ast.Name) and statement.value.func.value.id == "BridgeInjector"
+
+
+# returns (start, end, indent, reinject) for each module-level __main__ guard, where lines[start:end] is what the
+# injected code replaces: nothing for a fresh injection, or the code injected by an earlier run
+def find_injection_points(tree, lines) -> list:
+    points = []
+    for node in tree.body:
+        if not isinstance(node, ast.If) or not is_main_guard(node.test):
+            continue
+        first = node.body[0]
+        if first.lineno == node.lineno:
+            # `if __name__ == "__main__": main()` has no line to inject in front of
+            continue
+
+        start = first.lineno - 1
+        indent = re.match(rb"[ \t]*", lines[start]).group()
+        end = start
+        reinject = False
+        if start > node.lineno and lines[start - 1].strip() == INJECT_MARKER.encode():
+            calls = [statement for statement in node.body if is_inject_call(statement)]
+            if calls:
+                start -= 1
+                end = calls[0].end_lineno
+                reinject = True
+        points.append((start, end, indent, reinject))
+    return points
+
+
+def rewrite(path, data, lines, points, source):
+    # keep the file's own encoding and line endings
+    encoding = tokenize.detect_encoding(io.BytesIO(data).readline)[0]
+    newline = lines[0][len(lines[0].rstrip(b"\r\n")):] or b"\n"
+    # work backwards so earlier line numbers stay valid
+    for start, end, indent, reinject in sorted(points, reverse=True):
+        # the template is indented for a 4-space guard; use whatever the guard's body uses instead
+        lines[start:end] = [indent + line[4:].encode(encoding) + newline for line in source.splitlines()]
+
+    if not any(reinject for start, end, indent, reinject in points):
+        shutil.copy2(path, path + ".noninjected")
+
+    # write the new source next to the original and swap it in, so the file is never seen half-written
+    temp_fd, temp_path = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), suffix=".tmp",
+                                          dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(temp_fd, "wb") as temp_stream:
+            temp_stream.writelines(lines)
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
 
 
 STARTED_BRIDGE = False
 
 
-def inject_zeromq_bridge(zmq_addr: str, zmq_port: int, http_bind_addr: str, http_bind_port: int, destination: str):
+def inject_zeromq_bridge(zmq_addr: str, zmq_port: int, http_bind_addr: str, http_bind_port: int, destination: str,
+                         ready_timeout: float = READY_TIMEOUT):
     from zmq import Socket as s
-    from txzmq import ZmqConnection as zc
 
-    s.__real_connect__ = s.connect
-    s.__real_bind__ = s.bind
+    # injecting twice mustn't make the injected methods the "real" ones
+    if not hasattr(s, "__real_connect__"):
+        s.__real_connect__ = s.connect
+        s.__real_bind__ = s.bind
 
     def _start_bridge(is_app_hosting):
         global STARTED_BRIDGE
         if not STARTED_BRIDGE:
-            bp = multiprocessing.Process(target=BridgeApplication.start_bridge, daemon=True,
+            started = time.perf_counter()
+            ready_reader, ready_writer = multiprocessing.Pipe(duplex=False)
+            bp = multiprocessing.Process(target=run_bridge, daemon=True,
                                          args=(zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination,
-                                               is_app_hosting))
+                                               is_app_hosting, ready_writer))
             bp.start()
-            # give the bridge a second to start up fully
-            time.sleep(1)
-            LOG.debug("Started bridge process")
+            # drop our copy of the write end, so the pipe reports EOF if the bridge dies before it's ready
+            ready_writer.close()
+            wait_for_bridge(ready_reader, ready_timeout)
+            LOG.debug("Started bridge process in %.3fs" % (time.perf_counter() - started))
             STARTED_BRIDGE = True
 
     # first, we need to override ZMQ's socket bind/connect to redirect it to our socket
@@ -118,16 +215,34 @@ def inject_zeromq_bridge(zmq_addr: str, zmq_port: int, http_bind_addr: str, http
         self.__real_connect__(new_dst)
         LOG.debug("Redirected connect() call to %s" % new_dst)
 
-    # then we need to fix txzmq's socket to use the real underlying method so we don't end up looping
-    def _injected_connectOrBind(self, endpoints):
-        for endpoint in endpoints:
-            if endpoint.type == ZmqEndpointType.connect:
-                self.socket.__real_connect__(endpoint.address)
-            elif endpoint.type == ZmqEndpointType.bind:
-                self.socket.__real_bind__(endpoint.address)
-            else:
-                assert False, "Unknown endpoint type %r" % endpoint
-
     s.bind = _injected_bind
     s.connect = _injected_connect
-    zc._connectOrBind = _injected_connectOrBind
+
+
+def run_bridge(zmq_addr: str, zmq_port: int, http_bind_addr: str, http_bind_port: int, destination: str,
+               is_app_hosting: bool, ready):
+    # we're the bridge process now: our own sockets must go where they're told, rather than being redirected back to
+    # us. this is also why Twisted and txZMQ are only ever imported here, and not in the application. a process started
+    # with spawn or forkserver imported zmq afresh, and never had them redirected
+    from zmq import Socket as s
+    s.connect = getattr(s, "__real_connect__", s.connect)
+    s.bind = getattr(s, "__real_bind__", s.bind)
+
+    # imported here rather than at the top: when the bridge is run to inject, BridgeApplication is already loaded as
+    # __main__, and importing it again would set up its logging a second time
+    import BridgeApplication
+    BridgeApplication.start_bridge(zmq_addr, zmq_port, http_bind_addr, http_bind_port, destination, is_app_hosting,
+                                   ready=ready)
+
+
+def wait_for_bridge(ready_reader, timeout: float):
+    if not ready_reader.poll(timeout):
+        LOG.warning("Bridge didn't report that it's up within %.1f seconds; carrying on without it" % timeout)
+        return
+    try:
+        error = ready_reader.recv()
+    except EOFError:
+        error = "the bridge process exited during startup"
+    ready_reader.close()
+    if error is not None:
+        raise RuntimeError("Couldn't start the bridge: %s" % error)
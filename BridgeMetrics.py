@@ -0,0 +1,166 @@
+import math
+import time
+from bisect import bisect_left
+
+
+# upper bounds (in seconds) of the latency histogram buckets; from sub-millisecond LAN hops up to stalled WAN requests
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# how often the reactor is asked to wake us up, so we can measure how late it was
+REACTOR_LAG_INTERVAL = 0.5
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values) -> str:
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, _escape(value)) for name, value in zip(names, values))
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(int(value))
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels=(), function=None, constant_labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        # (name, value) pairs added to every sample, e.g. the route a metric belongs to
+        self._constant_names = tuple(label for label, value in constant_labels)
+        self._constant_values = tuple(value for label, value in constant_labels)
+        # values can also be read from a callback at scrape time; it returns a number, or a dict keyed by label value
+        # (or tuple of label values) if the metric has labels
+        self._function = function
+        self._values = {}
+
+    def samples(self):
+        if self._function is None:
+            values = self._values
+        else:
+            values = self._function()
+            if not self.labels:
+                values = {(): values}
+        for key, value in values.items():
+            if not isinstance(key, tuple):
+                key = (key,)
+            yield self.name, _format_labels(self._constant_names + self.labels, self._constant_values + key), value
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, labels: tuple = ()):
+        self._values[labels] = value
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets=LATENCY_BUCKETS, constant_labels=()):
+        self.name = name
+        self.help = help_text
+        self._buckets = tuple(buckets)
+        self._constant_names = tuple(label for label, value in constant_labels)
+        self._constant_values = tuple(value for label, value in constant_labels)
+        # one slot per bucket plus the implicit +Inf bucket; made cumulative when scraped
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self._buckets + (math.inf,), self._counts):
+            cumulative += count
+            labels = _format_labels(self._constant_names + ("le",),
+                                    self._constant_values + (_format_value(float(bound)),))
+            yield self.name + "_bucket", labels, cumulative
+        labels = _format_labels(self._constant_names, self._constant_values)
+        yield self.name + "_sum", labels, self._sum
+        yield self.name + "_count", labels, self._count
+
+
+# the bridge's metrics, rendered in the Prometheus text format for the /metrics page. registering a name that already
+# exists (with the same constant labels) hands back the existing metric, so several components can share one
+class Metrics:
+    def __init__(self, constant_labels=(), registry: dict = None):
+        self._constant_labels = tuple(constant_labels)
+        # name -> constant labels -> metric
+        self._metrics = registry if registry is not None else {}
+
+    def scoped(self, **labels) -> "Metrics":
+        # a view of the same metrics which adds these labels to everything registered through it; e.g. each route of a
+        # bridge gets its own copy of the bridge's metrics, told apart by a route label
+        return Metrics(self._constant_labels + tuple(sorted(labels.items())), self._metrics)
+
+    def counter(self, name: str, help_text: str, labels=(), function=None) -> Counter:
+        return self._register(name, lambda: Counter(name, help_text, labels, function, self._constant_labels))
+
+    def gauge(self, name: str, help_text: str, labels=(), function=None) -> Gauge:
+        return self._register(name, lambda: Gauge(name, help_text, labels, function, self._constant_labels))
+
+    def histogram(self, name: str, help_text: str, buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(name, lambda: Histogram(name, help_text, buckets, self._constant_labels))
+
+    def _register(self, name, create):
+        family = self._metrics.setdefault(name, {})
+        if self._constant_labels not in family:
+            family[self._constant_labels] = create()
+        return family[self._constant_labels]
+
+    def render(self) -> bytes:
+        lines = []
+        for family in self._metrics.values():
+            first = next(iter(family.values()))
+            lines.append("# HELP %s %s" % (first.name, first.help.replace("\\", "\\\\").replace("\n", "\\n")))
+            lines.append("# TYPE %s %s" % (first.name, first.type))
+            for metric in family.values():
+                for name, labels, value in metric.samples():
+                    lines.append("%s%s %s" % (name, labels, _format_value(value)))
+        lines.append("")
+        return "\n".join(lines).encode()
+
+
+# measures how late the reactor runs a timer; anything blocking the reactor thread (hashing, encoding, logging, ...)
+# shows up here as lag, and delays every connection the bridge has
+class ReactorLagMonitor:
+    def __init__(self, reactor, metrics: Metrics, interval: float = REACTOR_LAG_INTERVAL):
+        self._reactor = reactor
+        self._interval = interval
+        self._expected = None
+        self.last_lag = 0.0
+        self._histogram = metrics.histogram("bridge_reactor_lag_seconds",
+                                            "How late the reactor ran a timer, sampled every %gs" % interval)
+        metrics.gauge("bridge_reactor_lag_last_seconds", "The most recent reactor lag sample",
+                      function=lambda: self.last_lag)
+
+    def start(self):
+        self._expected = time.monotonic() + self._interval
+        self._reactor.callLater(self._interval, self._tick)
+
+    def _tick(self):
+        self.last_lag = max(0.0, time.monotonic() - self._expected)
+        self._histogram.observe(self.last_lag)
+        self.start()
@@ -0,0 +1,87 @@
+import time
+from collections import deque
+
+from twisted.internet import defer, threads
+
+import BridgeMetrics
+
+
+# payloads of at least this many bytes are hashed, encoded and compressed on the reactor's thread pool; below it, the
+# trip to a thread and back costs more than the work itself
+DEFAULT_OFFLOAD_THRESHOLD = 256 * 1024
+
+
+class _Job:
+    __slots__ = ("deferred", "done", "result", "started", "finished", "offloaded")
+
+    def __init__(self, offloaded: bool):
+        self.deferred = defer.Deferred()
+        self.done = False
+        self.result = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.offloaded = offloaded
+
+
+# runs CPU-heavy work on big payloads in the reactor's thread pool (hashlib, zlib, zstandard and lz4 release the GIL
+# while they work), and small payloads inline. results are handed back in submission order per key (i.e. per peer), so
+# a small message never overtakes a big one from the same peer that's still being worked on; other peers aren't held up
+class OrderedOffload:
+    def __init__(self, stage: str, threshold: int, metrics: BridgeMetrics.Metrics):
+        self._stage = stage
+        # 0 turns offloading off
+        self._threshold = threshold
+        # key -> jobs whose results haven't been handed back yet, oldest first
+        self._queues = {}
+        self._jobs = metrics.counter("bridge_offload_jobs_total", "Payloads processed, by stage and where they ran",
+                                     labels=("stage", "thread"))
+        self._inline_seconds = metrics.histogram("bridge_%s_inline_seconds" % stage,
+                                                 "Time spent %s payloads on the reactor thread" % stage)
+        self._offloaded_seconds = metrics.histogram("bridge_%s_offloaded_seconds" % stage,
+                                                    "Time from handing a payload to the thread pool for %s until its "
+                                                    "result was released (queueing and per-peer ordering included)"
+                                                    % stage)
+        self._ordering_seconds = metrics.histogram("bridge_%s_ordering_wait_seconds" % stage,
+                                                   "Time a finished %s result waited for earlier results from the "
+                                                   "same peer" % stage)
+        metrics.gauge("bridge_%s_pending" % stage, "Payloads being %s off the reactor thread, or waiting for their "
+                      "turn" % stage, function=lambda: sum(len(queue) for queue in self._queues.values()))
+
+    def run(self, key, size: int, function, *args) -> defer.Deferred:
+        offloaded = 0 < self._threshold <= size
+        if not offloaded and key not in self._queues:
+            # nothing from this peer is ahead of us; the fast path
+            self._jobs.inc(1, (self._stage, "reactor"))
+            started = time.perf_counter()
+            result = defer.maybeDeferred(function, *args)
+            self._inline_seconds.observe(time.perf_counter() - started)
+            return result
+
+        job = _Job(offloaded)
+        self._queues.setdefault(key, deque()).append(job)
+        if offloaded:
+            self._jobs.inc(1, (self._stage, "pool"))
+            work = threads.deferToThread(function, *args)
+        else:
+            self._jobs.inc(1, (self._stage, "reactor"))
+            started = time.perf_counter()
+            work = defer.maybeDeferred(function, *args)
+            self._inline_seconds.observe(time.perf_counter() - started)
+        work.addBoth(self._finished, key, job)
+        return job.deferred
+
+    def _finished(self, result, key, job: _Job):
+        job.done = True
+        job.result = result
+        job.finished = time.monotonic()
+        queue = self._queues[key]
+        while queue and queue[0].done:
+            ready = queue.popleft()
+            now = time.monotonic()
+            self._ordering_seconds.observe(now - ready.finished)
+            if ready.offloaded:
+                self._offloaded_seconds.observe(now - ready.started)
+            ready.deferred.callback(ready.result)
+        # the callbacks may have submitted (or finished) more work for this key meanwhile
+        if not queue and self._queues.get(key) is queue:
+            del self._queues[key]
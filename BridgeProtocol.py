@@ -0,0 +1,449 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import string
+import struct
+import threading
+import zlib
+
+
+# header carrying the number of messages packed into a batched request body
+BATCH_HEADER = "X-Bridge-Batch"
+# hex digest of a single (non-batched) message, along with the algorithm that produced it; no algorithm means SHA-256
+HASH_HEADER = "X-Verify-Hash"
+ALGORITHM_HEADER = "X-Verify-Algorithm"
+# sent back by the receiving bridge so the sender can upgrade to the cheapest transport both sides understand
+WIRE_FORMATS_HEADER = "X-Bridge-Wire-Formats"
+INTEGRITY_HEADER = "X-Bridge-Integrity"
+FEATURES_HEADER = "X-Bridge-Features"
+# marks a body holding a whole ZMQ multipart message (routing envelope included) rather than just its last frame
+ENVELOPE_HEADER = "X-Bridge-Envelope"
+ENVELOPE_MULTIPART = "multipart"
+# one correlation id per message in the body (comma-separated, in batch order; empty for uncorrelated messages). the
+# bridge the requester is connected to keeps its routing envelope and sends the id along instead, and the reply comes
+# back carrying the same id, whatever order replies arrive in
+CORRELATION_HEADER = "X-Bridge-Correlation"
+# names the ZMQ peer a single message came from (in hex, at most MAX_PEER_LENGTH bytes of its identity), so the
+# receiving bridge only has to keep that peer's messages in order; messages without it are kept in order per sender
+PEER_HEADER = "X-Bridge-Peer"
+MAX_PEER_LENGTH = 16
+# identifies each message in the body (comma-separated like correlation ids) when messages may be sent more than once,
+# so the receiving bridge can drop the copies it has already handed on
+MESSAGE_ID_HEADER = "X-Bridge-Message-Id"
+# correlation and message ids are hex numbers of up to 64 bits, so anything longer isn't one of ours
+MAX_ID_LENGTH = 16
+# a receiving bridge lists the codings it can decompress in Accept-Encoding (as RFC 7694 allows in responses), and
+# compressed bodies are marked with Content-Encoding
+ACCEPT_ENCODING_HEADER = "Accept-Encoding"
+CONTENT_ENCODING_HEADER = "Content-Encoding"
+
+# optional protocol features a receiving bridge advertises in FEATURES_HEADER
+FEATURE_MULTIPART = "multipart"
+FEATURE_CORRELATION = "correlation"
+FEATURE_DEDUPE = "dedupe"
+FEATURES = (FEATURE_MULTIPART, FEATURE_CORRELATION, FEATURE_DEDUPE)
+
+# the ZMQ socket a bridge presents to its application. a router (which the application connects to) or dealer (which
+# connects to the application) carries requests and their replies. the others carry one-way streams with nothing sent
+# back: a sub or pull socket takes messages from the application, and a pub or push socket hands them on to the
+# applications on the far side, fanning them out to every subscriber or spreading them over the workers
+SOCKET_ROUTER = "router"
+SOCKET_DEALER = "dealer"
+SOCKET_SUB = "sub"
+SOCKET_PULL = "pull"
+SOCKET_PUB = "pub"
+SOCKET_PUSH = "push"
+STREAM_SOURCES = (SOCKET_SUB, SOCKET_PULL)
+STREAM_SINKS = (SOCKET_PUB, SOCKET_PUSH)
+SOCKET_TYPES = (SOCKET_ROUTER, SOCKET_DEALER) + STREAM_SOURCES + STREAM_SINKS
+
+# the raw framing a receiving bridge may offer through ALPN on its HTTPS listener (--raw-ingress), next to HTTP. each
+# request and each response is one length-prefixed (4 bytes, big endian) packed frame list, so small messages skip
+# HTTP's parsing altogether: a request is [method, path, body, header name, header value, ...] and a response
+# [status code, body, header name, header value, ...]. requests are pipelined, and answered in the order they were sent
+RAW_ALPN = b"zmq-bridge-raw/1"
+# the largest raw frame taken by default; a request's headers come after its body, so the whole frame is held in memory
+# before it can be decoded
+RAW_MAX_LENGTH = 64 * 1024 * 1024
+
+# base64 is the original format and always understood; binary sends the raw bytes as application/octet-stream
+WIRE_FORMAT_BASE64 = "base64"
+WIRE_FORMAT_BINARY = "binary"
+WIRE_FORMATS = (WIRE_FORMAT_BINARY, WIRE_FORMAT_BASE64)
+BINARY_CONTENT_TYPE = "application/octet-stream"
+BASE64_CONTENT_TYPE = "text/plain"
+
+# compression is applied to the raw message (or batch) before it is encoded for the wire; zstd and lz4 need their
+# packages installed, deflate (zlib) is always available. none is the default
+COMPRESSION_NONE = "none"
+COMPRESSION_ALGORITHMS = (COMPRESSION_NONE, "zstd", "lz4", "deflate")
+# refuse bodies which decompress to more than this, so a tiny request can't make us allocate gigabytes
+MAX_DECOMPRESSED_SIZE = 256 * 1024 * 1024
+
+# a multipart message is packed as its frame count followed by each frame prefixed with its length (all 4 bytes,
+# big endian)
+FRAME_LENGTH = struct.Struct("!I")
+# each record in a batch is prefixed with its payload length (4 bytes, big endian) followed by the payload's digest,
+# so every message keeps its own integrity check even when several share one POST
+RECORD_LENGTH = struct.Struct("!I")
+
+
+class FramingError(ValueError):
+    pass
+
+
+class BatchError(FramingError):
+    pass
+
+
+class IntegrityError(BatchError):
+    pass
+
+
+# a message integrity check; SHA-256 is the original, BLAKE2b (optionally keyed) is cheaper in software, and a CRC or
+# nothing at all is enough when TLS already protects the link against tampering. new() returns an incremental hasher
+# (update()/digest()), so bodies can be checked as they stream in
+class Integrity:
+    def __init__(self, name: str, new, size: int):
+        self.name = name
+        self.new = new
+        self.size = size
+
+    def digest(self, data) -> bytes:
+        hasher = self.new()
+        hasher.update(data)
+        return hasher.digest()
+
+    def hexdigest(self, data) -> str:
+        return self.digest(data).hex()
+
+    def verify(self, data, expected: bytes) -> bool:
+        return hmac.compare_digest(self.digest(data), expected)
+
+
+class _Crc32:
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def digest(self) -> bytes:
+        return self._crc.to_bytes(4, "big")
+
+
+class _NoDigest:
+    def update(self, data):
+        pass
+
+    def digest(self) -> bytes:
+        return b''
+
+
+INTEGRITY_ALGORITHMS = ("sha256", "blake2b", "crc32", "none")
+DEFAULT_INTEGRITY = "sha256"
+
+
+def make_integrity(name: str, key: bytes = b'') -> Integrity:
+    if name == "sha256":
+        return Integrity(name, hashlib.sha256, 32)
+    elif name == "blake2b":
+        return Integrity(name, lambda: hashlib.blake2b(digest_size=16, key=key), 16)
+    elif name == "crc32":
+        return Integrity(name, _Crc32, 4)
+    elif name == "none":
+        return Integrity(name, _NoDigest, 0)
+    raise ValueError("Unknown integrity algorithm: %s" % name)
+
+
+class Codec:
+    def __init__(self, name: str, compress, decompressor):
+        self.name = name
+        self.compress = compress
+        # returns a fresh streaming decompressor, with decompress(chunk) and an eof attribute
+        self.decompressor = decompressor
+
+
+def make_codec(name: str) -> Codec:
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError("zstd compression requires the 'zstandard' package to be installed")
+        # a ZstdCompressor mustn't be used by two threads at once, and big payloads are compressed on the thread pool;
+        # each thread gets its own
+        compressors = threading.local()
+
+        def compress(data):
+            compressor = getattr(compressors, "compressor", None)
+            if compressor is None:
+                compressor = compressors.compressor = zstandard.ZstdCompressor()
+            return compressor.compress(data)
+
+        return Codec(name, compress, lambda: zstandard.ZstdDecompressor().decompressobj())
+    elif name == "lz4":
+        try:
+            import lz4.frame
+        except ImportError:
+            raise RuntimeError("lz4 compression requires the 'lz4' package to be installed")
+        return Codec(name, lz4.frame.compress, lz4.frame.LZ4FrameDecompressor)
+    elif name == "deflate":
+        return Codec(name, zlib.compress, zlib.decompressobj)
+    raise ValueError("Unknown compression algorithm: %s" % name)
+
+
+def available_codecs() -> list:
+    codecs = []
+    for name in COMPRESSION_ALGORITHMS:
+        if name == COMPRESSION_NONE:
+            continue
+        try:
+            codecs.append(make_codec(name))
+        except RuntimeError:
+            pass
+    return codecs
+
+
+def decompress(data, codec: Codec) -> bytes:
+    decompressor = codec.decompressor()
+    try:
+        result = decompressor.decompress(data)
+    except Exception as e:
+        # each codec has its own error type
+        raise FramingError("Bad %s data: %s" % (codec.name, e))
+    if len(result) > MAX_DECOMPRESSED_SIZE:
+        raise FramingError("Body decompresses to more than %d bytes" % MAX_DECOMPRESSED_SIZE)
+    if not decompressor.eof:
+        raise FramingError("Truncated %s data" % codec.name)
+    return result
+
+
+def encode_body(payload: bytes, wire_format: str) -> bytes:
+    if wire_format == WIRE_FORMAT_BINARY:
+        return payload
+    return base64.b64encode(payload)
+
+
+def decode_body(body: bytes, wire_format: str) -> bytes:
+    if wire_format == WIRE_FORMAT_BINARY:
+        return body
+    return base64.b64decode(body)
+
+
+# decodes (and decompresses) a request body chunk by chunk as it arrives, optionally hashing the decoded data on the way,
+# so neither the encoded body nor a second decoded copy has to be held in memory
+class BodyDecoder:
+    def __init__(self, wire_format: str, integrity: Integrity = None, codec: Codec = None):
+        self._base64 = wire_format != WIRE_FORMAT_BINARY
+        self._hasher = integrity.new() if integrity is not None else None
+        self._codec = codec
+        self._decompressor = codec.decompressor() if codec is not None else None
+        # base64 decodes in groups of 4 characters; whatever doesn't fill a group waits for the next chunk
+        self._pending = b''
+        self._data = bytearray()
+        self.received = 0
+        self.error = None
+
+    def feed(self, chunk: bytes):
+        # HTTP/2 ends a body with an empty chunk; the decompressors mustn't see it, some of them take it for more data
+        if self.error is not None or not chunk:
+            return
+        self.received += len(chunk)
+        if self._base64:
+            chunk = self._pending + chunk
+            usable = len(chunk) - len(chunk) % 4
+            self._pending = chunk[usable:]
+            try:
+                chunk = base64.b64decode(chunk[:usable], validate=True)
+            except binascii.Error as e:
+                self._fail("Bad base64 data: %s" % e)
+                return
+            if not chunk:
+                return
+        if self._decompressor is not None:
+            if self._decompressor.eof:
+                self._fail("Data after the end of the %s stream" % self._codec.name)
+                return
+            try:
+                chunk = self._decompressor.decompress(chunk)
+            except Exception as e:
+                # each codec has its own error type
+                self._fail("Bad %s data: %s" % (self._codec.name, e))
+                return
+            if self._decompressor.eof and getattr(self._decompressor, "unused_data", b''):
+                self._fail("Data after the end of the %s stream" % self._codec.name)
+                return
+            if len(self._data) + len(chunk) > MAX_DECOMPRESSED_SIZE:
+                self._fail("Body decompresses to more than %d bytes" % MAX_DECOMPRESSED_SIZE)
+                return
+        if self._hasher is not None:
+            self._hasher.update(chunk)
+        self._data += chunk
+
+    def finish(self) -> bytearray:
+        if self._pending and self.error is None:
+            self.error = "Truncated base64 data"
+        elif self._decompressor is not None and not self._decompressor.eof and self.error is None:
+            self.error = "Truncated %s data" % self._codec.name
+        return self._data
+
+    def _fail(self, error: str):
+        self.error = error
+        self._data = bytearray()
+
+    def hexdigest(self) -> str:
+        return self._hasher.digest().hex()
+
+    def has_digest(self) -> bool:
+        return self._hasher is not None
+
+
+def content_type(wire_format: str) -> str:
+    return BINARY_CONTENT_TYPE if wire_format == WIRE_FORMAT_BINARY else BASE64_CONTENT_TYPE
+
+
+def wire_format_for(content_type_header) -> str:
+    # anything that isn't explicitly binary is treated as the original base64 format
+    if content_type_header is not None and content_type_header.split(";")[0].strip() == BINARY_CONTENT_TYPE:
+        return WIRE_FORMAT_BINARY
+    return WIRE_FORMAT_BASE64
+
+
+def parse_list_header(value) -> list:
+    if value is None:
+        return []
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# correlation and message ids: one per message, empty for messages without one
+def format_id_list(ids) -> str:
+    return ",".join(id_ or "" for id_ in ids)
+
+
+def parse_id_list(value, count: int) -> list:
+    if value is None:
+        return [None] * count
+    ids = [item.strip() or None for item in value.split(",")]
+    if len(ids) != count:
+        raise FramingError("%d ids for %d messages" % (len(ids), count))
+    for id_ in ids:
+        if id_ is not None and (len(id_) > MAX_ID_LENGTH or not all(c in string.hexdigits for c in id_)):
+            raise FramingError("Bad id %r" % id_[:MAX_ID_LENGTH + 1])
+    return ids
+
+
+def split_envelope(frames) -> tuple:
+    # a ROUTER prefixes each message with its sender's identity; REQ (and well-behaved DEALER) peers add an empty
+    # delimiter frame after their envelope. a message without a delimiter is taken to have just the identity
+    try:
+        delimiter = frames.index(b'', 1)
+    except ValueError:
+        return frames[:1], frames[1:]
+    return frames[:delimiter + 1], frames[delimiter + 1:]
+
+
+def pack_frames(frames) -> bytes:
+    parts = [FRAME_LENGTH.pack(len(frames))]
+    for frame in frames:
+        parts.append(FRAME_LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+
+def unpack_frames(data: bytes) -> list:
+    if len(data) < FRAME_LENGTH.size:
+        raise FramingError("Truncated multipart message")
+    count, = FRAME_LENGTH.unpack_from(data, 0)
+    view = memoryview(data)
+    offset = FRAME_LENGTH.size
+    frames = []
+    for _ in range(count):
+        if offset + FRAME_LENGTH.size > len(data):
+            raise FramingError("Truncated frame header at offset %d" % offset)
+        length, = FRAME_LENGTH.unpack_from(data, offset)
+        offset += FRAME_LENGTH.size
+        if offset + length > len(data):
+            raise FramingError("Truncated frame at offset %d (%d bytes expected)" % (offset, length))
+        frames.append(bytes(view[offset:offset + length]))
+        offset += length
+
+    if offset != len(data) or not frames:
+        raise FramingError("Malformed multipart message (%d frames, %d trailing bytes)" % (count, len(data) - offset))
+    return frames
+
+
+def pack_batch(messages, integrity: Integrity) -> bytes:
+    parts = []
+    for message in messages:
+        parts.append(RECORD_LENGTH.pack(len(message)))
+        parts.append(integrity.digest(message))
+        parts.append(message)
+    return b''.join(parts)
+
+
+def unpack_batch(body: bytes, count: int, integrity: Integrity) -> list:
+    messages = []
+    view = memoryview(body)
+    header_size = RECORD_LENGTH.size + integrity.size
+    offset = 0
+    while offset < len(body):
+        if offset + header_size > len(body):
+            raise BatchError("Truncated record header at offset %d" % offset)
+        length, = RECORD_LENGTH.unpack_from(body, offset)
+        digest = bytes(view[offset + RECORD_LENGTH.size:offset + header_size])
+        offset += header_size
+
+        if offset + length > len(body):
+            raise BatchError("Truncated record at offset %d (%d bytes expected)" % (offset, length))
+        message = bytes(view[offset:offset + length])
+        offset += length
+
+        # verify each message on its own; one bad record rejects the whole batch
+        if not integrity.verify(message, digest):
+            raise IntegrityError("Hash check failed for message #%d of batch" % len(messages))
+        messages.append(message)
+
+    if len(messages) != count:
+        raise BatchError("Batch holds %d messages, but %d were announced" % (len(messages), count))
+    return messages
+
+
+def pack_raw_request(method: bytes, path: bytes, headers, body: bytes) -> bytes:
+    head, tail = pack_raw_request_around(method, path, headers, len(body))
+    return head + body + tail
+
+
+def pack_raw_request_around(method: bytes, path: bytes, headers, body_length: int) -> tuple:
+    # what goes before and after a body of body_length bytes in a raw request, so the body can be streamed in between
+    tail = []
+    for name, values in headers:
+        for value in values:
+            tail += [FRAME_LENGTH.pack(len(name)), name, FRAME_LENGTH.pack(len(value)), value]
+    head = [FRAME_LENGTH.pack(3 + len(tail) // 2), FRAME_LENGTH.pack(len(method)), method,
+            FRAME_LENGTH.pack(len(path)), path, FRAME_LENGTH.pack(body_length)]
+    return b''.join(head), b''.join(tail)
+
+
+def unpack_raw_request(data: bytes) -> tuple:
+    # (method, path, [(header name, header value), ...], body)
+    frames = unpack_frames(data)
+    if len(frames) < 3 or len(frames) % 2 == 0:
+        raise FramingError("Malformed raw request (%d frames)" % len(frames))
+    return frames[0], frames[1], list(zip(frames[3::2], frames[4::2])), frames[2]
+
+
+def pack_raw_response(code: int, headers, body: bytes) -> bytes:
+    frames = [b"%d" % code, body]
+    for name, values in headers:
+        for value in values:
+            frames += [name, value]
+    return pack_frames(frames)
+
+
+def unpack_raw_response(data: bytes) -> tuple:
+    # (status code, [(header name, header value), ...], body)
+    frames = unpack_frames(data)
+    if len(frames) < 2 or len(frames) % 2 or not frames[0].isdigit():
+        raise FramingError("Malformed raw response (%d frames)" % len(frames))
+    return int(frames[0]), list(zip(frames[2::2], frames[3::2])), frames[1]
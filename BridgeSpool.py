@@ -0,0 +1,207 @@
+import logging
+import mmap
+import os
+import struct
+import zlib
+from collections import deque
+
+
+LOG = logging.getLogger("Spool")
+SEGMENT_SUFFIX = ".spool"
+SEGMENT_MAGIC = b"ZBSP"
+# every segment starts with its magic and the offset up to which all of its records have been delivered; a restarted
+# bridge resumes replaying from there
+SEGMENT_HEADER = struct.Struct("!4s4xQ")
+# each record is its payload's length and CRC-32, followed by the payload. segments are created at their full size
+# (sparse) and mapped, so a zero length marks where the records end
+RECORD_HEADER = struct.Struct("!II")
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# a spooled message is its id, its correlation id (length-prefixed; empty if it has none) and its frames
+MESSAGE_HEADER = struct.Struct("!QB")
+
+
+def pack_message(frames, correlation_id: str, message_id: str) -> bytes:
+    correlation = (correlation_id or "").encode()
+    parts = [MESSAGE_HEADER.pack(int(message_id, 16), len(correlation)), correlation,
+             struct.pack("!I", len(frames))]
+    for frame in frames:
+        parts.append(struct.pack("!I", len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+
+def unpack_message(data: bytes) -> tuple:
+    message_id, correlation_length = MESSAGE_HEADER.unpack_from(data, 0)
+    offset = MESSAGE_HEADER.size
+    correlation_id = data[offset:offset + correlation_length].decode() or None
+    offset += correlation_length
+    count, = struct.unpack_from("!I", data, offset)
+    offset += 4
+    frames = []
+    for _ in range(count):
+        length, = struct.unpack_from("!I", data, offset)
+        offset += 4
+        frames.append(data[offset:offset + length])
+        offset += length
+    return frames, correlation_id, "%016x" % message_id
+
+
+class _Segment:
+    def __init__(self, path: str, size: int = 0):
+        self.path = path
+        create = size > 0
+        fd = os.open(path, os.O_RDWR | (os.O_CREAT | os.O_EXCL if create else 0), 0o600)
+        try:
+            if create:
+                os.ftruncate(fd, size)
+            else:
+                size = os.fstat(fd).st_size
+                # too short to even hold the header, e.g. we died right after creating it
+                if size < SEGMENT_HEADER.size:
+                    raise ValueError("%s isn't a spool segment (%d bytes)" % (path, size))
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.size = size
+        if create:
+            SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, SEGMENT_HEADER.size)
+
+        magic, acked_offset = SEGMENT_HEADER.unpack_from(self.map, 0)
+        if magic != SEGMENT_MAGIC or not SEGMENT_HEADER.size <= acked_offset <= size:
+            self.map.close()
+            raise ValueError("%s isn't a spool segment" % path)
+        # everything before acked_offset has been delivered, everything before read_offset handed out for delivery
+        self.acked_offset = self.read_offset = acked_offset
+        self.write_offset, self.records = self._scan(acked_offset)
+        # [end offset, acknowledged] of each record handed out but not yet acknowledged, oldest first
+        self.unacked = deque()
+
+    def _scan(self, offset: int) -> tuple:
+        # find where the records end. a record that's cut short or doesn't match its CRC (we died while appending it)
+        # ends the segment
+        records = 0
+        while offset + RECORD_HEADER.size <= self.size:
+            length, crc = RECORD_HEADER.unpack_from(self.map, offset)
+            end = offset + RECORD_HEADER.size + length
+            if length == 0 or end > self.size or zlib.crc32(self.map[offset + RECORD_HEADER.size:end]) != crc:
+                break
+            offset = end
+            records += 1
+        return offset, records
+
+    def fits(self, length: int) -> bool:
+        return self.write_offset + RECORD_HEADER.size + length <= self.size
+
+    def append(self, payload: bytes):
+        offset = self.write_offset
+        RECORD_HEADER.pack_into(self.map, offset, len(payload), zlib.crc32(payload))
+        start = offset + RECORD_HEADER.size
+        self.map[start:start + len(payload)] = payload
+        self.write_offset = start + len(payload)
+        # whatever a torn write left behind mustn't look like the next record after a restart
+        if self.write_offset + RECORD_HEADER.size <= self.size:
+            RECORD_HEADER.pack_into(self.map, self.write_offset, 0, 0)
+        self.records += 1
+
+    def read(self) -> tuple:
+        length, crc = RECORD_HEADER.unpack_from(self.map, self.read_offset)
+        start = self.read_offset + RECORD_HEADER.size
+        payload = self.map[start:start + length]
+        self.read_offset = start + length
+        self.records -= 1
+        entry = [self.read_offset, False]
+        self.unacked.append(entry)
+        return entry, payload
+
+    def acknowledge(self, entry):
+        entry[1] = True
+        acked_offset = self.acked_offset
+        while self.unacked and self.unacked[0][1]:
+            acked_offset = self.unacked.popleft()[0]
+        if acked_offset != self.acked_offset:
+            self.acked_offset = acked_offset
+            SEGMENT_HEADER.pack_into(self.map, 0, SEGMENT_MAGIC, acked_offset)
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+
+
+# append-only store of messages waiting for the destination, kept in memory-mapped segment files so they survive the
+# bridge going down. records are handed out in the order they were appended, and a segment is deleted once every record
+# in it has been acknowledged. only the reactor thread may use it
+class Spool:
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE, max_bytes: int = DEFAULT_MAX_BYTES):
+        self._directory = directory
+        self._segment_size = segment_size
+        self._max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = deque()
+        # new segments are numbered after every segment file there is, including any we couldn't read
+        self._next_sequence = 0
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                if name[:-len(SEGMENT_SUFFIX)].isdigit():
+                    self._next_sequence = max(self._next_sequence, int(name[:-len(SEGMENT_SUFFIX)]) + 1)
+                try:
+                    self._segments.append(_Segment(os.path.join(directory, name)))
+                except ValueError as e:
+                    LOG.error("Skipping %s" % e)
+        self._collect()
+        if self.pending():
+            LOG.info("Recovered %d undelivered messages (%d bytes) from %s"
+                     % (self.pending(), self.bytes(), directory))
+
+    def pending(self) -> int:
+        # records not handed out yet
+        return sum(segment.records for segment in self._segments)
+
+    def bytes(self) -> int:
+        # bytes held by records not acknowledged yet
+        return sum(segment.write_offset - segment.acked_offset for segment in self._segments)
+
+    def append(self, payload: bytes) -> bool:
+        if self.bytes() + RECORD_HEADER.size + len(payload) > self._max_bytes:
+            return False
+        if not self._segments or not self._segments[-1].fits(len(payload)):
+            self._rotate(len(payload))
+        self._segments[-1].append(payload)
+        return True
+
+    def pop(self):
+        # the oldest record not handed out yet, as (token, payload); acknowledge the token once it's been delivered
+        for segment in self._segments:
+            if segment.records:
+                entry, payload = segment.read()
+                return (segment, entry), payload
+        return None
+
+    def acknowledge(self, token):
+        segment, entry = token
+        segment.acknowledge(entry)
+        self._collect()
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
+        self._segments.clear()
+
+    def _rotate(self, length: int):
+        if self._segments:
+            self._segments[-1].map.flush()
+        # a record bigger than a whole segment gets a segment to itself
+        size = max(self._segment_size, SEGMENT_HEADER.size + RECORD_HEADER.size * 2 + length)
+        path = os.path.join(self._directory, "%016d%s" % (self._next_sequence, SEGMENT_SUFFIX))
+        self._next_sequence += 1
+        self._segments.append(_Segment(path, size))
+        LOG.debug("Started spool segment %s" % path)
+
+    def _collect(self):
+        # drop segments that have been written to the end and fully acknowledged; the newest one is still written to
+        while len(self._segments) > 1 and self._segments[0].acked_offset == self._segments[0].write_offset:
+            segment = self._segments.popleft()
+            segment.close()
+            os.unlink(segment.path)
+            LOG.debug("Removed delivered spool segment %s" % segment.path)
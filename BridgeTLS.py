@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import re
+
+from OpenSSL import SSL, crypto
+from twisted.internet import ssl
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.web.iweb import IPolicyForHTTPS
+from zope.interface import implementer
+
+import BridgeProtocol
+
+LOG = logging.getLogger("TLS")
+DEFAULT_CERT_PATH = "bridge-ssl.pem"
+DEFAULT_KEY_PATH = "bridge-ssl.key"
+ALPN_HTTP2 = b"h2"
+ALPN_HTTP11 = b"http/1.1"
+PEM_CERTIFICATE_END = b"-----END CERTIFICATE-----"
+# a pin is the SHA-256 of a certificate (DER), as hex with or without colons
+PIN_FINGERPRINT = re.compile(r"^[0-9A-Fa-f]{2}(:?[0-9A-Fa-f]{2}){31}$")
+
+
+class TLSConfigError(Exception):
+    pass
+
+
+def load_certificates(path: str) -> list:
+    # every certificate in a PEM file, in the order they appear (for a chain, the leaf first)
+    try:
+        with open(path, "rb") as pem_file:
+            data = pem_file.read()
+        return [crypto.load_certificate(crypto.FILETYPE_PEM, block + PEM_CERTIFICATE_END)
+                for block in data.split(PEM_CERTIFICATE_END)[:-1]]
+    except (OSError, crypto.Error) as e:
+        raise TLSConfigError("Couldn't read certificates from %s: %s" % (path, e))
+
+
+def fingerprint(certificate) -> str:
+    return hashlib.sha256(crypto.dump_certificate(crypto.FILETYPE_ASN1, certificate)).hexdigest()
+
+
+def load_pins(pins) -> set:
+    # each pin is a fingerprint, or a PEM file whose certificates are all pinned
+    fingerprints = set()
+    for pin in pins:
+        if PIN_FINGERPRINT.match(pin):
+            fingerprints.add(pin.replace(":", "").lower())
+            continue
+        certificates = load_certificates(pin)
+        if not certificates:
+            raise TLSConfigError("No certificates in %s" % pin)
+        fingerprints.update(fingerprint(certificate) for certificate in certificates)
+    return fingerprints
+
+
+def acceptable_ciphers(ciphers: str):
+    # an OpenSSL cipher string; it picks the TLS 1.2 suites, OpenSSL decides on the TLS 1.3 ones itself
+    if not ciphers:
+        return None
+    try:
+        SSL.Context(SSL.TLS_METHOD).set_cipher_list(ciphers.encode())
+    except SSL.Error:
+        raise TLSConfigError("No cipher suites match %r" % ciphers)
+    return ssl.AcceptableCiphers.fromOpenSSLCipherString(ciphers)
+
+
+def server_options(cert_path: str = DEFAULT_CERT_PATH, key_path: str = DEFAULT_KEY_PATH, ciphers: str = None,
+                   resumption: bool = True) -> ssl.CertificateOptions:
+    # cert_path may hold the certificate's chain after it. the protocols offered through ALPN are up to the site the
+    # connections are handed to
+    certificates = load_certificates(cert_path)
+    if not certificates:
+        raise TLSConfigError("No certificate in %s" % cert_path)
+    try:
+        with open(key_path, "rb") as key_file:
+            key = crypto.load_privatekey(crypto.FILETYPE_PEM, key_file.read())
+    except (OSError, crypto.Error) as e:
+        raise TLSConfigError("Couldn't read the private key from %s: %s" % (key_path, e))
+
+    options = ssl.CertificateOptions(privateKey=key, certificate=certificates[0], extraCertChain=certificates[1:],
+                                     acceptableCiphers=acceptable_ciphers(ciphers), enableSessions=resumption,
+                                     enableSessionTickets=resumption)
+    # make the context (and with it, the session ticket keys) now: worker processes forked afterwards share it, so a
+    # client can resume its session on any of them, and a key that doesn't match the certificate fails at startup
+    try:
+        options.getContext()
+    except SSL.Error as e:
+        raise TLSConfigError("Couldn't use %s with %s: %s" % (cert_path, key_path, e))
+    return options
+
+
+# offers every new connection the session of the last one made to the same destination, so reconnecting takes an
+# abbreviated handshake (TLS 1.2 session ids or tickets, TLS 1.3 tickets)
+@implementer(IOpenSSLClientConnectionCreator)
+class ResumingCreator:
+    def __init__(self, creator):
+        self._creator = creator
+        self._last_connection = None
+        self._session = None
+
+    def clientConnectionForTLS(self, tls_protocol):
+        connection = self._creator.clientConnectionForTLS(tls_protocol)
+        if self._last_connection is not None:
+            # a connection that never finished its handshake has no session; keep the one we had
+            self._session = self._last_connection.get_session() or self._session
+        if self._session is not None:
+            connection.set_session(self._session)
+        self._last_connection = connection
+        return connection
+
+
+# connections for a destination whose certificate is either pinned or not verified at all. the context only says which
+# protocols a server would select, so the ones to offer through ALPN are set on each connection
+@implementer(IOpenSSLClientConnectionCreator)
+class _ContextCreator:
+    def __init__(self, hostname: str, context: SSL.Context, protocols: list):
+        self._hostname = hostname.encode("idna") if not (isIPAddress(hostname) or isIPv6Address(hostname)) else None
+        self._context = context
+        self._protocols = protocols
+
+    def clientConnectionForTLS(self, tls_protocol):
+        connection = SSL.Connection(self._context, None)
+        connection.set_app_data(tls_protocol)
+        if self._hostname is not None:
+            connection.set_tlsext_host_name(self._hostname)
+        connection.set_alpn_protos(self._protocols)
+        return connection
+
+
+# decides how the destinations' certificates are verified, and hands the agent one connection creator per destination
+# which is made once and reused: contexts are expensive to set up, and resuming sessions needs them to stay the same
+@implementer(IPolicyForHTTPS)
+class ClientPolicy:
+    def __init__(self, ca_path: str = None, pins=(), ciphers: str = None, http2: bool = False,
+                 resumption: bool = True, raw: bool = False):
+        if ca_path and pins:
+            raise TLSConfigError("Verify destinations either against CAs or against pinned certificates, not both")
+        self._trust_root = None
+        if ca_path:
+            certificates = load_certificates(ca_path)
+            if not certificates:
+                raise TLSConfigError("No CA certificates in %s" % ca_path)
+            self._trust_root = ssl.trustRootFromCertificates([ssl.Certificate(c) for c in certificates])
+        self._pins = load_pins(pins)
+        self._ciphers = acceptable_ciphers(ciphers)
+        # the agent's transport decides on the protocol; HTTP/2 needs h2, the pooled agent speaks HTTP/1.1
+        if raw:
+            # http/1.1 only so that a destination without raw framing finishes the handshake, and we can tell why
+            self._protocols = [BridgeProtocol.RAW_ALPN, ALPN_HTTP11]
+        else:
+            self._protocols = [ALPN_HTTP2] if http2 else [ALPN_HTTP11]
+        self._resumption = resumption
+        # (hostname, port) -> creator
+        self._creators = {}
+        if self._trust_root is None and not self._pins:
+            LOG.warning("Not verifying the destinations' certificates; pin them with --tls-pin, or verify them "
+                        "against CAs with --tls-ca")
+
+    def creatorForNetloc(self, hostname, port):
+        key = (hostname, port)
+        creator = self._creators.get(key)
+        if creator is None:
+            creator = self._creators[key] = self._make_creator(hostname.decode() if isinstance(hostname, bytes)
+                                                               else hostname)
+        return creator
+
+    def _make_creator(self, hostname: str):
+        certificate_options = {"acceptableCiphers": self._ciphers, "enableSessionTickets": self._resumption}
+        if self._trust_root is not None:
+            # chain and hostname are checked by Twisted
+            creator = ssl.optionsForClientTLS(hostname, trustRoot=self._trust_root,
+                                              acceptableProtocols=self._protocols,
+                                              extraCertificateOptions=certificate_options)
+        else:
+            context = ssl.CertificateOptions(verify=False, acceptableProtocols=self._protocols,
+                                             **certificate_options).getContext()
+            if self._pins:
+                # only the destination's own certificate counts; whoever issued it (if anyone) doesn't matter
+                context.set_verify(SSL.VERIFY_PEER, self._verify_pin)
+            creator = _ContextCreator(hostname, context, self._protocols)
+        LOG.debug("Created TLS connection creator for %s" % hostname)
+        return ResumingCreator(creator) if self._resumption else creator
+
+    def _verify_pin(self, connection, certificate, error_number, depth, ok) -> bool:
+        if depth > 0:
+            return True
+        if fingerprint(certificate) in self._pins:
+            return True
+        LOG.error("Destination presented a certificate which isn't pinned (SHA-256 %s)" % fingerprint(certificate))
+        return False
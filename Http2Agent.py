@@ -0,0 +1,299 @@
+import logging
+from collections import deque
+
+from twisted.internet import defer, protocol
+from twisted.internet.endpoints import HostnameEndpoint, connectProtocol, wrapClientTLS
+from twisted.internet.interfaces import IHandshakeListener
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone, URI
+from twisted.web.http_headers import Headers
+from zope.interface import implementer
+
+import BridgeTLS
+
+
+LOG = logging.getLogger("HTTP2")
+
+
+# minimal IResponse stand-in; it carries enough for readBody() and the bridge's response handling
+class Http2Response:
+    def __init__(self, code: int, headers: Headers, body: bytes):
+        self.code = code
+        self.phrase = b''
+        self.headers = headers
+        self.length = len(body)
+        self._body = body
+
+    def deliverBody(self, body_protocol):
+        body_protocol.dataReceived(self._body)
+        body_protocol.connectionLost(Failure(ResponseDone()))
+
+
+class _Http2Stream:
+    def __init__(self, stream_id, body_producer, deferred):
+        self.stream_id = stream_id
+        self.body_producer = body_producer
+        self.deferred = deferred
+        self.pending = deque()
+        self.body_finished = False
+        self.paused = False
+        self.code = None
+        self.headers = Headers()
+        self.body = []
+
+
+# receives body data from an IBodyProducer and hands it to the connection, which queues it until the stream's flow
+# control window allows it to be sent
+class _Http2StreamConsumer:
+    def __init__(self, connection, stream):
+        self._connection = connection
+        self._stream = stream
+
+    def write(self, data):
+        self._stream.pending.append(data)
+        self._connection.flush_stream(self._stream)
+
+
+@implementer(IHandshakeListener)
+class _Http2ClientProtocol(protocol.Protocol):
+    def __init__(self, agent, key):
+        from h2.config import H2Configuration
+        from h2.connection import H2Connection
+
+        self._agent = agent
+        self._key = key
+        self._h2 = H2Connection(config=H2Configuration(client_side=True, header_encoding=None))
+        self._streams = {}
+
+    def connectionMade(self):
+        # frames are small and go out in several writes; don't let Nagle's algorithm hold them back
+        self.transport.setTcpNoDelay(True)
+
+    def handshakeCompleted(self):
+        # ALPN has had its say by now; a destination that picked HTTP/1.1 (or nothing) would answer the preface with
+        # a 400 and hang up
+        if self.transport.negotiatedProtocol != BridgeTLS.ALPN_HTTP2:
+            self._agent._connection_failed(self._key, Failure(ConnectionError(
+                "Destination didn't negotiate h2 (negotiated %r); is it running with --http2?"
+                % self.transport.negotiatedProtocol)))
+            self.transport.loseConnection()
+            return
+        self._h2.initiate_connection()
+        self._send_pending()
+        self._agent._connection_made(self._key, self)
+
+    def available_streams(self) -> int:
+        return self._h2.remote_settings.max_concurrent_streams - self._h2.open_outbound_streams
+
+    def open_streams(self) -> int:
+        return len(self._streams)
+
+    def submit(self, method, authority, path, headers, body_producer, deferred):
+        stream_id = self._h2.get_next_available_stream_id()
+        request_headers = [
+            (b':method', method),
+            (b':scheme', b'https'),
+            (b':authority', authority),
+            (b':path', path),
+        ]
+        for name, values in headers.getAllRawHeaders():
+            # connection-specific headers are forbidden in HTTP/2
+            if name.lower() in (b'connection', b'host', b'keep-alive', b'transfer-encoding'):
+                continue
+            for value in values:
+                request_headers.append((name.lower(), value))
+        if body_producer is not None:
+            request_headers.append((b'content-length', str(body_producer.length).encode()))
+
+        stream = _Http2Stream(stream_id, body_producer, deferred)
+        self._streams[stream_id] = stream
+        self._h2.send_headers(stream_id, request_headers, end_stream=body_producer is None)
+        self._send_pending()
+
+        if body_producer is not None:
+            produced = body_producer.startProducing(_Http2StreamConsumer(self, stream))
+
+            def body_done(ignored):
+                stream.body_finished = True
+                self.flush_stream(stream)
+
+            def body_failed(fail):
+                self._fail_stream(stream, fail)
+                self._h2.reset_stream(stream_id)
+                self._send_pending()
+
+            produced.addCallbacks(body_done, body_failed)
+
+    def flush_stream(self, stream):
+        if stream.stream_id not in self._streams:
+            return
+
+        while stream.pending:
+            window = min(self._h2.local_flow_control_window(stream.stream_id), self._h2.max_outbound_frame_size)
+            if window <= 0:
+                # out of flow control credit; hold the producer back until the peer opens the window
+                if not stream.paused and stream.body_producer is not None:
+                    stream.paused = True
+                    stream.body_producer.pauseProducing()
+                break
+
+            data = stream.pending.popleft()
+            if len(data) > window:
+                stream.pending.appendleft(data[window:])
+                data = data[:window]
+            self._h2.send_data(stream.stream_id, data)
+
+        if not stream.pending:
+            if stream.paused:
+                stream.paused = False
+                stream.body_producer.resumeProducing()
+            if stream.body_finished:
+                self._h2.end_stream(stream.stream_id)
+                stream.body_finished = False
+        self._send_pending()
+
+    def dataReceived(self, data):
+        from h2.events import (ConnectionTerminated, DataReceived, RemoteSettingsChanged, ResponseReceived,
+                               StreamEnded, StreamReset, WindowUpdated)
+        from h2.exceptions import ProtocolError
+
+        try:
+            events = self._h2.receive_data(data)
+        except ProtocolError as e:
+            LOG.error("HTTP/2 protocol error from destination: %s" % e)
+            self._send_pending()
+            self.transport.loseConnection()
+            return
+
+        for event in events:
+            stream = self._streams.get(getattr(event, "stream_id", None))
+            if isinstance(event, ResponseReceived) and stream is not None:
+                for name, value in event.headers:
+                    if name == b':status':
+                        stream.code = int(value)
+                    elif not name.startswith(b':'):
+                        stream.headers.addRawHeader(name, value)
+            elif isinstance(event, DataReceived):
+                self._h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                if stream is not None:
+                    stream.body.append(event.data)
+            elif isinstance(event, StreamEnded) and stream is not None:
+                del self._streams[stream.stream_id]
+                stream.deferred.callback(Http2Response(stream.code, stream.headers, b''.join(stream.body)))
+            elif isinstance(event, StreamReset) and stream is not None:
+                self._fail_stream(stream, Failure(ConnectionError("Stream reset by destination (code %s)"
+                                                                  % event.error_code)))
+            elif isinstance(event, WindowUpdated):
+                # a window update on stream 0 opens up every stream on the connection
+                targets = list(self._streams.values()) if event.stream_id == 0 else [stream]
+                for target in targets:
+                    if target is not None:
+                        self.flush_stream(target)
+            elif isinstance(event, RemoteSettingsChanged):
+                self._agent._streams_available(self._key)
+            elif isinstance(event, ConnectionTerminated):
+                LOG.warning("Destination terminated the HTTP/2 connection (code %s)" % event.error_code)
+                self.transport.loseConnection()
+
+        self._send_pending()
+        # finished streams free up room for queued requests
+        self._agent._streams_available(self._key)
+
+    def connectionLost(self, reason):
+        for stream in list(self._streams.values()):
+            self._fail_stream(stream, reason)
+        self._agent._connection_lost(self._key, self, reason)
+
+    def _fail_stream(self, stream, fail):
+        if self._streams.pop(stream.stream_id, None) is not None:
+            if stream.body_producer is not None:
+                stream.body_producer.stopProducing()
+            stream.deferred.errback(fail)
+
+    def _send_pending(self):
+        data = self._h2.data_to_send()
+        if data:
+            self.transport.write(data)
+
+
+# an Agent look-alike that multiplexes every request to a destination over a single HTTP/2 connection, so many
+# in-flight messages share one TLS session
+class Http2Agent:
+    def __init__(self, reactor, context_factory):
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            raise RuntimeError("HTTP/2 mode requires the 'h2' package to be installed")
+
+        self._reactor = reactor
+        self._context_factory = context_factory
+        self._connections = {}
+        self._connecting = set()
+        self._queued = {}
+
+        self.requests = 0
+        self.connections_created = 0
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        parsed = URI.fromBytes(uri)
+        if parsed.scheme != b'https':
+            return defer.fail(ValueError("HTTP/2 mode requires an HTTPS destination"))
+
+        self.requests += 1
+        key = (parsed.host, parsed.port)
+        deferred = defer.Deferred()
+        self._queued.setdefault(key, deque()).append(
+            (method, parsed.netloc, parsed.originForm, headers or Headers(), bodyProducer, deferred))
+
+        if key in self._connections:
+            self._streams_available(key)
+        elif key not in self._connecting:
+            self._connect(key)
+        return deferred
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "open_connections": len(self._connections),
+            "open_streams": sum(connection.open_streams() for connection in self._connections.values()),
+            "queued_requests": sum(len(queue) for queue in self._queued.values()),
+        }
+
+    def _connect(self, key):
+        host, port = key
+        self._connecting.add(key)
+        self.connections_created += 1
+        creator = self._context_factory.creatorForNetloc(host, port)
+        endpoint = wrapClientTLS(creator, HostnameEndpoint(self._reactor, host, port))
+        LOG.info("Opening HTTP/2 connection to %s:%d" % (host.decode(), port))
+        connectProtocol(endpoint, _Http2ClientProtocol(self, key)).addErrback(
+            lambda fail: self._connection_failed(key, fail))
+
+    def _connection_made(self, key, connection):
+        self._connecting.discard(key)
+        self._connections[key] = connection
+        self._streams_available(key)
+
+    def _connection_failed(self, key, fail):
+        self._connecting.discard(key)
+        # nothing to multiplex onto; fail everything that was waiting for this connection
+        for request in self._queued.pop(key, ()):
+            request[-1].errback(fail)
+
+    def _connection_lost(self, key, connection, reason):
+        if self._connections.get(key) is connection:
+            del self._connections[key]
+        elif key in self._connecting:
+            # lost before the handshake finished
+            self._connection_failed(key, reason)
+            return
+        # reconnect if requests were queued up behind the lost connection
+        if self._queued.get(key) and key not in self._connecting:
+            self._connect(key)
+
+    def _streams_available(self, key):
+        connection = self._connections.get(key)
+        queue = self._queued.get(key)
+        while connection is not None and queue and connection.available_streams() > 0:
+            connection.submit(*queue.popleft())
@@ -0,0 +1,242 @@
+import logging
+import struct
+from collections import deque
+
+from twisted.internet import defer
+from twisted.internet.endpoints import HostnameEndpoint, connectProtocol, wrapClientTLS
+from twisted.internet.interfaces import IHandshakeListener
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone, URI
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import UNKNOWN_LENGTH
+from zope.interface import implementer
+
+import BridgeProtocol
+
+
+LOG = logging.getLogger("Raw")
+
+
+# minimal IResponse stand-in; it carries enough for readBody() and the bridge's response handling
+class RawResponse:
+    def __init__(self, code: int, headers: Headers, body: bytes):
+        self.code = code
+        self.phrase = b''
+        self.headers = headers
+        self.length = len(body)
+        self._body = body
+
+    def deliverBody(self, body_protocol):
+        body_protocol.dataReceived(self._body)
+        body_protocol.connectionLost(Failure(ResponseDone()))
+
+
+# passes what an IBodyProducer writes straight on to the connection, in the middle of the request's frame; the frame's
+# length was sent up front, so the producer mustn't write more than it said it would
+class _FrameBodyConsumer:
+    def __init__(self, transport, length: int):
+        self._transport = transport
+        self.remaining = length
+
+    def write(self, data):
+        self.remaining -= len(data)
+        if self.remaining < 0:
+            raise ValueError("Body producer wrote more than its length")
+        self._transport.write(data)
+
+
+@implementer(IHandshakeListener)
+class _RawClientProtocol(Int32StringReceiver):
+    MAX_LENGTH = BridgeProtocol.RAW_MAX_LENGTH
+
+    def __init__(self, agent, key):
+        self._agent = agent
+        self._key = key
+        # responses come back in the order requests were sent, so this is all the bookkeeping there is
+        self._waiting = deque()
+        # bodies are streamed into the connection one request at a time; the others wait their turn here
+        self._outgoing = deque()
+        self._streaming = None
+        self._usable = False
+
+    def connectionMade(self):
+        # requests are small and latency-sensitive; don't let Nagle's algorithm hold them back
+        self.transport.setTcpNoDelay(True)
+
+    def handshakeCompleted(self):
+        # ALPN has had its say by now; a destination without --raw-ingress would answer in HTTP
+        if self.transport.negotiatedProtocol != BridgeProtocol.RAW_ALPN:
+            self._agent._connection_failed(self._key, Failure(ConnectionError(
+                "Destination doesn't accept raw framing (negotiated %r); is it running with --raw-ingress?"
+                % self.transport.negotiatedProtocol)))
+            self.transport.loseConnection()
+            return
+        self._usable = True
+        self._agent._connection_made(self._key, self)
+
+    def open_requests(self) -> int:
+        return len(self._waiting) + len(self._outgoing)
+
+    def submit(self, method, path, headers, body_producer, deferred):
+        if body_producer is not None and body_producer.length is UNKNOWN_LENGTH:
+            deferred.errback(Failure(ValueError("Raw framing needs bodies of a known length")))
+            return
+        self._outgoing.append((method, path, headers, body_producer, deferred))
+        self._send_next()
+
+    def _send_next(self):
+        while self._outgoing and self._streaming is None and self._usable:
+            method, path, headers, body_producer, deferred = self._outgoing.popleft()
+            length = body_producer.length if body_producer is not None else 0
+            head, tail = BridgeProtocol.pack_raw_request_around(method, path, headers.getAllRawHeaders(), length)
+            frame_length = len(head) + length + len(tail)
+            if frame_length >= 2 ** (8 * self.prefixLength):
+                deferred.errback(Failure(ValueError("Request of %d bytes is too big for raw framing" % frame_length)))
+                continue
+            # the request's place in line is taken when its frame starts going out
+            self._waiting.append(deferred)
+            self.transport.write(struct.pack(self.structFormat, frame_length) + head)
+            if body_producer is None:
+                self.transport.write(tail)
+                continue
+            self._stream_body(body_producer, length, tail, deferred)
+
+    def _stream_body(self, body_producer, length, tail, deferred):
+        consumer = _FrameBodyConsumer(self.transport, length)
+        self._streaming = body_producer
+        self.transport.registerProducer(body_producer, True)
+
+        def body_done(ignored):
+            if self._streaming is not body_producer:
+                # the connection went away meanwhile, and took the request with it
+                return
+            self._streaming = None
+            self.transport.unregisterProducer()
+            if consumer.remaining != 0:
+                body_failed(Failure(ValueError("Body producer wrote %d bytes less than its length"
+                                               % consumer.remaining)))
+                return
+            self.transport.write(tail)
+            self._send_next()
+
+        def body_failed(fail):
+            if self._streaming is body_producer:
+                self._streaming = None
+                self.transport.unregisterProducer()
+            if not self._usable:
+                return
+            # the frame is cut short, so nothing else can be sent over this connection
+            LOG.error("Couldn't stream request body to destination: %s" % fail.getErrorMessage())
+            self._waiting.remove(deferred)
+            deferred.errback(fail)
+            self.transport.loseConnection()
+
+        body_producer.startProducing(consumer).addCallbacks(body_done, body_failed)
+
+    def stringReceived(self, data):
+        try:
+            code, header_list, body = BridgeProtocol.unpack_raw_response(data)
+        except BridgeProtocol.FramingError as e:
+            LOG.error("Bad response from destination: %s" % e)
+            self.transport.loseConnection()
+            return
+        if not self._waiting:
+            LOG.error("Destination answered a request we didn't send")
+            self.transport.loseConnection()
+            return
+        headers = Headers()
+        for name, value in header_list:
+            headers.addRawHeader(name, value)
+        self._waiting.popleft().callback(RawResponse(code, headers, body))
+
+    def lengthLimitExceeded(self, length):
+        LOG.error("Destination sent a %d byte response; giving up on the connection" % length)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self._usable = False
+        if self._streaming is not None:
+            streaming = self._streaming
+            self._streaming = None
+            streaming.stopProducing()
+        waiting = self._waiting
+        self._waiting = deque()
+        for deferred in waiting:
+            deferred.errback(reason)
+        outgoing = self._outgoing
+        self._outgoing = deque()
+        for request in outgoing:
+            request[-1].errback(reason)
+        self._agent._connection_lost(self._key, self, reason)
+
+
+# an Agent look-alike that pipelines every request to a destination over a single TLS connection using the raw framing
+# (BridgeProtocol.RAW_ALPN) instead of HTTP; the destination has to be running with --raw-ingress
+class RawAgent:
+    def __init__(self, reactor, context_factory):
+        self._reactor = reactor
+        self._context_factory = context_factory
+        self._connections = {}
+        self._connecting = set()
+        self._queued = {}
+
+        self.requests = 0
+        self.connections_created = 0
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        parsed = URI.fromBytes(uri)
+        if parsed.scheme != b'https':
+            return defer.fail(ValueError("Raw framing requires an HTTPS destination"))
+
+        self.requests += 1
+        key = (parsed.host, parsed.port)
+        deferred = defer.Deferred()
+        request = (method, parsed.originForm, headers or Headers(), bodyProducer, deferred)
+        connection = self._connections.get(key)
+        if connection is not None:
+            connection.submit(*request)
+            return deferred
+
+        self._queued.setdefault(key, deque()).append(request)
+        if key not in self._connecting:
+            self._connect(key)
+        return deferred
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "open_connections": len(self._connections),
+            "open_requests": sum(connection.open_requests() for connection in self._connections.values()),
+            "queued_requests": sum(len(queue) for queue in self._queued.values()),
+        }
+
+    def _connect(self, key):
+        host, port = key
+        self._connecting.add(key)
+        self.connections_created += 1
+        creator = self._context_factory.creatorForNetloc(host, port)
+        endpoint = wrapClientTLS(creator, HostnameEndpoint(self._reactor, host, port))
+        LOG.info("Opening raw connection to %s:%d" % (host.decode(), port))
+        connectProtocol(endpoint, _RawClientProtocol(self, key)).addErrback(
+            lambda fail: self._connection_failed(key, fail))
+
+    def _connection_made(self, key, connection):
+        self._connecting.discard(key)
+        self._connections[key] = connection
+        for request in self._queued.pop(key, ()):
+            connection.submit(*request)
+
+    def _connection_failed(self, key, fail):
+        self._connecting.discard(key)
+        # nothing to send over; fail everything that was waiting for this connection
+        for request in self._queued.pop(key, ()):
+            request[-1].errback(fail)
+
+    def _connection_lost(self, key, connection, reason):
+        if self._connections.get(key) is connection:
+            del self._connections[key]
+        elif key in self._connecting:
+            # lost before the handshake finished
+            self._connection_failed(key, reason)
@@ -1,15 +1,36 @@
-import base64
-import hashlib
+import hmac
 import logging
+import socket
+import string
+from collections import OrderedDict, deque
+from io import BytesIO
+from urllib.parse import unquote_to_bytes
 
-from twisted.internet import reactor, endpoints, ssl
-from twisted.web.resource import Resource
-from twisted.web.server import Site
+from twisted.internet import defer, reactor, endpoints, ssl
+from twisted.internet.interfaces import IHandshakeListener
+from twisted.internet.protocol import Protocol
+from twisted.protocols.basic import Int32StringReceiver
+from twisted.protocols.tls import TLSMemoryBIOFactory, TLSMemoryBIOProtocol
+from twisted.python.failure import Failure
+from twisted.web.http_headers import Headers
+from twisted.web.resource import Resource, getChildForRequest
+from twisted.web.server import NOT_DONE_YET, Request, Site, UnsupportedMethod
+from zope.interface import implementer
 
+import BridgeMetrics
+import BridgeOffload
+import BridgeProtocol
+import BridgeTLS
 from BaseServerBridge import BaseBridge
 
 
 LOG = logging.getLogger("Twist-HTTP")
+# per-message log lines go to their own logger, so they can be turned off under load without losing everything else
+MESSAGE_LOG = logging.getLogger("Twist-HTTP.messages")
+# buffered bodies are decoded in chunks of this many bytes
+DECODE_CHUNK_SIZE = 64 * 1024
+# how many message ids are remembered to drop duplicates by
+DEFAULT_DEDUPE_WINDOW = 65536
 
 
 def fail(request, code, msg):
@@ -17,47 +38,455 @@ def fail(request, code, msg):
     client_addr = request.getClientAddress()
     LOG.error("Failed to process request from %s:%d: code=%d, msg=%s"
               % (client_addr.host, client_addr.port, code, msg))
-    return msg
+    return msg.encode()
+
+
+# the integrity checks this bridge accepts from senders
+class IntegrityPolicy:
+    def __init__(self, key: bytes = b''):
+        self._key = key
+        # keyed BLAKE2b is only usable if we share the sender's key
+        self.algorithms = [name for name in BridgeProtocol.INTEGRITY_ALGORITHMS if name != "blake2b" or key]
+        self._integrity = {}
+
+    def get(self, name: str):
+        if name not in self.algorithms:
+            return None
+        if name not in self._integrity:
+            self._integrity[name] = BridgeProtocol.make_integrity(name, self._key)
+        return self._integrity[name]
+
+    def for_request(self, request):
+        return self.get(request.getHeader(BridgeProtocol.ALGORITHM_HEADER) or BridgeProtocol.DEFAULT_INTEGRITY)
+
+
+# request which decodes (and, for single messages, hashes) bridged data as it arrives rather than buffering the whole
+# encoded body first
+class StreamingRequest(Request):
+    body_decoder = None
+
+    def gotLength(self, length):
+        if self.getHeader(BridgeProtocol.HASH_HEADER) is None and self.getHeader(BridgeProtocol.BATCH_HEADER) is None:
+            # not bridged data; let Twisted buffer it as usual
+            Request.gotLength(self, length)
+            return
+
+        # batch records carry their own digests, so only single messages are hashed on the fly
+        integrity = None
+        if self.getHeader(BridgeProtocol.BATCH_HEADER) is None:
+            integrity = self.channel.site.integrity_policy.for_request(self)
+        wire_format = BridgeProtocol.wire_format_for(self.getHeader("Content-Type"))
+        # an unsupported encoding is left for the page to reject
+        codec = self.channel.site.codecs.get(self.getHeader(BridgeProtocol.CONTENT_ENCODING_HEADER))
+        self.body_decoder = BridgeProtocol.BodyDecoder(wire_format, integrity, codec)
+        self.content = BytesIO()
+
+    def handleContentChunk(self, data):
+        if self.body_decoder is not None:
+            self.body_decoder.feed(data)
+        else:
+            Request.handleContentChunk(self, data)
+
+
+class BridgeSite(Site):
+    requestFactory = StreamingRequest
+
+    def __init__(self, resource, integrity_policy: IntegrityPolicy, codecs: dict, alpn: list = None,
+                 raw_ingress: bool = False, raw_max_length: int = BridgeProtocol.RAW_MAX_LENGTH):
+        Site.__init__(self, resource)
+        self.integrity_policy = integrity_policy
+        self.codecs = codecs
+        # the protocols offered through ALPN; the TLS layer asks the site for them on every connection
+        self._alpn = alpn
+        # whether clients may pick the raw framing instead of HTTP, and the largest raw frame they may send
+        self._raw_ingress = raw_ingress
+        self.raw_max_length = raw_max_length
+
+    def acceptableProtocols(self):
+        # h2 if the "h2" package is installed, and http/1.1
+        protocols = self._alpn if self._alpn is not None else Site.acceptableProtocols(self)
+        if self._raw_ingress:
+            return [BridgeProtocol.RAW_ALPN] + protocols
+        return protocols
+
+    def buildProtocol(self, addr):
+        if self._raw_ingress:
+            return IngressSwitchProtocol(self, addr)
+        return Site.buildProtocol(self, addr)
+
+
+# picks a connection's protocol once its TLS handshake is done: the raw framing if the client asked for it through
+# ALPN, the site's HTTP (or HTTP/2) channel otherwise
+@implementer(IHandshakeListener)
+class IngressSwitchProtocol(Protocol):
+    def __init__(self, site: BridgeSite, addr):
+        self._site = site
+        self._addr = addr
+        self._protocol = None
+
+    def handshakeCompleted(self):
+        self._switch()
+
+    def _switch(self):
+        if self.transport.negotiatedProtocol == BridgeProtocol.RAW_ALPN:
+            self._protocol = RawIngressProtocol(self._site)
+        else:
+            self._protocol = Site.buildProtocol(self._site, self._addr)
+        self._protocol.makeConnection(self.transport)
+
+    def dataReceived(self, data):
+        if self._protocol is None:
+            self._switch()
+        self._protocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self._protocol is not None:
+            self._protocol.connectionLost(reason)
+
+
+# just enough of twisted.web.server.Request for the bridge's pages, filled in from a raw framed request; there are no
+# headers to parse and no temporary file for the body
+class RawRequest:
+    body_decoder = None
+
+    def __init__(self, channel, method: bytes, path: bytes, headers: list, body: bytes):
+        self.channel = channel
+        self.method = method
+        self.uri = self.path = path.split(b'?', 1)[0]
+        self.prepath = []
+        self.postpath = [unquote_to_bytes(segment) for segment in self.path[1:].split(b'/')]
+        self.requestHeaders = Headers()
+        for name, value in headers:
+            self.requestHeaders.addRawHeader(name, value)
+        self.requestHeaders.setRawHeaders(b'content-length', [b'%d' % len(body)])
+        self.content = BytesIO(body)
+        self.code = 200
+        self.responseHeaders = Headers()
+        self.response = []
+        self.finished = False
+        self._finish_notifications = []
+
+    def getHeader(self, key):
+        values = self.requestHeaders.getRawHeaders(key)
+        return values[-1] if values else None
+
+    def setHeader(self, name, value):
+        self.responseHeaders.setRawHeaders(name, [value])
+
+    def setResponseCode(self, code: int, message: bytes = None):
+        self.code = code
+
+    def getClientAddress(self):
+        return self.channel.transport.getPeer()
+
+    def notifyFinish(self) -> defer.Deferred:
+        notification = defer.Deferred()
+        self._finish_notifications.append(notification)
+        return notification
+
+    def write(self, data: bytes):
+        self.response.append(data)
+
+    def finish(self):
+        self.finished = True
+        notifications = self._finish_notifications
+        self._finish_notifications = []
+        for notification in notifications:
+            notification.callback(None)
+        self.channel.request_finished()
+
+    def connection_lost(self, reason):
+        notifications = self._finish_notifications
+        self._finish_notifications = []
+        for notification in notifications:
+            notification.errback(reason)
+
+
+# takes pipelined raw framed requests (see BridgeProtocol.RAW_ALPN), hands them to the site's pages like HTTP requests,
+# and answers them in the order they came in
+class RawIngressProtocol(Int32StringReceiver):
+    def __init__(self, site: BridgeSite):
+        self._site = site
+        self.MAX_LENGTH = site.raw_max_length
+        self._requests = deque()
+
+    def stringReceived(self, data):
+        try:
+            method, path, headers, body = BridgeProtocol.unpack_raw_request(data)
+        except BridgeProtocol.FramingError as e:
+            LOG.error("Dropping raw connection from %s: %s" % (self.transport.getPeer().host, e))
+            self.transport.loseConnection()
+            return
+
+        request = RawRequest(self, method, path, headers, body)
+        self._requests.append(request)
+        try:
+            result = getChildForRequest(self._site.resource, request).render(request)
+        except UnsupportedMethod:
+            result = fail(request, 405, "Bad request method")
+        except Exception:
+            LOG.error("Couldn't process raw request: %s" % Failure().getTraceback())
+            result = fail(request, 500, "Internal error")
+        if result is not NOT_DONE_YET:
+            request.write(result)
+            request.finish()
+
+    def request_finished(self):
+        while self._requests and self._requests[0].finished:
+            request = self._requests.popleft()
+            self.sendString(BridgeProtocol.pack_raw_response(request.code, request.responseHeaders.getAllRawHeaders(),
+                                                             b''.join(request.response)))
+
+    def lengthLimitExceeded(self, length):
+        LOG.error("Dropping raw connection from %s: %d byte request" % (self.transport.getPeer().host, length))
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        requests = self._requests
+        self._requests = deque()
+        for request in requests:
+            request.connection_lost(reason)
+
+
+# responses are small and latency-sensitive; Nagle's algorithm would hold them back until the peer's (delayed)
+# acknowledgement of whatever we sent before
+class NoDelayTLSProtocol(TLSMemoryBIOProtocol):
+    def makeConnection(self, transport):
+        transport.setTcpNoDelay(True)
+        TLSMemoryBIOProtocol.makeConnection(self, transport)
+
+
+class NoDelayTLSFactory(TLSMemoryBIOFactory):
+    protocol = NoDelayTLSProtocol
+
+
+class RequestError(Exception):
+    def __init__(self, code: int, message: str, integrity_failure: bool = False):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.integrity_failure = integrity_failure
+
+
+# turns a request body into the messages it carries, raising RequestError if it doesn't check out. this may run on a
+# pool thread, so it mustn't touch the bridge or its metrics
+def unpack_request(decoder, body, wire_format: str, integrity, codec, multipart: bool, batch_count_str,
+                   correlation_header, message_id_header, remote_digest: str) -> tuple:
+    if decoder is None:
+        # not sent by a bridge (or it would have been decoded as it streamed in); decode it the same way
+        decoder = BridgeProtocol.BodyDecoder(wire_format, integrity if batch_count_str is None else None, codec)
+        for offset in range(0, len(body), DECODE_CHUNK_SIZE):
+            decoder.feed(body[offset:offset + DECODE_CHUNK_SIZE])
+    zmq_data = decoder.finish()
+    if decoder.error is not None:
+        raise RequestError(400, decoder.error)
+
+    # batched bodies carry several length-prefixed messages, each with its own digest
+    if batch_count_str is not None:
+        try:
+            messages = BridgeProtocol.unpack_batch(zmq_data, int(batch_count_str), integrity)
+            if multipart:
+                messages = [BridgeProtocol.unpack_frames(message) for message in messages]
+            correlation_ids = BridgeProtocol.parse_id_list(correlation_header, len(messages))
+            message_ids = BridgeProtocol.parse_id_list(message_id_header, len(messages))
+        except BridgeProtocol.IntegrityError as e:
+            raise RequestError(500, "Bad batch: %s" % e, integrity_failure=True)
+        except ValueError as e:
+            raise RequestError(500, "Bad batch: %s" % e)
+        return messages, correlation_ids, message_ids, len(zmq_data)
+
+    # now check for validity; if we're invalid, don't forward it.
+    if not all(c in string.hexdigits for c in remote_digest):
+        raise RequestError(400, "Bad %s header %r" % (BridgeProtocol.HASH_HEADER, remote_digest[0:16]))
+    if decoder.has_digest():
+        digest = decoder.hexdigest()
+    else:
+        digest = integrity.hexdigest(zmq_data)
+    if not hmac.compare_digest(digest, remote_digest):
+        raise RequestError(500, "Hash check failed (%s != %s)" % (digest[0:8], remote_digest[0:8]),
+                           integrity_failure=True)
+
+    data_length = len(zmq_data)
+    if multipart:
+        try:
+            zmq_data = BridgeProtocol.unpack_frames(zmq_data)
+        except ValueError as e:
+            raise RequestError(400, "Bad multipart message: %s" % e)
+    try:
+        correlation_ids = BridgeProtocol.parse_id_list(correlation_header, 1)
+        message_ids = BridgeProtocol.parse_id_list(message_id_header, 1)
+    except ValueError as e:
+        raise RequestError(400, str(e))
+    return [zmq_data], correlation_ids, message_ids, data_length
 
 
 class ZMQDataPage(Resource):
     isLeaf = True
 
-    def __init__(self, bridge):
+    def __init__(self, zmq_bridge, integrity_policy: IntegrityPolicy, codecs: dict, metrics: BridgeMetrics.Metrics,
+                 offload_threshold: int = BridgeOffload.DEFAULT_OFFLOAD_THRESHOLD,
+                 dedupe_window: int = DEFAULT_DEDUPE_WINDOW):
         Resource.__init__(self)
-        self._bridge = bridge
+        self._zmq_bridge = zmq_bridge
+        self._integrity_policy = integrity_policy
+        self._codecs = codecs
+        self._offload = BridgeOffload.OrderedOffload("decoding", offload_threshold, metrics)
+        # ids of the most recent messages handed on, oldest first; a sender that retries gets its copies dropped, as
+        # long as they arrive within this many messages of the original
+        self._dedupe_window = dedupe_window
+        self._recent_ids = OrderedDict()
+        self._features = [feature for feature in BridgeProtocol.FEATURES
+                          if feature != BridgeProtocol.FEATURE_DEDUPE or dedupe_window > 0]
+        self._duplicates = metrics.counter("bridge_duplicate_messages_total",
+                                           "Messages dropped because one with the same id was already handed on")
+        self._requests = metrics.counter("bridge_http_requests_received_total",
+                                         "Requests received from the sending bridge, by response code",
+                                         labels=("code",))
+        self._received_bytes = metrics.counter("bridge_http_bytes_received_total",
+                                               "Request body bytes received from the sending bridge")
+        self._received_messages = metrics.counter("bridge_http_messages_received_total",
+                                                  "Messages received from the sending bridge and forwarded over ZMQ")
+        self._hash_failures = metrics.counter("bridge_hash_failures_total",
+                                              "Messages rejected because their integrity check failed")
 
     def render(self, request):
+        result = self._render(request)
+        if result is NOT_DONE_YET:
+            request.notifyFinish().addBoth(lambda ignored: self._requests.inc(1, (str(request.code),)))
+        else:
+            self._requests.inc(1, (str(request.code),))
+        return result
+
+    def _render(self, request):
         LOG.debug("Handling new request...")
+        # let the sender know which formats we understand, so it can switch to a cheaper one
+        request.setHeader(BridgeProtocol.WIRE_FORMATS_HEADER, ", ".join(BridgeProtocol.WIRE_FORMATS))
+        request.setHeader(BridgeProtocol.INTEGRITY_HEADER, ", ".join(self._integrity_policy.algorithms))
+        request.setHeader(BridgeProtocol.FEATURES_HEADER, ", ".join(self._features))
+        request.setHeader(BridgeProtocol.ACCEPT_ENCODING_HEADER, ", ".join(self._codecs))
+        if request.method in (b'GET', b'HEAD'):
+            # a capability probe; the headers above are the answer
+            return b''
         if request.method != b'POST':
             return fail(request, 405, "Bad request method")
 
         content_length_str = request.getHeader("Content-Length")
         if content_length_str is None:
-            return fail(request, 411, "Received bad request from %s" % self.client_address[0])
+            return fail(request, 411, "Missing Content-Length")
 
         content_length = int(content_length_str)
         # we _would_ use <= 0, but ZMQ itself actually uses 0 length "data"
         if content_length < 0:
-            return fail(request, 400, "Bad Content-Length from %s" % self.client_address[0])
-
-        # read the base64 encoded data
-        b64_data = request.content.read(content_length)
-        LOG.info("Received new request of %d bytes..." % len(b64_data))
-        LOG.debug("b64_data=%s" % b64_data)
-        # decode our data
-        zmq_data = base64.b64decode(b64_data)
-        # now check for validity; if we're invalid, don't forward it.
-        digest = hashlib.sha256(zmq_data).hexdigest()
-        remote_digest = request.getHeader("X-Verify-Hash")
-        if digest != remote_digest:
-            return fail(request, 500, "Hash check failed (%s != %s)" % (digest[0:8], remote_digest[0:8]))
-
-        # then forward it onto the ZMQ app
-        self._bridge.zmq_bridge.transfer_data_to_app(zmq_data)
-        LOG.info("Forwarded %d bytes..." % len(zmq_data))
+            return fail(request, 400, "Bad Content-Length")
+
+        integrity = self._integrity_policy.for_request(request)
+        if integrity is None:
+            return fail(request, 400, "Unsupported integrity algorithm %s"
+                        % request.getHeader(BridgeProtocol.ALGORITHM_HEADER))
+
+        # compressed bodies are decompressed before their integrity is checked
+        encoding = request.getHeader(BridgeProtocol.CONTENT_ENCODING_HEADER)
+        codec = None
+        if encoding is not None:
+            codec = self._codecs.get(encoding)
+            if codec is None:
+                return fail(request, 415, "Unsupported content encoding %s" % encoding)
+
+        wire_format = BridgeProtocol.wire_format_for(request.getHeader("Content-Type"))
+        batch_count_str = request.getHeader(BridgeProtocol.BATCH_HEADER)
+        multipart = request.getHeader(BridgeProtocol.ENVELOPE_HEADER) == BridgeProtocol.ENVELOPE_MULTIPART
+        decoder = getattr(request, "body_decoder", None)
+        if decoder is not None:
+            # the body was decoded as it streamed in, and single messages hashed along the way; what's left for them is
+            # cheap, but batch records still have to be verified
+            body = None
+            received = decoder.received
+            work = received if batch_count_str is not None else 0
+        else:
+            # read the encoded data
+            body = request.content.read(content_length)
+            received = work = len(body)
+            LOG.debug("body=%r", body)
+        self._received_bytes.inc(received)
+        MESSAGE_LOG.info("Received new %s request of %d bytes...", wire_format, received)
+
+        # each ZMQ peer's messages are handed on in the order their requests came in, even if a small one is done
+        # before a big one that's still being verified; the sending bridge names the peer if it knows it
+        peer = (request.getClientAddress().host, request.getHeader(BridgeProtocol.PEER_HEADER))
+        response = self._offload.run(peer, work,
+                                     unpack_request, decoder, body, wire_format, integrity, codec, multipart,
+                                     batch_count_str, request.getHeader(BridgeProtocol.CORRELATION_HEADER),
+                                     request.getHeader(BridgeProtocol.MESSAGE_ID_HEADER),
+                                     request.getHeader(BridgeProtocol.HASH_HEADER) or "")
+        response.addCallback(self._deliver, multipart, batch_count_str is not None)
+        response.addErrback(self._rejected, request)
+
+        result = []
+        response.addCallback(result.append)
+        if result:
+            return result[0]
+
+        # still being decoded, or waiting for the same sender's earlier requests; answer once it's done
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+
+        def respond(ignored):
+            if not lost:
+                request.write(result[0])
+                request.finish()
+
+        response.addCallback(respond)
+        return NOT_DONE_YET
+
+    def _deliver(self, unpacked, multipart: bool, batch: bool):
+        messages, correlation_ids, message_ids, data_length = unpacked
+        # only dispatch once the whole batch checked out, and keep the original order
+        for message, correlation_id, message_id in zip(messages, correlation_ids, message_ids):
+            if message_id is not None and message_id in self._recent_ids:
+                # the sender retried a request we had already handled
+                self._recent_ids.move_to_end(message_id)
+                self._duplicates.inc()
+                continue
+            self._transfer(message, multipart, correlation_id)
+            if message_id is not None and self._dedupe_window > 0:
+                self._recent_ids[message_id] = None
+                if len(self._recent_ids) > self._dedupe_window:
+                    self._recent_ids.popitem(last=False)
+        self._received_messages.inc(len(messages))
+        if batch:
+            MESSAGE_LOG.info("Forwarded batch of %d messages (%d bytes)...", len(messages), data_length)
+        else:
+            MESSAGE_LOG.info("Forwarded %d bytes...", data_length)
         return b'OK'
 
+    def _rejected(self, failure, request):
+        if not failure.check(RequestError):
+            LOG.error("Couldn't process request: %s" % failure.getTraceback())
+            return fail(request, 500, "Internal error")
+        if failure.value.integrity_failure:
+            self._hash_failures.inc()
+        return fail(request, failure.value.code, failure.value.message)
+
+    def _transfer(self, message, multipart: bool, correlation_id: str = None):
+        if correlation_id is not None:
+            self._zmq_bridge.transfer_correlated_to_app(correlation_id, message if multipart else [message])
+        elif multipart:
+            self._zmq_bridge.transfer_frames_to_app(message)
+        else:
+            self._zmq_bridge.transfer_data_to_app(message)
+
+
+class MetricsPage(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics: BridgeMetrics.Metrics):
+        Resource.__init__(self)
+        self._metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", BridgeMetrics.CONTENT_TYPE)
+        return self._metrics.render()
+
 
 class BridgePage(Resource):
     def render(self, request):
@@ -65,23 +494,66 @@ class BridgePage(Resource):
         return fail(request, 400, "No action specified.")
 
 
+# /zmq of a bridge carrying several routes; each route's data is posted to /zmq/<route>
+class RoutesPage(Resource):
+    def getChild(self, path, request):
+        return self
+
+    def render(self, request):
+        return fail(request, 404, "No route %s" % request.path.decode(errors="replace"))
+
+
 class Bridge(BaseBridge):
-    def __init__(self, zmq_bridge, bind_address: str, bind_port: int):
+    def __init__(self, zmq_bridge, bind_address: str, bind_port: int, integrity_key: bytes = b'',
+                 listen_fd: int = None, metrics: BridgeMetrics.Metrics = None,
+                 offload_threshold: int = BridgeOffload.DEFAULT_OFFLOAD_THRESHOLD,
+                 dedupe_window: int = DEFAULT_DEDUPE_WINDOW, tls_options: ssl.CertificateOptions = None,
+                 alpn: list = None, raw_ingress: bool = False, raw_max_length: int = BridgeProtocol.RAW_MAX_LENGTH):
         super().__init__(True)
 
+        # without a ZMQ bridge, data is only taken on the routes added later
         self.zmq_bridge = zmq_bridge
+        # share the ZMQ side's metrics unless we're given others, so /metrics covers both directions
+        self._metrics = metrics if metrics is not None else zmq_bridge.metrics
         self._twisted_root = BridgePage()
-        self._twisted_root.putChild(b'zmq', ZMQDataPage(self))
+        self._integrity_policy = IntegrityPolicy(integrity_key)
+        # the compression codecs we can take, i.e. those whose packages are installed
+        self._codecs = {codec.name: codec for codec in BridgeProtocol.available_codecs()}
+        if zmq_bridge is not None:
+            self._twisted_root.putChild(b'zmq', ZMQDataPage(zmq_bridge, self._integrity_policy, self._codecs,
+                                                            self._metrics, offload_threshold, dedupe_window))
+        else:
+            self._routes = RoutesPage()
+            self._twisted_root.putChild(b'zmq', self._routes)
+        self._twisted_root.putChild(b'metrics', MetricsPage(self._metrics))
+
+        self._twisted_server = BridgeSite(self._twisted_root, self._integrity_policy, self._codecs, alpn, raw_ingress,
+                                          raw_max_length)
+        if raw_ingress:
+            LOG.info("Taking raw framed requests (ALPN %s, up to %d bytes) on the HTTPS listener too"
+                     % (BridgeProtocol.RAW_ALPN.decode(), raw_max_length))
 
-        self._twisted_server = Site(self._twisted_root)
+        # load the key and certificate for SSL, unless we're given them already
+        ssl_context = tls_options if tls_options is not None else BridgeTLS.server_options()
 
-        # load the key and certificate for SSL
-        ssl_context = ssl.DefaultOpenSSLContextFactory(
-            'bridge-ssl.key',
-            'bridge-ssl.pem'
-        )
+        if listen_fd is not None:
+            # we're a worker; accept connections from the listening socket the parent process already bound
+            self._twisted_port = reactor.adoptStreamPort(listen_fd, socket.AF_INET,
+                                                         NoDelayTLSFactory(ssl_context, False, self._twisted_server))
+            self.listening = defer.succeed(self._twisted_port)
+            LOG.info("Accepting HTTPS connections on shared listener %s:%d" % (bind_address, bind_port))
+        else:
+            # create the endpoint and begin listening; TLS is layered on the same way SSL4ServerEndpoint would
+            self._twisted_endpoint = endpoints.TCP4ServerEndpoint(reactor, bind_port, interface=bind_address)
+            # fires once we're listening
+            self.listening = self._twisted_endpoint.listen(NoDelayTLSFactory(ssl_context, False,
+                                                                             self._twisted_server))
+            LOG.info("Created HTTPS endpoint on %s:%d" % (bind_address, bind_port))
 
-        # create the SSL endpoint and begin listening
-        self._twisted_endpoint = endpoints.SSL4ServerEndpoint(reactor, bind_port, ssl_context, interface=bind_address)
-        self._twisted_endpoint.listen(self._twisted_server)
-        LOG.info("Created HTTPS endpoint on %s:%d" % (bind_address, bind_port))
+    def add_route(self, name: str, zmq_bridge, offload_threshold: int = BridgeOffload.DEFAULT_OFFLOAD_THRESHOLD,
+                  dedupe_window: int = DEFAULT_DEDUPE_WINDOW):
+        # the route's metrics carry its name as a label
+        self._routes.putChild(name.encode(), ZMQDataPage(zmq_bridge, self._integrity_policy, self._codecs,
+                                                         self._metrics.scoped(route=name), offload_threshold,
+                                                         dedupe_window))
+        LOG.info("Taking data for route %s on /zmq/%s" % (name, name))
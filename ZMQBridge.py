@@ -1,123 +1,1097 @@
 import base64
-import hashlib
+import itertools
 import logging
+import os
+import time
+from collections import deque
 
-from twisted.internet import reactor, ssl
-from twisted.internet.defer import succeed
+import zmq
+from twisted.internet import defer, protocol, reactor
 from twisted.internet.endpoints import HostnameEndpoint
-from twisted.web.client import Agent, ProxyAgent
+from twisted.internet.task import LoopingCall, TaskDone, TaskStopped, cooperate
+from twisted.python import log
+from twisted.web.client import Agent, HTTP11ClientProtocol, HTTPConnectionPool, ProxyAgent, readBody
 from twisted.web.http_headers import Headers
-from twisted.web.iweb import IBodyProducer, IPolicyForHTTPS
-from txzmq import ZmqFactory, ZmqRouterConnection, ZmqDealerConnection, ZmqEndpoint, ZmqEndpointType
+from twisted.web.iweb import IBodyProducer
+from txzmq import ZmqConnection, ZmqFactory, ZmqRouterConnection, ZmqDealerConnection, ZmqEndpoint, ZmqEndpointType
 from zope.interface import implementer
 
+import BridgeMetrics
+import BridgeOffload
+import BridgeProtocol
+import BridgeSpool
+import BridgeTLS
 from BaseServerBridge import BaseBridge
+from Http2Agent import Http2Agent
+from RawAgent import RawAgent
 
 
 LOG = logging.getLogger("ZMQ")
+# per-message log lines go to their own logger, so they can be turned off under load without losing everything else
+MESSAGE_LOG = logging.getLogger("ZMQ.messages")
 USE_HTTPS_PROXY = False
 PROXY_HOST = "10.0.0.208"
 PROXY_PORT = 8888
+# outgoing bodies are encoded and written in chunks of this many bytes
+BODY_CHUNK_SIZE = 64 * 1024
+# seconds between attempts to negotiate with a destination that can't be reached yet
+PROBE_RETRY_INTERVAL = 1
+# round trips are timed for at most this many peers, and this many outstanding requests per peer; peers that never get
+# a reply must not grow the table forever
+ROUND_TRIP_MAX_PEERS = 65536
+ROUND_TRIP_MAX_PENDING = 1024
+# requests awaiting a correlated reply; once this many are outstanding, the oldest is given up on
+CORRELATION_MAX_PENDING = 65536
+# seconds before spooled messages are retried after the destination failed, doubling with every failed retry
+RETRY_BACKOFF_INITIAL = 0.5
+RETRY_BACKOFF_MAX = 30.0
 
 
-# helper class to bypass SSL verification due to self-signed certificates
-@implementer(IPolicyForHTTPS)
-class DisableSSLVerificationFactory(object):
-    def __init__(self):
-        pass
+def set_no_delay(protocol):
+    # a request's headers and body go out as separate writes; with Nagle's algorithm on, the body then waits for the
+    # peer's (delayed) acknowledgement of the headers, which costs up to 40ms per message
+    protocol.transport.setTcpNoDelay(True)
+    return protocol
 
-    def creatorForNetloc(self, hostname, port):
-        return ssl.CertificateOptions(verify=False)
+
+# an HTTP/1.1 client connection that tells its pool when it goes away, whether it was idle or in use
+class _PooledClientProtocol(HTTP11ClientProtocol):
+    def __init__(self, quiescent_callback, lost_callback):
+        super().__init__(quiescent_callback)
+        self._lost_callback = lost_callback
+
+    def connectionLost(self, reason):
+        HTTP11ClientProtocol.connectionLost(self, reason)
+        self._lost_callback(self)
+
+
+class _PooledClientFactory(protocol.Factory):
+    noisy = False
+
+    def __init__(self, quiescent_callback, lost_callback):
+        self._quiescent_callback = quiescent_callback
+        self._lost_callback = lost_callback
+
+    def buildProtocol(self, addr):
+        return _PooledClientProtocol(self._quiescent_callback, self._lost_callback)
+
+
+# persistent connection pool which keeps count of how its connections get used, so its size can be tuned. it never has
+# more than max_per_host connections to a destination open or opening; requests beyond that wait for one to come back,
+# since every connection past what's kept alive would be handshaken for one request and then thrown away
+class BridgeConnectionPool(HTTPConnectionPool):
+    def __init__(self, reactor, max_per_host: int, idle_timeout: float):
+        super().__init__(reactor, persistent=True)
+        self.maxPersistentPerHost = max_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self.requests = 0
+        self.connections_created = 0
+        # key -> connections that are open, in use or idle; key -> connections being opened
+        self._open = {}
+        self._opening = {}
+        # key -> (deferred, endpoint) of each request waiting for a connection
+        self._waiting = {}
+
+    def getConnection(self, key, endpoint):
+        self.requests += 1
+        # requests take connections in the order they asked for them
+        if self._waiting.get(key) or self._in_use(key) >= self.maxPersistentPerHost:
+            deferred = defer.Deferred()
+            self._waiting.setdefault(key, deque()).append((deferred, endpoint))
+            return deferred
+        return super().getConnection(key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.connections_created += 1
+        self._opening[key] = self._opening.get(key, 0) + 1
+        factory = _PooledClientFactory(lambda connection: self._putConnection(key, connection),
+                                       lambda connection: self._connection_lost(key, connection))
+
+        def connected(connection):
+            self._opening[key] -= 1
+            self._open.setdefault(key, set()).add(connection)
+            return set_no_delay(connection)
+
+        def failed(fail):
+            self._opening[key] -= 1
+            self._release(key)
+            return fail
+
+        return endpoint.connect(factory).addCallbacks(connected, failed)
+
+    def _putConnection(self, key, connection):
+        super()._putConnection(key, connection)
+        # the connection is still finishing off its last response; hand it on once that's done
+        self._reactor.callLater(0, self._release, key)
+
+    def _connection_lost(self, key, connection):
+        connections = self._open.get(key)
+        if connections is not None:
+            connections.discard(connection)
+        self._release(key)
+
+    def _in_use(self, key) -> int:
+        idle = self._connections.get(key, ())
+        return self._opening.get(key, 0) + sum(1 for connection in self._open.get(key, ()) if connection not in idle)
+
+    def _release(self, key):
+        waiting = self._waiting.get(key)
+        while waiting and self._in_use(key) < self.maxPersistentPerHost:
+            deferred, endpoint = waiting.popleft()
+            if not deferred.called:
+                super().getConnection(key, endpoint).chainDeferred(deferred)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.requests - self.connections_created,
+            "idle_connections": sum(len(connections) for connections in self._connections.values()),
+            "waiting_requests": sum(len(waiting) for waiting in self._waiting.values()),
+        }
+
+
+def make_agent(http2: bool, pool_max_per_host: int, pool_idle_timeout: float, metrics: BridgeMetrics.Metrics,
+               tls_policy: BridgeTLS.ClientPolicy = None, raw_egress: bool = False) -> tuple:
+    # returns the agent and, unless it's HTTP/2 or raw framing, its connection pool. the TLS policy must offer the
+    # protocol the agent speaks (raw framing, h2 or http/1.1)
+    if tls_policy is None:
+        tls_policy = BridgeTLS.ClientPolicy(http2=http2, raw=raw_egress)
+    # check if we want to use an HTTPS proxy; useful for Fiddler
+    if USE_HTTPS_PROXY:
+        pool = BridgeConnectionPool(reactor, pool_max_per_host, pool_idle_timeout)
+        agent = ProxyAgent(HostnameEndpoint(reactor, PROXY_HOST, PROXY_PORT), reactor, pool=pool)
+        LOG.warning("Agent is using HTTP proxy for outbound work!")
+    elif raw_egress:
+        # pipeline every in-flight message over a single connection per destination, without HTTP
+        pool = None
+        agent = RawAgent(reactor, tls_policy)
+        LOG.info("Agent is pipelining requests over raw framing")
+    elif http2:
+        # multiplex every in-flight message over a single HTTP/2 connection per destination
+        pool = None
+        agent = Http2Agent(reactor, tls_policy)
+        LOG.info("Agent is multiplexing requests over HTTP/2")
+    else:
+        # otherwise, use the standard Agent; connections are kept alive and reused between requests, and new ones
+        # resume the TLS session of an earlier one
+        pool = BridgeConnectionPool(reactor, pool_max_per_host, pool_idle_timeout)
+        agent = Agent(reactor, contextFactory=tls_policy, pool=pool)
+        LOG.info("Agent is using up to %d connections per destination and keeping them alive (idle timeout: %.1fs)"
+                 % (pool_max_per_host, pool_idle_timeout))
+    metrics.gauge("bridge_connection_stats", "Outbound connection statistics", labels=("stat",),
+                  function=lambda: connection_stats(agent, pool))
+    return agent, pool
+
+
+def connection_stats(agent, pool: BridgeConnectionPool) -> dict:
+    if pool is not None:
+        return pool.stats()
+    return agent.stats()
 
 
 class Bridge(BaseBridge):
-    def __init__(self, address: str, port: int, destination: str, is_app_hosting: bool):
+    def __init__(self, address: str, port: int, destination: str, is_app_hosting: bool,
+                 batch_window: float = 0.0, batch_max_bytes: int = 1024 * 1024, batch_max_count: int = 256,
+                 pool_max_per_host: int = 8, pool_idle_timeout: float = 240.0, http2: bool = False,
+                 stats_interval: float = 0.0, wire_format: str = BridgeProtocol.WIRE_FORMAT_BASE64,
+                 integrity: str = BridgeProtocol.DEFAULT_INTEGRITY, integrity_key: bytes = b'',
+                 max_in_flight: int = 64, max_queue: int = 1024, high_water_mark: int = 1000,
+                 proxy_backend: str = None, metrics: BridgeMetrics.Metrics = None,
+                 compression: str = BridgeProtocol.COMPRESSION_NONE, compression_threshold: int = 512,
+                 offload_threshold: int = BridgeOffload.DEFAULT_OFFLOAD_THRESHOLD, offload_threads: int = 0,
+                 spool_dir: str = None, spool_segment_size: int = BridgeSpool.DEFAULT_SEGMENT_SIZE,
+                 spool_max_bytes: int = BridgeSpool.DEFAULT_MAX_BYTES, at_least_once: bool = False,
+                 destination_route: str = None, agent=None, pool: BridgeConnectionPool = None,
+                 zmq_factory: ZmqFactory = None, socket_type: str = None, topics=(),
+                 tls_policy: BridgeTLS.ClientPolicy = None, raw_egress: bool = False):
         self._address = address
         self._port = port
         self._destination = destination
         self._is_app_hosting = is_app_hosting
-        self._zmq_factory = ZmqFactory()
+        self._zmq_factory = zmq_factory if zmq_factory is not None else ZmqFactory()
+        # requests and replies go through a ROUTER we bind or a DEALER connected to the application; one-way streams
+        # go through their own socket type, which connects if the application is hosting and binds otherwise
+        if socket_type is None:
+            socket_type = BridgeProtocol.SOCKET_DEALER if is_app_hosting else BridgeProtocol.SOCKET_ROUTER
+        self._socket_type = socket_type
+        self._stream = socket_type in BridgeProtocol.STREAM_SOURCES + BridgeProtocol.STREAM_SINKS
 
+        if self._stream:
+            zmq_socket_class = STREAM_CONNECTIONS[socket_type]
+            zmq_endpoint = ZmqEndpoint(ZmqEndpointType.connect if is_app_hosting else ZmqEndpointType.bind,
+                                       "tcp://%s:%d" % (address, port))
+            LOG.info("Configured txZMQ for a one-way %s stream - socket %s tcp://%s:%d"
+                     % (socket_type, "connected to" if is_app_hosting else "bound to", address, port))
         # if the ZMQ app is binding and hosting the server, we need to connect to that instead
-        if is_app_hosting:
-            zmq_socket_class = ZmqDealerConnection
+        elif proxy_backend is not None:
+            # we're one of several workers; the parent's proxy owns the ZMQ address and deals messages out to us, with
+            # their routing envelope intact
+            zmq_socket_class = FlowControlledDealerConnection
+            zmq_endpoint = ZmqEndpoint(ZmqEndpointType.connect, proxy_backend)
+            LOG.info("Configured txZMQ for worker mode - connected to proxy at %s" % proxy_backend)
+        elif is_app_hosting:
+            zmq_socket_class = FlowControlledDealerConnection
             zmq_endpoint = ZmqEndpoint(ZmqEndpointType.connect, "tcp://%s:%d" % (address, port))
             LOG.info("Configured txZMQ for connecting to application "
                      "- connected to tcp://%s:%d" % (address, port))
         else:
             # otherwise, bind to the address/port and have them connect to us
-            zmq_socket_class = ZmqRouterConnection
+            zmq_socket_class = FlowControlledRouterConnection
             zmq_endpoint = ZmqEndpoint(ZmqEndpointType.bind, "tcp://%s:%d" % (address, port))
             LOG.info("Configured txZMQ for application connecting to us "
                      "- socket bound to tcp://%s:%d" % (address, port))
 
-        self._zmq_socket = zmq_socket_class(self._zmq_factory, zmq_endpoint)
+        # the high-water mark bounds what ZeroMQ itself buffers while we've stopped reading from the socket
+        self._zmq_socket = zmq_socket_class(self._zmq_factory, zmq_endpoint, high_water_mark=high_water_mark)
+        if zmq_socket_class is FlowControlledRouterConnection:
+            # report replies to peers that have gone away instead of silently dropping them
+            self._zmq_socket.socket.setsockopt(zmq.ROUTER_MANDATORY, 1)
         # store the socket identity of the client; we need it to send data back to the local ZMQ app
         self._zmq_socket_identity = None
+        # only messages whose first frame starts with one of these prefixes are sent on. a SUB socket subscribes to
+        # them, so the publisher doesn't even send us the rest; for PULL we drop them ourselves
+        self._topics = tuple(topics or ())
+        if socket_type == BridgeProtocol.SOCKET_SUB:
+            for topic in self._topics or (b'',):
+                self._zmq_socket.socket.setsockopt(zmq.SUBSCRIBE, topic)
+            LOG.info("Subscribed to %s" % (", ".join(repr(topic) for topic in self._topics) or "everything"))
 
+        self.metrics = metrics if metrics is not None else BridgeMetrics.Metrics()
         LOG.debug("Initializing socket and agent")
-        # check if we want to use an HTTPS proxy; useful for Fiddler
-        if USE_HTTPS_PROXY:
-            self._twisted_agent = ProxyAgent(HostnameEndpoint(reactor, PROXY_HOST, PROXY_PORT), reactor)
-            LOG.warning("Agent is using HTTP proxy for outbound work!")
+        if agent is None:
+            agent, pool = make_agent(http2, pool_max_per_host, pool_idle_timeout, self.metrics, tls_policy,
+                                     raw_egress)
+        # several routes may share one agent (and with it, its connection pool); the destination path tells them apart
+        self._twisted_agent = agent
+        self._twisted_pool = pool
+        # a pub or push socket only hands messages to the application, so it doesn't need a destination
+        self._url = None
+        if destination is not None:
+            self._url = ("%s/zmq/%s" % (destination, destination_route) if destination_route
+                         else "%s/zmq" % destination).encode()
+
+        # requests waiting for one of the max_in_flight slots; once max_queue of them pile up we stop reading from the
+        # ZMQ socket until half of them have drained, which pushes back on the application through ZeroMQ
+        if socket_type in BridgeProtocol.STREAM_SOURCES:
+            # a stream's requests could overtake each other on different connections, so there's only ever one in
+            # flight; whatever queues up meanwhile goes out together in the next one (see _dispatch)
+            max_in_flight = 1
+        self._max_in_flight = max_in_flight
+        self._max_queue = max_queue
+        self._send_queue = deque()
+        self._in_flight = 0
+        self._reading_pauses = 0
+        LOG.info("Allowing %d requests in flight and %d queued (ZMQ high-water mark: %d)"
+                 % (max_in_flight, max_queue, high_water_mark))
+
+        if stats_interval > 0:
+            LoopingCall(lambda: LOG.info("Connection stats: %s, queue stats: %s, compression stats: %s"
+                                         % (self.connection_stats(), self.queue_stats(),
+                                            self.compression_stats()))).start(stats_interval, now=False)
+
+        self._setup_metrics()
+        # big messages are packed, hashed and compressed off the reactor thread, without reordering any peer's messages
+        self._offload = BridgeOffload.OrderedOffload("encoding", offload_threshold, self.metrics)
+        if offload_threads > 0:
+            # the pool is the reactor's, and also decodes big requests for the HTTPS side
+            reactor.suggestThreadPoolSize(offload_threads)
+        # when each peer's outstanding requests came in, so the reply can be timed when we deliver it; only bridges the
+        # application connects to see both the request and its reply
+        self._round_trips = {}
+        self._track_round_trips = not is_app_hosting and not self._stream
+
+        # once the destination supports it, requests from the application connected to us are sent with a correlation id
+        # instead of their routing envelope; the envelope waits here for the reply with the same id, so replies can come
+        # back in any order and are timed exactly. as a worker behind the proxy, a reply may arrive at any of the
+        # workers, so the envelope has to travel with the message instead
+        self._correlation_allowed = not is_app_hosting and proxy_backend is None and not self._stream
+        self._correlation = False
+        self._correlation_ids = itertools.count()
+        # correlation id -> (routing envelope, when the request came in)
+        self._awaiting_reply = {}
+        # on the application's side: correlation id -> number of requests with that id the application still has to answer
+        self._awaiting_app = {}
+
+        # we start out with the original base64 + SHA-256 format, which every bridge understands, and move to the
+        # configured format/integrity check once the destination has advertised support for it
+        self._wanted_wire_format = wire_format
+        self._wanted_integrity = BridgeProtocol.make_integrity(integrity, integrity_key)
+        self._wire_format = BridgeProtocol.WIRE_FORMAT_BASE64
+        self._integrity = BridgeProtocol.make_integrity(BridgeProtocol.DEFAULT_INTEGRITY)
+        if self._wanted_integrity.name == self._integrity.name:
+            self._integrity = self._wanted_integrity
+
+        # likewise, bodies of at least compression_threshold bytes are only compressed once the destination has said it
+        # can decompress them; bodies that don't shrink are sent as they are
+        self._wanted_codec = None
+        if compression != BridgeProtocol.COMPRESSION_NONE:
+            self._wanted_codec = BridgeProtocol.make_codec(compression)
+        self._codec = None
+        self._compression_threshold = compression_threshold
+        self._compressed_bodies = 0
+        self._incompressible_bodies = 0
+        self._compression_input_bytes = 0
+        self._compression_output_bytes = 0
+
+        # if batching is enabled, messages are gathered until the window expires or a size limit is hit. the limits
+        # also bound how much of a stream is sent in one request
+        self._batch_max_bytes = batch_max_bytes
+        self._batch_max_count = batch_max_count
+        if batch_window > 0:
+            self._batcher = MessageBatcher(self._enqueue_batch, batch_window, batch_max_bytes, batch_max_count)
+            LOG.info("Batching messages (window: %.3fs, max bytes: %d, max count: %d)"
+                     % (batch_window, batch_max_bytes, batch_max_count))
         else:
-            # otherwise, use the standard Agent with a nulled SSL verification process, since self-signed certificates
-            # fail the connection process entirely
-            self._twisted_agent = Agent(reactor, contextFactory=DisableSSLVerificationFactory())
+            self._batcher = None
+
+        # with a spool, messages the destination didn't take (or that don't fit in the send queue) are stored on disk and
+        # replayed in order once it's back, with exponential backoff between attempts. with at_least_once, every message
+        # is spooled before it's sent and only removed once the destination has accepted it. since a message may then
+        # arrive twice, each carries an id the destination can drop duplicates by
+        self._spool = None
+        if spool_dir is not None:
+            self._spool = BridgeSpool.Spool(spool_dir, spool_segment_size, spool_max_bytes)
+            LOG.info("Spooling undeliverable messages to %s (up to %d bytes; %s delivery)"
+                     % (spool_dir, spool_max_bytes, "at-least-once" if at_least_once else "best-effort"))
+        elif at_least_once:
+            raise ValueError("At-least-once delivery needs a spool directory")
+        self._at_least_once = at_least_once
+        self._message_ids = itertools.count(int.from_bytes(os.urandom(8), "big") & ~0xffffffff)
+        # message id -> spool token of each replayed message that's on its way
+        self._replaying = {}
+        self._destination_down = False
+        self._retry_backoff = RETRY_BACKOFF_INITIAL
+        self._retry_timer = None
+        # while the destination is down, one spooled message at a time is sent to find out whether it's back
+        self._retry_allowed = False
+        self._dedupe = False
+
+        # whole multipart messages (routing envelope included) are only sent once the destination says it can take them;
+        # until then we fall back to sending the last frame and remembering the last peer identity
+        self._multipart = False
+
+        # ask the destination what it supports before forwarding anything, so the first messages don't go out in a
+        # format that loses their routing envelope; messages arriving in the meantime are held back
+        self._negotiated = False
+        self._held = []
+        if socket_type not in BridgeProtocol.STREAM_SINKS:
+            self._probe()
 
         # setup auto-POST method for our socket
         def post_data(*zmq_data_recv):
-            self._zmq_socket_identity = zmq_data_recv[0]
-            data = zmq_data_recv[-1]
-            LOG.debug("Received %d bytes of data" % len(data))
-            # hash and base64 our data for validation and transportation
-            data_hash = hashlib.sha256(data).hexdigest()
-            b64_data = base64.b64encode(data)
-            # POST it to the remote server
-            request = self._twisted_agent.request(
-                b'POST',
-                (destination + "/zmq").encode(),
-                Headers({
-                    'User-Agent': ['ZMQ-HTTP-Bridge-Agent'],
-                    'X-Verify-Hash': [data_hash]
-                }),
-                bodyProducer=StringProducer(b64_data)
-            )
-
-            def handle_twisted_error(fail):
-                # print out _all_ errors, since Twisted doesn't provide all exceptions
-                for error in fail.value.reasons:
-                    LOG.error("%s", str(error))
-
-            request.addErrback(handle_twisted_error)
-            request.addCallback(lambda ignored: LOG.debug("Request completed."))
-            LOG.info("Forwarded data to destination (hash preview: %s)" % data_hash[0:8])
+            received = time.monotonic()
+            frames = list(zmq_data_recv)
+            size = sum(len(frame) for frame in frames)
+            LOG.debug("Received %d frames (%d bytes) of data", len(frames), size)
+            self._zmq_received.inc()
+            self._zmq_received_bytes.inc(size)
+            if self._stream:
+                if self._topics and not frames[0].startswith(self._topics):
+                    self._zmq_filtered.inc()
+                    return
+            else:
+                self._zmq_socket_identity = frames[0]
+            if not self._negotiated:
+                self._held.append((frames, received))
+                if len(self._held) >= self._max_queue:
+                    self._pause_reading()
+            else:
+                self._forward(frames, received)
 
         self._zmq_socket.gotMessage = post_data
 
+    def _setup_metrics(self):
+        metrics = self.metrics
+        self._zmq_received = metrics.counter("bridge_zmq_messages_received_total",
+                                             "Messages received from the local ZMQ application")
+        self._zmq_received_bytes = metrics.counter("bridge_zmq_bytes_received_total",
+                                                   "Bytes received from the local ZMQ application")
+        self._zmq_sent = metrics.counter("bridge_zmq_messages_sent_total",
+                                         "Messages delivered to the local ZMQ application")
+        self._zmq_sent_bytes = metrics.counter("bridge_zmq_bytes_sent_total",
+                                               "Bytes delivered to the local ZMQ application")
+        self._zmq_filtered = metrics.counter("bridge_zmq_messages_filtered_total",
+                                             "Messages received from the local ZMQ application and dropped because "
+                                             "they didn't match any topic")
+        self._zmq_dropped = metrics.counter("bridge_zmq_messages_dropped_total",
+                                            "Messages ZeroMQ refused to deliver to the local application",
+                                            labels=("reason",))
+        self._posts = metrics.counter("bridge_http_requests_sent_total",
+                                      "Requests sent to the destination bridge, by outcome", labels=("result",))
+        self._posted_messages = metrics.counter("bridge_http_messages_sent_total",
+                                                "Messages sent to the destination bridge")
+        self._posted_bytes = metrics.counter("bridge_http_bytes_sent_total",
+                                             "Request body bytes sent to the destination bridge")
+        self._post_latency = metrics.histogram("bridge_post_latency_seconds",
+                                               "Time from receiving a message over ZMQ until the request carrying it "
+                                               "to the destination completed")
+        self._round_trip_latency = metrics.histogram("bridge_round_trip_seconds",
+                                                     "Time from receiving a request over ZMQ until its reply was "
+                                                     "delivered back to the application")
+        metrics.gauge("bridge_in_flight_requests", "Requests to the destination awaiting a response",
+                      function=lambda: self._in_flight)
+        metrics.gauge("bridge_queued_requests", "Requests waiting for an in-flight slot",
+                      function=lambda: len(self._send_queue))
+        metrics.gauge("bridge_correlated_requests_pending", "Correlated requests still awaiting their reply",
+                      function=lambda: len(self._awaiting_reply) + sum(self._awaiting_app.values()))
+        self._correlations_expired = metrics.counter("bridge_correlations_expired_total",
+                                                     "Correlated requests given up on because too many were pending")
+        self._spooled = metrics.counter("bridge_spooled_messages_total",
+                                        "Messages written to the spool, retries included")
+        self._replayed = metrics.counter("bridge_replayed_messages_total", "Messages sent on from the spool")
+        self._spool_full = metrics.counter("bridge_spool_full_total", "Messages that didn't fit in the spool")
+        metrics.gauge("bridge_spool_pending_messages", "Spooled messages waiting to be sent",
+                      function=lambda: self._spool.pending() if self._spool is not None else 0)
+        metrics.gauge("bridge_spool_bytes", "Bytes of spooled messages not yet delivered",
+                      function=lambda: self._spool.bytes() if self._spool is not None else 0)
+        metrics.gauge("bridge_destination_down", "1 while the destination is failing and messages are spooled",
+                      function=lambda: int(self._destination_down))
+        metrics.gauge("bridge_held_messages", "Messages held back until the destination has been negotiated with",
+                      function=lambda: len(self._held))
+        metrics.gauge("bridge_zmq_reading_paused", "1 while reads from ZMQ are paused for backpressure",
+                      function=lambda: int(self._zmq_socket.reading_paused))
+        metrics.counter("bridge_zmq_reading_pauses_total", "Times reads from ZMQ were paused for backpressure",
+                        function=lambda: self._reading_pauses)
+        metrics.counter("bridge_compression_input_bytes_total", "Bytes handed to the compressor",
+                        function=lambda: self._compression_input_bytes)
+        metrics.counter("bridge_compression_output_bytes_total",
+                        "Bytes sent for what was handed to the compressor (incompressible bodies count as sent)",
+                        function=lambda: self._compression_output_bytes)
+        metrics.gauge("bridge_compression_ratio", "Bytes handed to the compressor per byte sent",
+                      function=lambda: self.compression_stats()["ratio"])
+
+    def _round_trip_started(self, identity, received):
+        pending = self._round_trips.get(identity)
+        if pending is None:
+            if len(self._round_trips) >= ROUND_TRIP_MAX_PEERS:
+                # forget the peer we've been tracking the longest
+                del self._round_trips[next(iter(self._round_trips))]
+            pending = self._round_trips[identity] = deque(maxlen=ROUND_TRIP_MAX_PENDING)
+        pending.append(received)
+
+    def _round_trip_finished(self, identity):
+        pending = self._round_trips.get(identity)
+        if pending:
+            # replies are assumed to come back in the order their requests were sent
+            self._round_trip_latency.observe(time.monotonic() - pending.popleft())
+            if not pending:
+                del self._round_trips[identity]
+
+    def _forward(self, frames, received):
+        # the application is our only peer if we connect to it; otherwise each client is told apart by its identity
+        peer = None if self._is_app_hosting or self._stream else frames[0]
+        frames, correlation_id = self._correlate(frames, received)
+        if self._spool is None:
+            self._send((frames, correlation_id, None), received, peer)
+            return
+
+        message = (frames, correlation_id, "%016x" % next(self._message_ids))
+        # once anything is spooled, everything after it has to queue up behind it
+        if self._at_least_once or self._destination_down or self._spool.pending() \
+                or len(self._send_queue) >= self._max_queue:
+            if self._spool.append(BridgeSpool.pack_message(*message)):
+                self._spooled.inc()
+                self._replay()
+                return
+            self._spool_full.inc()
+            LOG.warning("Spool is full; holding message in memory")
+        self._send(message, received, peer)
+
+    def _send(self, message, received, peer):
+        if self._batcher is not None:
+            self._batcher.add(message, received)
+        else:
+            self._enqueue(self._encode_single, [message], [received], peer, sum(len(frame) for frame in message[0]))
+
+    def _enqueue_batch(self, batch):
+        messages = [message for message, received in batch]
+        # a batch mixes peers; batches keep the order they were put together in
+        self._enqueue(self._encode_batch, messages, [received for message, received in batch], None,
+                      sum(len(frame) for frames, correlation_id, message_id in messages for frame in frames))
+
+    def _replay(self):
+        if self._spool is None or not self._negotiated:
+            return
+        # replayed messages only take up free in-flight slots; the spool is where the backlog waits. a stream's single
+        # request carries a batch of them
+        limit = self._max_in_flight + (self._batch_max_count if self._stream else 0)
+        while self._spool.pending() and self._in_flight + len(self._send_queue) < limit:
+            if self._destination_down:
+                if not self._retry_allowed:
+                    return
+                self._retry_allowed = False
+            token, record = self._spool.pop()
+            message = BridgeSpool.unpack_message(record)
+            self._replaying[message[2]] = token
+            self._replayed.inc()
+            self._send(message, time.monotonic(), None)
+        if self._batcher is not None and self._destination_down:
+            # a retry shouldn't wait for the batch window
+            self._batcher.flush()
+
+    def _settle(self, outcome, messages):
+        # outcome is True if the destination took the messages, False if they're worth retrying, and None if not
+        if outcome is False:
+            for message in messages:
+                if self._spool.append(BridgeSpool.pack_message(*message)):
+                    self._spooled.inc()
+                else:
+                    self._spool_full.inc()
+                    LOG.error("Spool is full; dropping message %s" % message[2])
+            self._destination_failed()
+        elif outcome:
+            self._destination_recovered()
+        # the messages are either delivered or spooled again (as new records) by now
+        for frames, correlation_id, message_id in messages:
+            token = self._replaying.pop(message_id, None)
+            if token is not None:
+                self._spool.acknowledge(token)
+
+    def _destination_failed(self):
+        if self._retry_timer is not None and self._retry_timer.active():
+            # other requests sent before we noticed; one retry is scheduled already
+            return
+        if self._destination_down:
+            self._retry_backoff = min(self._retry_backoff * 2, RETRY_BACKOFF_MAX)
+        else:
+            self._destination_down = True
+            self._retry_backoff = RETRY_BACKOFF_INITIAL
+        LOG.warning("Destination failed; spooling messages and retrying in %.1f seconds (%d spooled)"
+                    % (self._retry_backoff, self._spool.pending()))
+        self._retry_timer = reactor.callLater(self._retry_backoff, self._retry)
+
+    def _retry(self):
+        self._retry_allowed = True
+        self._replay()
+        if self._retry_allowed:
+            # nothing left to retry with; new messages will find out whether the destination is back
+            self._retry_allowed = False
+            self._destination_down = False
+
+    def _destination_recovered(self):
+        if self._destination_down:
+            self._destination_down = False
+            if self._retry_timer is not None and self._retry_timer.active():
+                self._retry_timer.cancel()
+            LOG.info("Destination is back; replaying %d spooled messages" % self._spool.pending())
+
+    def _correlate(self, frames, received) -> tuple:
+        # returns the frames to send and their correlation id, if they have one
+        if self._stream:
+            # nothing comes back for a stream
+            return frames, None
+        if self._is_app_hosting:
+            # the application answering a correlated request hands back the id we gave it as its envelope
+            if len(frames) > 2 and frames[1] == b'' and self._answered(frames[0]):
+                return frames[2:], frames[0].decode()
+            return frames, None
+
+        envelope, body = BridgeProtocol.split_envelope(frames)
+        if not self._correlation or not body:
+            if self._track_round_trips:
+                self._round_trip_started(frames[0], received)
+            return frames, None
+
+        if len(self._awaiting_reply) >= CORRELATION_MAX_PENDING:
+            # give up on the oldest request; its reply will be dropped if it ever turns up
+            del self._awaiting_reply[next(iter(self._awaiting_reply))]
+            self._correlations_expired.inc()
+        correlation_id = "%x" % next(self._correlation_ids)
+        self._awaiting_reply[correlation_id] = (envelope, received)
+        return body, correlation_id
+
+    def _answered(self, correlation_id: bytes) -> bool:
+        try:
+            correlation_id = correlation_id.decode()
+        except UnicodeDecodeError:
+            return False
+        count = self._awaiting_app.get(correlation_id)
+        if count is None:
+            return False
+        if count > 1:
+            self._awaiting_app[correlation_id] = count - 1
+        else:
+            del self._awaiting_app[correlation_id]
+        return True
+
+    def _enqueue(self, encode, messages, received, peer, size: int):
+        self._send_queue.append((encode, messages, received, peer, size))
+        self._dispatch()
+        if len(self._send_queue) >= self._max_queue:
+            self._pause_reading()
+
+    def _dispatch(self):
+        while self._send_queue and self._in_flight < self._max_in_flight:
+            encode, messages, received, peer, size = self._send_queue.popleft()
+            if self._stream:
+                encode, messages, received, size = self._coalesce(encode, messages, received, size)
+            self._in_flight += 1
+            self._offload.run(peer, size, encode, messages, peer) \
+                .addCallback(self._post) \
+                .addErrback(self._encoding_failed) \
+                .addBoth(self._request_finished, messages, received)
+
+        if self._zmq_socket.reading_paused and self._negotiated and len(self._send_queue) <= self._max_queue // 2:
+            LOG.debug("Send queue drained to %d requests; resuming reads from ZMQ" % len(self._send_queue))
+            self._zmq_socket.resumeReading()
+
+    def _coalesce(self, encode, messages, received, size: int) -> tuple:
+        # the requests queued behind a stream's first one, up to the batch limits, are sent as one batch with it
+        while self._send_queue and len(messages) + len(self._send_queue[0][1]) <= self._batch_max_count \
+                and size + self._send_queue[0][4] <= self._batch_max_bytes:
+            next_encode, next_messages, next_received, next_peer, next_size = self._send_queue.popleft()
+            encode = self._encode_batch
+            messages = messages + next_messages
+            received = received + next_received
+            size += next_size
+        return encode, messages, received, size
+
+    def _request_finished(self, outcome, messages, received):
+        now = time.monotonic()
+        for started in received:
+            self._post_latency.observe(now - started)
+        self._in_flight -= 1
+        if outcome is not True and (outcome is None or self._spool is None):
+            # the requests never made it across, so no reply is coming for them
+            self._abandon([correlation_id for frames, correlation_id, message_id in messages])
+        if self._spool is not None:
+            self._settle(outcome, messages)
+        self._dispatch()
+        self._replay()
+
+    def _pause_reading(self):
+        if not self._zmq_socket.reading_paused:
+            LOG.debug("Send queue is full (%d requests, %d in flight); pausing reads from ZMQ"
+                      % (len(self._send_queue) + len(self._held), self._in_flight))
+            self._reading_pauses += 1
+            self._zmq_socket.pauseReading()
+
+    def queue_stats(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "queued": len(self._send_queue),
+            "held": len(self._held),
+            "reading_paused": self._zmq_socket.reading_paused,
+            "reading_pauses": self._reading_pauses,
+        }
+
+    def _probe(self):
+        request = self._twisted_agent.request(
+            b'GET',
+            self._url,
+            Headers({'User-Agent': ['ZMQ-HTTP-Bridge-Agent']})
+        )
+
+        def probed(response):
+            self._negotiate(response.headers)
+            self._negotiated = True
+            held = self._held
+            self._held = []
+            LOG.info("Negotiated with destination; forwarding %d held messages" % len(held))
+            for frames, received in held:
+                self._forward(frames, received)
+            self._dispatch()
+            self._replay()
+            return readBody(response)
+
+        def probe_failed(fail):
+            LOG.warning("Couldn't reach destination to negotiate (%s); retrying in %d seconds"
+                        % (fail.getErrorMessage(), PROBE_RETRY_INTERVAL))
+            reactor.callLater(PROBE_RETRY_INTERVAL, self._probe)
+
+        request.addCallbacks(probed, probe_failed)
+
+    # the _encode methods may run on a pool thread. negotiating can switch formats while they do, so each setting is read
+    # exactly once, and the headers always describe the body they go with
+    def _encode_single(self, messages, peer) -> tuple:
+        (frames, correlation_id, message_id), = messages
+        integrity = self._integrity
+        multipart = self._multipart
+        data = BridgeProtocol.pack_frames(frames) if multipart else frames[-1]
+        # hash and encode our data for validation and transportation
+        data_hash = integrity.hexdigest(data)
+        MESSAGE_LOG.info("Forwarding data to destination (hash preview: %s)", data_hash[0:8])
+        headers = {BridgeProtocol.HASH_HEADER: [data_hash]}
+        if peer is not None:
+            headers[BridgeProtocol.PEER_HEADER] = [peer[:BridgeProtocol.MAX_PEER_LENGTH].hex()]
+        return self._finish_encoding(data, headers, integrity, multipart, messages)
+
+    def _encode_batch(self, messages, peer) -> tuple:
+        integrity = self._integrity
+        multipart = self._multipart
+        # every record carries its own digest, so no hash header is needed here
+        body = BridgeProtocol.pack_batch([BridgeProtocol.pack_frames(frames) if multipart else frames[-1]
+                                          for frames, correlation_id, message_id in messages], integrity)
+        MESSAGE_LOG.info("Forwarding batch of %d messages (%d bytes) to destination", len(messages), len(body))
+        return self._finish_encoding(body, {BridgeProtocol.BATCH_HEADER: [str(len(messages))]}, integrity, multipart,
+                                     messages)
+
+    def _finish_encoding(self, payload, headers, integrity, multipart: bool, messages) -> tuple:
+        if integrity.name != BridgeProtocol.DEFAULT_INTEGRITY:
+            headers[BridgeProtocol.ALGORITHM_HEADER] = [integrity.name]
+        if multipart:
+            headers[BridgeProtocol.ENVELOPE_HEADER] = [BridgeProtocol.ENVELOPE_MULTIPART]
+        correlation_ids = [correlation_id for frames, correlation_id, message_id in messages]
+        if any(correlation_ids):
+            headers[BridgeProtocol.CORRELATION_HEADER] = [BridgeProtocol.format_id_list(correlation_ids)]
+        message_ids = [message_id for frames, correlation_id, message_id in messages]
+        if self._dedupe and any(message_ids):
+            headers[BridgeProtocol.MESSAGE_ID_HEADER] = [BridgeProtocol.format_id_list(message_ids)]
+        # (bytes in, bytes out) if compression was tried; counted once we're back on the reactor thread
+        compression = None
+        codec = self._codec
+        if codec is not None and len(payload) >= self._compression_threshold:
+            compressed = codec.compress(payload)
+            if len(compressed) < len(payload):
+                compression = (len(payload), len(compressed))
+                headers[BridgeProtocol.CONTENT_ENCODING_HEADER] = [codec.name]
+                payload = compressed
+            else:
+                compression = (len(payload), len(payload))
+        return payload, headers, len(messages), compression
+
+    def _encoding_failed(self, fail):
+        # _post handles failed requests itself; this is something going wrong while building one, and retrying won't help
+        self._posts.inc(1, ("error",))
+        LOG.error("Couldn't encode message for the destination: %s" % fail.getErrorMessage())
+        return None
+
+    def _post(self, encoded):
+        payload, headers, message_count, compression = encoded
+        if compression is not None:
+            self._count_compression(*compression)
+        headers['User-Agent'] = ['ZMQ-HTTP-Bridge-Agent']
+        headers['Content-Type'] = [BridgeProtocol.content_type(self._wire_format)]
+        # POST it to the remote server
+        body_producer = ChunkedBodyProducer(payload, self._wire_format)
+        request = self._twisted_agent.request(
+            b'POST',
+            self._url,
+            Headers(headers),
+            bodyProducer=body_producer
+        )
+
+        def handle_twisted_error(fail):
+            self._posts.inc(1, ("error",))
+            # print out _all_ errors, since Twisted doesn't provide all exceptions
+            for error in getattr(fail.value, "reasons", [fail]):
+                LOG.error("%s", str(error))
+            # we can't tell whether it got there; worth retrying
+            return False
+
+        def handle_response(response):
+            if response.code != 200:
+                self._posts.inc(1, ("rejected",))
+                LOG.error("Destination rejected data (code: %d)" % response.code)
+                # the destination's own trouble may pass, but it won't ever take what it found wrong with the request
+                outcome = False if response.code >= 500 else None
+            else:
+                self._posts.inc(1, ("ok",))
+                self._posted_messages.inc(message_count)
+                self._posted_bytes.inc(body_producer.length)
+                outcome = True
+            self._negotiate(response.headers)
+            # the body has to be consumed for the connection to go back into the pool; it was delivered either way
+            return readBody(response).addBoth(lambda ignored: outcome)
+
+        def completed(outcome):
+            LOG.debug("Request completed.")
+            return outcome
+
+        request.addCallback(handle_response)
+        request.addCallback(completed)
+        request.addErrback(handle_twisted_error)
+        return request
+
+    def _abandon(self, correlation_ids):
+        for correlation_id in correlation_ids:
+            if correlation_id is not None:
+                self._awaiting_reply.pop(correlation_id, None)
+
+    def _count_compression(self, input_bytes: int, output_bytes: int):
+        self._compression_input_bytes += input_bytes
+        self._compression_output_bytes += output_bytes
+        if output_bytes < input_bytes:
+            self._compressed_bodies += 1
+        else:
+            self._incompressible_bodies += 1
+
+    def compression_stats(self) -> dict:
+        return {
+            "algorithm": self._codec.name if self._codec is not None else BridgeProtocol.COMPRESSION_NONE,
+            "compressed": self._compressed_bodies,
+            "incompressible": self._incompressible_bodies,
+            "input_bytes": self._compression_input_bytes,
+            "output_bytes": self._compression_output_bytes,
+            "ratio": self._compression_input_bytes / self._compression_output_bytes
+            if self._compression_output_bytes else 1.0,
+        }
+
+    def _negotiate(self, response_headers):
+        def advertised(name):
+            return BridgeProtocol.parse_list_header(response_headers.getRawHeaders(name, [None])[0])
+
+        if self._wire_format != self._wanted_wire_format \
+                and self._wanted_wire_format in advertised(BridgeProtocol.WIRE_FORMATS_HEADER):
+            self._wire_format = self._wanted_wire_format
+            LOG.info("Destination supports the %s wire format; switching to it" % self._wire_format)
+        if self._integrity.name != self._wanted_integrity.name \
+                and self._wanted_integrity.name in advertised(BridgeProtocol.INTEGRITY_HEADER):
+            self._integrity = self._wanted_integrity
+            LOG.info("Destination supports %s integrity checks; switching to it" % self._integrity.name)
+        if self._codec is None and self._wanted_codec is not None \
+                and self._wanted_codec.name in advertised(BridgeProtocol.ACCEPT_ENCODING_HEADER):
+            self._codec = self._wanted_codec
+            LOG.info("Destination supports %s compression; compressing bodies of %d bytes or more"
+                     % (self._codec.name, self._compression_threshold))
+        if not self._multipart and BridgeProtocol.FEATURE_MULTIPART in advertised(BridgeProtocol.FEATURES_HEADER):
+            self._multipart = True
+            LOG.info("Destination supports multipart messages; forwarding whole envelopes")
+        if not self._correlation and self._correlation_allowed \
+                and BridgeProtocol.FEATURE_CORRELATION in advertised(BridgeProtocol.FEATURES_HEADER):
+            self._correlation = True
+            LOG.info("Destination supports correlation ids; keeping routing envelopes until replies arrive")
+        if not self._dedupe and self._spool is not None \
+                and BridgeProtocol.FEATURE_DEDUPE in advertised(BridgeProtocol.FEATURES_HEADER):
+            self._dedupe = True
+            LOG.info("Destination drops duplicate messages; sending message ids")
+
+    def connection_stats(self) -> dict:
+        return connection_stats(self._twisted_agent, self._twisted_pool)
+
     def transfer_data_to_app(self, data):
-        LOG.info("Sending bytes to client...")
-        LOG.debug("data=%s", data.decode())
+        MESSAGE_LOG.info("Sending bytes to client...")
+        LOG.debug("data=%r", data)
+        if self._stream:
+            # there's no envelope on one-way messages
+            self._send_to_app([data])
         # if the app is hosting, then we need to send an empty delimiter frame followed by our data
-        if self._is_app_hosting:
-            self._zmq_socket.socket.send_multipart([b'', data])
+        elif self._is_app_hosting:
+            self._send_to_app([b'', data])
         else:
             # otherwise, we need to send the socket identity, empty frame, and then our data
-            self._zmq_socket.socket.send_multipart([self._zmq_socket_identity, b'', data])
+            if self._send_to_app([self._zmq_socket_identity, b'', data]) and self._track_round_trips:
+                self._round_trip_finished(self._zmq_socket_identity)
+
+    def transfer_frames_to_app(self, frames):
+        MESSAGE_LOG.info("Sending %d frames to client...", len(frames))
+        LOG.debug("frames=%r", frames)
+        # the frames carry their own routing envelope: a ROUTER routes on the leading identity frame, and a DEALER
+        # passes the envelope on to the app, which hands it back to us along with its reply. one-way messages have none
+        if self._send_to_app(frames) and self._track_round_trips:
+            self._round_trip_finished(frames[0])
+
+    def transfer_correlated_to_app(self, correlation_id: str, frames):
+        MESSAGE_LOG.info("Sending %d frames to client (correlation id: %s)...", len(frames), correlation_id)
+        LOG.debug("frames=%r", frames)
+        if self._stream:
+            # the sender didn't know this was a stream; there's no reply to wait for
+            self._send_to_app(frames)
+            return
+        if self._is_app_hosting:
+            # a request; the id stands in for the envelope, so the application hands it back with its reply
+            if correlation_id not in self._awaiting_app and len(self._awaiting_app) >= CORRELATION_MAX_PENDING:
+                del self._awaiting_app[next(iter(self._awaiting_app))]
+                self._correlations_expired.inc()
+            self._awaiting_app[correlation_id] = self._awaiting_app.get(correlation_id, 0) + 1
+            if not self._send_to_app([correlation_id.encode(), b''] + list(frames)):
+                self._answered(correlation_id.encode())
+            return
+
+        # a reply; it goes back to whoever sent the request with this id
+        pending = self._awaiting_reply.pop(correlation_id, None)
+        if pending is None:
+            self._zmq_dropped.inc(1, ("uncorrelated",))
+            LOG.warning("Dropped reply with unknown correlation id %s" % correlation_id)
+            return
+        envelope, received = pending
+        if self._send_to_app(envelope + list(frames)):
+            self._round_trip_latency.observe(time.monotonic() - received)
+
+    def _send_to_app(self, frames) -> bool:
+        if self._socket_type in BridgeProtocol.STREAM_SOURCES:
+            # we only read from the application on this socket; what the destination sends us has nowhere to go
+            self._zmq_dropped.inc(1, ("one-way",))
+            LOG.warning("Dropped message for a %s socket, which only receives" % self._socket_type)
+            return False
+        # go through txZMQ rather than the raw socket: ZeroMQ's descriptor is edge-triggered and may not signal
+        # incoming messages again after a write, so txZMQ schedules a read after every send
+        try:
+            self._zmq_socket.send(frames)
+        except zmq.ZMQError as e:
+            if e.errno == zmq.EHOSTUNREACH:
+                self._zmq_dropped.inc(1, ("unreachable",))
+                LOG.warning("Dropped message for disconnected peer %r" % frames[0])
+            elif e.errno == zmq.EAGAIN:
+                self._zmq_dropped.inc(1, ("full",))
+                LOG.warning("Dropped message; the application isn't keeping up")
+            else:
+                raise
+            return False
+
+        self._zmq_sent.inc()
+        self._zmq_sent_bytes.inc(sum(len(frame) for frame in frames))
+        return True
+
+
+# txZMQ connection which can stop pulling messages off its socket; ZeroMQ then buffers them up to the high-water mark
+# and pushes back on the application
+class FlowControlMixin:
+    reading_paused = False
+
+    def __init__(self, factory, endpoint=None, identity=None, high_water_mark: int = 0):
+        # txZMQ applies the high-water mark while setting up the socket, before the endpoint is bound/connected
+        self.highWaterMark = high_water_mark
+        super().__init__(factory, endpoint, identity)
+
+    def pauseReading(self):
+        self.reading_paused = True
 
+    def resumeReading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            # the descriptor is edge-triggered, so messages that queued up meanwhile won't be signalled again
+            reactor.callLater(0, self.doRead)
 
+    def doRead(self):
+        # same as ZmqConnection.doRead, except that it stops as soon as reading gets paused
+        if self.read_scheduled is not None:
+            if not self.read_scheduled.called:
+                self.read_scheduled.cancel()
+            self.read_scheduled = None
+
+        while not self.reading_paused:
+            if self.factory is None:  # disconnected
+                return
+
+            events = self.socket.get(zmq.EVENTS)
+            if (events & zmq.POLLIN) != zmq.POLLIN:
+                return
+
+            try:
+                message = self._readMultipart()
+            except zmq.ZMQError as e:
+                if e.errno == zmq.EAGAIN:
+                    continue
+                raise e
+
+            log.callWithLogger(self, self.messageReceived, message)
+
+
+class FlowControlledRouterConnection(FlowControlMixin, ZmqRouterConnection):
+    pass
+
+
+class FlowControlledDealerConnection(FlowControlMixin, ZmqDealerConnection):
+    pass
+
+
+# txZMQ's own PUB/SUB and PUSH/PULL connections frame messages their own way; these pass every frame through untouched,
+# like its ROUTER/DEALER connections
+class StreamConnection(FlowControlMixin, ZmqConnection):
+    def messageReceived(self, message):
+        self.gotMessage(*message)
+
+
+class SubConnection(StreamConnection):
+    socketType = zmq.SUB
+
+
+class PullConnection(StreamConnection):
+    socketType = zmq.PULL
+
+
+class PubConnection(StreamConnection):
+    socketType = zmq.PUB
+
+
+class PushConnection(StreamConnection):
+    socketType = zmq.PUSH
+
+
+STREAM_CONNECTIONS = {
+    BridgeProtocol.SOCKET_SUB: SubConnection,
+    BridgeProtocol.SOCKET_PULL: PullConnection,
+    BridgeProtocol.SOCKET_PUB: PubConnection,
+    BridgeProtocol.SOCKET_PUSH: PushConnection,
+}
+
+
+# gathers messages and hands them to the flush callback as one list, either once the time window since the first
+# pending message expires or as soon as the byte/count limit is reached
+class MessageBatcher:
+    def __init__(self, flush, window: float, max_bytes: int, max_count: int):
+        self._flush = flush
+        self._window = window
+        self._max_bytes = max_bytes
+        self._max_count = max_count
+        self._pending = []
+        self._pending_bytes = 0
+        self._timer = None
+
+    def add(self, message, received: float):
+        # messages are (frames, correlation id, message id)
+        self._pending.append((message, received))
+        self._pending_bytes += sum(len(frame) for frame in message[0])
+        if len(self._pending) >= self._max_count or self._pending_bytes >= self._max_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = reactor.callLater(self._window, self.flush)
+
+    def flush(self):
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+
+        if not self._pending:
+            return
+        batch = self._pending
+        self._pending = []
+        self._pending_bytes = 0
+        self._flush(batch)
+
+
+# streams a payload to the destination in chunks, encoding each one on the way out instead of building the whole
+# encoded body up front; pausing and resuming follow the transport's flow control
 @implementer(IBodyProducer)
-class StringProducer:
-    def __init__(self, body):
-        self.body = body
-        self.length = len(body)
+class ChunkedBodyProducer:
+    def __init__(self, payload, wire_format: str, chunk_size: int = BODY_CHUNK_SIZE):
+        self._payload = payload
+        self._base64 = wire_format != BridgeProtocol.WIRE_FORMAT_BINARY
+        if self._base64:
+            # keep chunks on 3-byte boundaries so they encode without padding in between
+            chunk_size -= chunk_size % 3
+            self.length = 4 * ((len(payload) + 2) // 3)
+        else:
+            self.length = len(payload)
+        self._chunk_size = chunk_size
+        self._task = None
+        self._paused = False
 
     def startProducing(self, consumer):
-        consumer.write(self.body)
-        return succeed(None)
+        self._task = cooperate(self._produce(consumer))
+        return self._task.whenDone().addCallback(lambda ignored: None)
+
+    def _produce(self, consumer):
+        view = memoryview(self._payload)
+        for offset in range(0, len(view), self._chunk_size):
+            chunk = view[offset:offset + self._chunk_size]
+            consumer.write(base64.b64encode(chunk) if self._base64 else bytes(chunk))
+            yield None
 
     def pauseProducing(self):
-        pass
+        if not self._paused:
+            self._paused = True
+            self._task.pause()
+
+    def resumeProducing(self):
+        if self._paused:
+            self._paused = False
+            self._task.resume()
 
     def stopProducing(self):
-        pass
+        try:
+            self._task.stop()
+        except (TaskDone, TaskStopped):
+            pass
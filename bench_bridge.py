@@ -0,0 +1,294 @@
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import zmq
+
+# the bridges are started from the checkout this script lives in
+BRIDGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# seconds the bridges get to carry a first request end to end
+STARTUP_TIMEOUT = 30
+# seconds to wait for replies still outstanding once a run's time is up; anything later counts as lost
+DRAIN_TIMEOUT = 10
+# every payload starts with a unique counter, so each one (and its digest) can be told apart
+COUNTER_LENGTH = 16
+PERCENTILES = (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))
+# stands in for the JSON most of our applications send, for measuring compression
+COMPRESSIBLE_RECORD = b'{"symbol": "%04d", "side": "buy", "price": 101.25, "quantity": 300, "venue": "XNAS"}, '
+
+
+def parse_int_list(value: str) -> list:
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def free_ports(count: int) -> list:
+    # hold every socket open until all ports are picked, so the same port isn't handed out twice
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def ensure_certificate(workdir: str):
+    # the bridges load bridge-ssl.key/bridge-ssl.pem from their working directory; make a throwaway pair if needed
+    key_path = os.path.join(workdir, "bridge-ssl.key")
+    cert_path = os.path.join(workdir, "bridge-ssl.pem")
+    if os.path.exists(key_path) and os.path.exists(cert_path):
+        return
+
+    from OpenSSL import crypto
+
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = "localhost"
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, "sha256")
+    with open(key_path, "wb") as key_file:
+        key_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    with open(cert_path, "wb") as cert_file:
+        cert_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+
+
+def run_echo_server(address: str):
+    # replies with the SHA-256 digest of each request, like debug-zmq-rep.py, but as a ROUTER so pipelined requests
+    # are answered without waiting on each other; whatever envelope the request came with is sent back untouched
+    context = zmq.Context()
+    router = context.socket(zmq.ROUTER)
+    router.bind(address)
+    while True:
+        frames = router.recv_multipart()
+        router.send_multipart(frames[:-1] + [hashlib.sha256(frames[-1]).hexdigest().encode()])
+
+
+def start_bridge(workdir: str, name: str, arguments: list) -> subprocess.Popen:
+    output = open(os.path.join(workdir, "%s.out" % name), "wb")
+    return subprocess.Popen([sys.executable, os.path.join(BRIDGE_DIR, "BridgeApplication.py")] + arguments,
+                            cwd=workdir, stdout=output, stderr=subprocess.STDOUT)
+
+
+def wait_until_bridged(address: str, processes: list):
+    context = zmq.Context.instance()
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        for process in processes:
+            if process.poll() is not None:
+                raise RuntimeError("A bridge exited during startup (code: %d)" % process.returncode)
+
+        sock = context.socket(zmq.REQ)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.RCVTIMEO, 1000)
+        sock.connect(address)
+        try:
+            sock.send(b"warmup")
+            sock.recv()
+            return
+        except zmq.Again:
+            pass
+        finally:
+            sock.close()
+    raise RuntimeError("Bridges didn't carry a request within %d seconds" % STARTUP_TIMEOUT)
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    # nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def make_filler(size: int, compressible: bool) -> bytes:
+    if not compressible:
+        return os.urandom(size)
+    records = []
+    length = 0
+    while length < size:
+        records.append(COMPRESSIBLE_RECORD % (len(records) % 10000))
+        length += len(records[-1])
+    return b''.join(records)[:size]
+
+
+def run_load(address: str, size: int, clients: int, pipeline: int, duration: float, compressible: bool) -> dict:
+    # one thread drives every client socket, so the load generator doesn't compete with itself for the GIL. REQ
+    # sockets are used without pipelining, DEALER sockets keep `pipeline` requests outstanding each
+    context = zmq.Context()
+    poller = zmq.Poller()
+    use_req = pipeline == 1
+    pending = {}
+    for _ in range(clients):
+        sock = context.socket(zmq.REQ if use_req else zmq.DEALER)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(address)
+        poller.register(sock, zmq.POLLIN)
+        # digest of each outstanding request -> when it was sent; replies are matched on it, so they may arrive in
+        # any order
+        pending[sock] = {}
+
+    filler = make_filler(size, compressible)
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+
+    def send(sock):
+        payload = (b"%016x" % next(counter) + filler)[:size]
+        pending[sock][hashlib.sha256(payload).hexdigest().encode()] = time.perf_counter()
+        if use_req:
+            sock.send(payload)
+        else:
+            sock.send_multipart([b'', payload])
+
+    start = time.perf_counter()
+    deadline = start + duration
+    finished = start
+    for sock in pending:
+        for _ in range(pipeline):
+            send(sock)
+
+    while any(pending.values()):
+        events = poller.poll(100)
+        now = time.perf_counter()
+        if not events and now > deadline + DRAIN_TIMEOUT:
+            break
+        for sock, event in events:
+            reply = sock.recv() if use_req else sock.recv_multipart()[-1]
+            now = time.perf_counter()
+            sent = pending[sock].pop(reply, None)
+            if sent is None:
+                errors += 1
+            else:
+                latencies.append(now - sent)
+                finished = now
+            if now < deadline:
+                send(sock)
+
+    lost = sum(len(outstanding) for outstanding in pending.values())
+    context.destroy(linger=0)
+
+    elapsed = max(finished - start, 1e-9)
+    latencies.sort()
+    result = {
+        "size": size,
+        "clients": clients,
+        "pipeline": pipeline,
+        "requests": len(latencies),
+        "errors": errors,
+        "lost": lost,
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "megabytes_per_second": len(latencies) * size / elapsed / 1e6,
+    }
+    for name, fraction in PERCENTILES:
+        result[name + "_ms"] = percentile(latencies, fraction) * 1000
+    result["max_ms"] = (latencies[-1] if latencies else 0.0) * 1000
+    return result
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--sizes", dest="sizes", default="16,1024,65536",
+                      help="Comma-separated message sizes in bytes (at least %d)." % COUNTER_LENGTH)
+    parser.add_option("--clients", dest="clients", default="1,16,64",
+                      help="Comma-separated numbers of concurrent clients.")
+    parser.add_option("--pipeline", dest="pipeline", default="1,8",
+                      help="Comma-separated requests outstanding per client; 1 uses REQ clients, anything higher "
+                           "uses DEALER clients.")
+    parser.add_option("--duration", dest="duration", type="float", default=5.0,
+                      help="Seconds to send requests for at each point of the sweep.")
+    parser.add_option("--compressible", dest="compressible", action="store_true", default=False,
+                      help="Send JSON-like text instead of random bytes, e.g. to measure --compression.")
+    parser.add_option("--bridge-options", dest="bridge_options", default="",
+                      help="Extra BridgeApplication.py options, passed to both bridges (e.g. \"--wire-format binary "
+                           "--http2\").")
+    parser.add_option("--compare", dest="compare", action="append", default=None,
+                      help="Run the sweep again with these bridge options added, e.g. \"--raw-ingress "
+                           "--raw-egress\" to measure the raw framing against HTTP. May be given several times.")
+    parser.add_option("--message-logs", dest="message_logs", action="store_true", default=False,
+                      help="Leave per-message logging on in the bridges.")
+    parser.add_option("--workdir", dest="workdir", default=None,
+                      help="Directory the bridges run in, holding their certificate and log. A temporary one is "
+                           "used by default.")
+    parser.add_option("--json", dest="json", action="store_true", default=False,
+                      help="Print one JSON object per result instead of a table.")
+    (options, args) = parser.parse_args()
+
+    sizes = parse_int_list(options.sizes)
+    if min(sizes) < COUNTER_LENGTH:
+        parser.error("Message sizes must be at least %d bytes" % COUNTER_LENGTH)
+    workdir = options.workdir or tempfile.mkdtemp(prefix="zmq-https-bridge-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    ensure_certificate(workdir)
+
+    # the bridges are started afresh for each set of options being compared
+    variants = [options.bridge_options] + [" ".join([options.bridge_options, compare]).strip()
+                                           for compare in options.compare or ()]
+    if not options.json:
+        print("%9s %7s %8s %9s %7s %10s %9s %9s %9s %9s" % ("size", "clients", "pipeline", "requests", "errors",
+                                                            "req/s", "MB/s", "p50 ms", "p99 ms", "p999 ms"))
+    try:
+        for variant in variants:
+            if len(variants) > 1 and not options.json:
+                print("bridge options: %s" % (variant or "(none)"), flush=True)
+            run_sweep(workdir, variant, options, sizes)
+    finally:
+        print("Bridge logs are in %s" % workdir, file=sys.stderr)
+
+
+def run_sweep(workdir: str, variant: str, options, sizes: list):
+    app_port, zmq_port, near_port, far_port = free_ports(4)
+    bridge_options = shlex.split(variant)
+    if not options.message_logs:
+        bridge_options.append("--no-message-logs")
+
+    echo = multiprocessing.Process(target=run_echo_server, args=("tcp://127.0.0.1:%d" % app_port,), daemon=True)
+    echo.start()
+    processes = [
+        # the far bridge connects to the echo server, the near one takes the load generator's connections
+        start_bridge(workdir, "far", ["-z", "127.0.0.1:%d" % app_port, "-H", "127.0.0.1:%d" % far_port,
+                                      "-d", "https://127.0.0.1:%d" % near_port, "-c", "true"] + bridge_options),
+        start_bridge(workdir, "near", ["-z", "127.0.0.1:%d" % zmq_port, "-H", "127.0.0.1:%d" % near_port,
+                                       "-d", "https://127.0.0.1:%d" % far_port] + bridge_options),
+    ]
+    address = "tcp://127.0.0.1:%d" % zmq_port
+
+    try:
+        wait_until_bridged(address, processes)
+        for size in sizes:
+            for clients in parse_int_list(options.clients):
+                for pipeline in parse_int_list(options.pipeline):
+                    result = run_load(address, size, clients, pipeline, options.duration, options.compressible)
+                    if options.json:
+                        print(json.dumps(dict(result, bridge_options=variant)), flush=True)
+                    else:
+                        print("%9d %7d %8d %9d %7d %10.1f %9.2f %9.2f %9.2f %9.2f"
+                              % (size, clients, pipeline, result["requests"], result["errors"] + result["lost"],
+                                 result["requests_per_second"], result["megabytes_per_second"], result["p50_ms"],
+                                 result["p99_ms"], result["p999_ms"]), flush=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        echo.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import json
+import os
+import time
+from optparse import OptionParser
+
+import BridgeProtocol
+
+# (wire format, integrity check) combinations to compare; the first one is the original format
+MODES = [
+    (BridgeProtocol.WIRE_FORMAT_BASE64, "sha256"),
+    (BridgeProtocol.WIRE_FORMAT_BINARY, "sha256"),
+    (BridgeProtocol.WIRE_FORMAT_BINARY, "blake2b"),
+    (BridgeProtocol.WIRE_FORMAT_BINARY, "crc32"),
+    (BridgeProtocol.WIRE_FORMAT_BINARY, "none"),
+]
+SIZES = [16, 1024, 64 * 1024, 1024 * 1024]
+
+
+def header_bytes(wire_format: str, integrity: BridgeProtocol.Integrity, digest: str) -> int:
+    # only the headers that differ between modes are counted
+    headers = {"Content-Type": BridgeProtocol.content_type(wire_format), BridgeProtocol.HASH_HEADER: digest}
+    if integrity.name != BridgeProtocol.DEFAULT_INTEGRITY:
+        headers[BridgeProtocol.ALGORITHM_HEADER] = integrity.name
+    return sum(len("%s: %s\r\n" % (name, value)) for name, value in headers.items())
+
+
+def run_mode(wire_format: str, integrity_name: str, payload: bytes, iterations: int) -> dict:
+    integrity = BridgeProtocol.make_integrity(integrity_name, b'benchmark-key')
+
+    # sending side: digest + encode
+    start = time.process_time()
+    for _ in range(iterations):
+        digest = integrity.hexdigest(payload)
+        body = BridgeProtocol.encode_body(payload, wire_format)
+    send_cpu = (time.process_time() - start) / iterations
+
+    # receiving side: decode + verify
+    start = time.process_time()
+    for _ in range(iterations):
+        data = BridgeProtocol.decode_body(body, wire_format)
+        if integrity.hexdigest(data) != digest:
+            raise ValueError("Integrity check failed for %s/%s" % (wire_format, integrity_name))
+    receive_cpu = (time.process_time() - start) / iterations
+
+    return {
+        "wire_format": wire_format,
+        "integrity": integrity_name,
+        "size": len(payload),
+        "wire_bytes": len(body) + header_bytes(wire_format, integrity, digest),
+        "send_us": send_cpu * 1e6,
+        "receive_us": receive_cpu * 1e6,
+    }
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--iterations", dest="iterations", type="int", default=0,
+                      help="Iterations per size; by default scaled so each run processes ~64MB.")
+    parser.add_option("--json", dest="json", action="store_true", default=False,
+                      help="Print one JSON object per result instead of a table.")
+    (options, args) = parser.parse_args()
+
+    if not options.json:
+        print("%-8s %-8s %9s %11s %9s %11s %11s" % ("format", "check", "size", "wire bytes", "overhead",
+                                                    "send us", "receive us"))
+    for size in SIZES:
+        payload = os.urandom(size)
+        iterations = options.iterations or max(10, (64 * 1024 * 1024) // size // 8)
+        for wire_format, integrity_name in MODES:
+            result = run_mode(wire_format, integrity_name, payload, iterations)
+            if options.json:
+                print(json.dumps(result))
+            else:
+                print("%-8s %-8s %9d %11d %8.1f%% %11.2f %11.2f"
+                      % (result["wire_format"], result["integrity"], result["size"], result["wire_bytes"],
+                         100.0 * (result["wire_bytes"] - size) / size, result["send_us"], result["receive_us"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+import os
+import shutil
+import socket
+import tempfile
+
+import zmq
+from OpenSSL import crypto
+from twisted.internet import defer, reactor, task
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET, Site
+from txzmq import ZmqFactory
+
+import BridgeMetrics
+import BridgeTLS
+import TwistedHttpBridge
+import ZMQBridge
+
+
+# seconds a test waits for something to come through before giving up
+WAIT_TIMEOUT = 10.0
+WAIT_INTERVAL = 0.01
+
+
+def make_certificate(directory, common_name: str = "localhost") -> tuple:
+    # a throwaway self-signed pair, like the one bench_bridge.py makes; returns (certificate path, key path)
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    cert = crypto.X509()
+    cert.get_subject().CN = common_name
+    cert.set_serial_number(int.from_bytes(os.urandom(8), "big"))
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(24 * 60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.sign(key, "sha256")
+    cert_path = os.path.join(str(directory), "%s.pem" % common_name)
+    key_path = os.path.join(str(directory), "%s.key" % common_name)
+    with open(key_path, "wb") as key_file:
+        key_file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+    with open(cert_path, "wb") as cert_file:
+        cert_file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+    return cert_path, key_path
+
+
+def free_port() -> int:
+    # a port nobody listens on right now; ZMQ endpoints and destinations have to be known before anything binds them
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+# stands in for the ZMQ side of a receiving bridge, and keeps whatever it's handed in the order it came
+class RecordingBridge:
+    def __init__(self):
+        self.metrics = BridgeMetrics.Metrics()
+        # ("data", bytes), ("frames", [bytes]) or ("correlated", correlation id, [bytes])
+        self.received = []
+
+    def transfer_data_to_app(self, data):
+        self.received.append(("data", data))
+
+    def transfer_frames_to_app(self, frames):
+        self.received.append(("frames", list(frames)))
+
+    def transfer_correlated_to_app(self, correlation_id: str, frames):
+        self.received.append(("correlated", correlation_id, list(frames)))
+
+
+def temporary_directory(testcase) -> str:
+    # trial's mktemp() would put it under the working directory, i.e. the repository when run by pytest
+    path = tempfile.mkdtemp(prefix="bridge-test-")
+    testcase.addCleanup(shutil.rmtree, path, True)
+    return path
+
+
+def listen(testcase, zmq_bridge, **options) -> defer.Deferred:
+    # starts an HTTPS bridge on a free loopback port and fires with (bridge, port number); it stops listening once the
+    # test is done. options are TwistedHttpBridge.Bridge's
+    if "tls_options" not in options:
+        options["tls_options"] = BridgeTLS.server_options(*make_certificate(temporary_directory(testcase)))
+    if zmq_bridge is None and "metrics" not in options:
+        options["metrics"] = BridgeMetrics.Metrics()
+    bridge = TwistedHttpBridge.Bridge(zmq_bridge, "127.0.0.1", options.pop("port", 0), **options)
+
+    def listening(port):
+        testcase.addCleanup(port.stopListening)
+        return bridge, port.getHost().port
+
+    return bridge.listening.addCallback(listening)
+
+
+def listen_tls(testcase, factory, options=None) -> int:
+    # serves factory over TLS on a free loopback port until the test is done, and returns the port number
+    if options is None:
+        options = BridgeTLS.server_options(*make_certificate(temporary_directory(testcase)))
+    port = reactor.listenSSL(0, factory, options, interface="127.0.0.1")
+    testcase.addCleanup(port.stopListening)
+    return port.getHost().port
+
+
+# a destination which holds on to every request until the test lets it through
+class HoldingResource(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.held = []
+        self.received = 0
+        # the client ports requests came from, i.e. the connections they took
+        self.connections = set()
+
+    def render(self, request):
+        self.received += 1
+        self.connections.add(request.getClientAddress().port)
+        self.held.append(request)
+        return NOT_DONE_YET
+
+    def release(self, count: int = None):
+        count = len(self.held) if count is None else count
+        requests, self.held = self.held[:count], self.held[count:]
+        for request in requests:
+            request.write(b'OK')
+            request.finish()
+
+
+def listen_holding(testcase) -> tuple:
+    # returns the holding resource and its address, as a bridge's destination
+    resource = HoldingResource()
+    return resource, "https://127.0.0.1:%d" % listen_tls(testcase, Site(resource))
+
+
+def start_zmq_bridge(testcase, zmq_port: int, destination: str, is_app_hosting: bool, **options) -> ZMQBridge.Bridge:
+    # a ZMQ bridge on the loopback interface with its own ZeroMQ context; its socket and outbound connections are closed
+    # once the test is done. options are ZMQBridge.Bridge's
+    factory = options.pop("zmq_factory", None) or ZmqFactory()
+    testcase.addCleanup(factory.shutdown)
+    bridge = ZMQBridge.Bridge("127.0.0.1", zmq_port, destination, is_app_hosting, zmq_factory=factory, **options)
+    testcase.addCleanup(close_connections, bridge._twisted_agent, bridge._twisted_pool)
+    return bridge
+
+
+@defer.inlineCallbacks
+def start_pair(testcase, http_options=None, **options):
+    # two bridges back to back, the way two BridgeApplication processes would run: the application's clients connect to
+    # the near one, and the far one connects to the application's server. fires with (near ZMQ bridge, far ZMQ bridge,
+    # endpoint for the clients to connect to, endpoint for the server to bind)
+    # each ZMQ bridge probes the other's HTTPS listener as it starts, so one of them has to try again
+    testcase.patch(ZMQBridge, "PROBE_RETRY_INTERVAL", 0.05)
+    near_http_port, far_http_port, client_port, server_port = free_port(), free_port(), free_port(), free_port()
+    near = start_zmq_bridge(testcase, client_port, "https://127.0.0.1:%d" % far_http_port, False, **options)
+    far = start_zmq_bridge(testcase, server_port, "https://127.0.0.1:%d" % near_http_port, True, **options)
+    yield listen(testcase, near, port=near_http_port, **dict(http_options or {}))
+    yield listen(testcase, far, port=far_http_port, **dict(http_options or {}))
+    return near, far, "tcp://127.0.0.1:%d" % client_port, "tcp://127.0.0.1:%d" % server_port
+
+
+def scrape(metrics: BridgeMetrics.Metrics) -> dict:
+    # the rendered metrics as {"name{labels}": value}, the way Prometheus reads them
+    samples = {}
+    for line in metrics.render().decode().splitlines():
+        if line and not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+    return samples
+
+
+def close_connections(agent, pool=None) -> defer.Deferred:
+    # drops whatever connections an agent (and its pool) keeps open, and gives both ends a moment to notice
+    if pool is not None:
+        pool.closeCachedConnections()
+    for connection in list(getattr(agent, "_connections", {}).values()):
+        connection.transport.loseConnection()
+    return settle()
+
+
+def settle(delay: float = 0.1) -> defer.Deferred:
+    return task.deferLater(reactor, delay, lambda: None)
+
+
+@defer.inlineCallbacks
+def wait_for(condition, timeout: float = WAIT_TIMEOUT):
+    # polls until condition() returns something true, and fires with it
+    waited = 0.0
+    while True:
+        result = condition()
+        if result:
+            return result
+        if waited >= timeout:
+            raise AssertionError("Gave up waiting after %.1f seconds" % timeout)
+        yield task.deferLater(reactor, WAIT_INTERVAL, lambda: None)
+        waited += WAIT_INTERVAL
+
+
+# the application's end of a bridge: a plain pyzmq socket, read without blocking the reactor
+class Application:
+    def __init__(self, testcase, socket_type: int, endpoint: str, bind: bool = False, **options):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(socket_type)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        for option, value in options.items():
+            self.socket.setsockopt(getattr(zmq, option), value)
+        if bind:
+            self.socket.bind(endpoint)
+        else:
+            self.socket.connect(endpoint)
+        testcase.addCleanup(self.close)
+
+    def send(self, frames):
+        self.socket.send_multipart(frames)
+
+    def try_receive(self):
+        # the next message if one has arrived, or None
+        try:
+            return self.socket.recv_multipart(zmq.NOBLOCK)
+        except zmq.Again:
+            return None
+
+    def receive(self, timeout: float = WAIT_TIMEOUT) -> defer.Deferred:
+        return wait_for(self.try_receive, timeout)
+
+    def close(self):
+        self.socket.close()
+        self.context.term()
@@ -18,7 +18,7 @@ def main():
 
         msg = socket.recv()
         hash = hashlib.sha256(msg).hexdigest()
-        print("[!] Received new message: \"%s\"" % msg.decode())
+        print("[!] Received new message: %r" % msg)
 
         socket.send(hash.encode())
         print("[.] Sent message: \"%s\"" % hash)
@@ -1,7 +1,7 @@
 import hashlib
 import random
 import sys
-from datetime import datetime as time
+import time
 
 import zmq
 
@@ -17,7 +17,7 @@ def main():
     socket = context.socket(zmq.REQ)
     socket.connect(sys.argv[1])
 
-    start = time.now()
+    start = time.perf_counter()
 
     for req in range(1000):
         # generate random character sequence for testing
@@ -37,10 +37,8 @@ def main():
         else:
             raise ValueError("Hash test FAILED. (got %s, expected %s)" % (server_hash, hash))
 
-    end = time.now()
-    delta = end - start
-    print("[*] 1000 requests processed in %d seconds (%f requests per second)"
-          % (delta.seconds, 1000 / delta.seconds))
+    delta = time.perf_counter() - start
+    print("[*] 1000 requests processed in %.3f seconds (%f requests per second)" % (delta, 1000 / delta))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+import pytest
+import zmq
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web.client import Agent, readBody
+
+import BridgeApplication
+import BridgeConfig
+import BridgeTLS
+from bridge_test_support import Application, RecordingBridge, free_port, listen, start_zmq_bridge, wait_for
+
+TOML = """
+http-bind-addr = "0.0.0.0:8443"
+compression = "zstd"
+batch_window = 0.5
+
+[routes.orders]
+zmq = "127.0.0.1:5555"
+destination = "https://bridge.example.com:8443"
+
+[routes.prices]
+zmq = "127.0.0.1:5556"
+socket = "dealer"
+destination = "https://bridge.example.com:8443"
+destination-route = "quotes"
+batch-window = 2
+topic = "ignored"
+
+[routes.ticks]
+zmq = "0.0.0.0:5557"
+socket = "pub"
+"""
+
+YAML = """
+http_bind_addr: 0.0.0.0:8443
+spool-dir: /var/spool/bridge
+routes:
+  orders:
+    zmq: 127.0.0.1:5555
+    destination: https://bridge.example.com:8443
+    at-least-once: true
+  ticks:
+    zmq: 127.0.0.1:5557
+    socket: sub
+    topic: [prices, trades]
+    destination: https://bridge.example.com:8443
+"""
+
+
+def load_routes(path, *args) -> tuple:
+    parser = BridgeApplication.make_parser()
+    options, _ = parser.parse_args(list(args))
+    return BridgeConfig.load_routes(str(path), parser, options)
+
+
+def write(tmp_path, text: str, name: str = "bridge.toml"):
+    path = tmp_path / name
+    path.write_text(text)
+    return path
+
+
+def test_split_addr_port():
+    assert BridgeConfig.split_addr_port("127.0.0.1:5555") == ("127.0.0.1", 5555)
+    assert BridgeConfig.split_addr_port(" 0.0.0.0 : 8443") == ("0.0.0.0", 8443)
+
+
+def test_toml_routes(tmp_path):
+    # a top level setting applies to every route, unless the route sets its own
+    options, routes = load_routes(write(tmp_path, TOML.replace('topic = "ignored"\n', "")), "--max-queue", "10")
+    assert (options.http_bind_address, options.compression, options.batch_window, options.max_queue) \
+        == ("0.0.0.0:8443", "zstd", 0.5, 10)
+    orders, prices, ticks = routes
+    assert (orders.name, orders.zmq_address, orders.socket_type, orders.connect, orders.destination,
+            orders.destination_route) \
+        == ("orders", "127.0.0.1:5555", "router", False, "https://bridge.example.com:8443", "orders")
+    assert (orders.options.batch_window, orders.options.compression, orders.options.max_queue) == (0.5, "zstd", 10)
+    assert (prices.socket_type, prices.connect, prices.destination_route, prices.options.batch_window) \
+        == ("dealer", True, "quotes", 2.0)
+    # a pub route only hands messages to the application, which connects to it
+    assert (ticks.socket_type, ticks.connect, ticks.destination) == ("pub", False, None)
+
+
+def test_yaml_routes(tmp_path):
+    options, (orders, ticks) = load_routes(write(tmp_path, YAML, "bridge.yaml"))
+    assert options.http_bind_address == "0.0.0.0:8443"
+    # each route spools on its own
+    assert (orders.options.spool_dir, orders.options.at_least_once) == ("/var/spool/bridge/orders", True)
+    assert ticks.options.spool_dir == "/var/spool/bridge/ticks"
+    assert (ticks.socket_type, ticks.connect, ticks.options.topics) == ("sub", True, ["prices", "trades"])
+    assert not ticks.options.at_least_once
+
+
+def test_the_config_file_wins_over_the_command_line(tmp_path):
+    options, (orders, *_) = load_routes(write(tmp_path, TOML.replace('topic = "ignored"\n', "")),
+                                        "--http-bind-addr", "127.0.0.1:9443", "--compression", "lz4", "--http2")
+    assert (options.http_bind_address, orders.options.compression, options.http2) == ("0.0.0.0:8443", "zstd", True)
+
+
+@pytest.mark.parametrize("name, text, error", [
+    ("bridge.ini", "", "config files must end in"),
+    ("bridge.toml", "routes = [", "Couldn't read"),
+    ("bridge.yaml", "- a list\n", "doesn't hold a table"),
+    ("bridge.toml", 'http-bind-addr = "0.0.0.0:8443"\n', "doesn't define any routes"),
+    ("bridge.toml", '[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\n', "doesn't give an http-bind-addr"),
+])
+def test_files_which_cant_be_used(tmp_path, name, text, error):
+    with pytest.raises(BridgeConfig.ConfigError, match=error):
+        load_routes(write(tmp_path, text, name))
+
+
+def test_missing_files(tmp_path):
+    with pytest.raises(BridgeConfig.ConfigError, match="Couldn't read"):
+        load_routes(tmp_path / "missing.toml")
+
+
+@pytest.mark.parametrize("settings, error", [
+    ('[routes."a/b"]\nzmq = "127.0.0.1:1"\ndestination = "https://b"', "route names may only hold"),
+    ('[routes]\na = 1', "a route must be a table"),
+    ('[routes.a]\ndestination = "https://b"', "zmq must be the ZMQ address"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\nsocket = "pair"\ndestination = "https://b"', "socket must be one of"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\nconnect = true\ndestination = "https://b"', "decides whether it connects"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\nsocket = "sub"\nconnect = "yes"\ndestination = "https://b"',
+     "connect must be true or false"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ntopic = "x"\ndestination = "https://b"', "topic only works with"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\nsocket = "push"\ndestination = "https://b"', "doesn't send anything"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "tcp://b"', "destination must be an HTTP"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\ndestination-route = "a b"',
+     "destination-route may only hold"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\nat-least-once = true', "needs spool-dir"),
+    # process wide settings can't be set per route, and unknown ones not at all
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\nhttp2 = true', "can't be set here"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\nbatch-size = 1', "unknown setting batch-size"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\nbatch-window = "soon"', "invalid floating-point"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\nbatch-window = [1]', "must be a single value"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\ndestination = "https://b"\nat-least-once = 1', "must be true or false"),
+    ('[routes.a]\nzmq = "127.0.0.1:1"\nsocket = "sub"\ntopic = [{}]', "must be a list of values"),
+])
+def test_routes_which_cant_be_used(tmp_path, settings, error):
+    with pytest.raises(BridgeConfig.ConfigError, match=error):
+        load_routes(write(tmp_path, 'http-bind-addr = "0.0.0.0:8443"\n' + settings + "\n"))
+
+
+class RoutesTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_routes_share_one_listener(self):
+        bridge, port = yield listen(self, None)
+        recorders = {name: RecordingBridge() for name in ("orders", "quotes")}
+        for name, recorder in recorders.items():
+            bridge.add_route(name, recorder)
+
+        # each sender posts to its own route on the destination, whatever the route is called at its end
+        for route, destination_route in (("orders", "orders"), ("prices", "quotes")):
+            zmq_port = free_port()
+            start_zmq_bridge(self, zmq_port, "https://127.0.0.1:%d" % port, False,
+                             destination_route=destination_route)
+            Application(self, zmq.DEALER, "tcp://127.0.0.1:%d" % zmq_port).send([b'', b'for %s' % route.encode()])
+        yield wait_for(lambda: all(recorder.received for recorder in recorders.values()))
+        self.assertEqual([recorder.received[0][-1][-1] for recorder in recorders.values()],
+                         [b'for orders', b'for prices'])
+
+        agent = Agent(reactor, contextFactory=BridgeTLS.ClientPolicy())
+        response = yield agent.request(b'GET', b"https://127.0.0.1:%d/zmq/unknown" % port)
+        self.assertEqual(response.code, 404)
+        yield readBody(response)
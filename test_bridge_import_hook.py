@@ -0,0 +1,90 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import zmq  # noqa: F401
+
+import BridgeImportHook
+
+
+CHECK_INJECTED = """
+import site, sys
+site.addsitedir(sys.argv[1])
+import zmq
+print(zmq.Socket.connect.__name__, zmq.Socket.bind.__name__)
+"""
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    for name in (BridgeImportHook.ENV_ZMQ_ADDR, BridgeImportHook.ENV_HTTP_ADDR, BridgeImportHook.ENV_DESTINATION,
+                 BridgeImportHook.ENV_DISABLE):
+        monkeypatch.delenv(name, raising=False)
+    # a finder left behind would take over the next import of zmq
+    monkeypatch.setattr(sys, "meta_path", list(sys.meta_path))
+    injected = []
+    monkeypatch.setattr(BridgeImportHook, "_inject", lambda *args: injected.append(args))
+    return injected
+
+
+def run_with_hook(site_dir, **environment) -> str:
+    # a fresh interpreter which picks up the .pth file in site_dir, like one using that site-packages directory would
+    env = {name: value for name, value in os.environ.items() if not name.startswith("ZMQ_HTTPS_BRIDGE_")}
+    env.update(environment)
+    return subprocess.run([sys.executable, "-c", CHECK_INJECTED, str(site_dir)], env=env, check=True,
+                          capture_output=True, text=True, timeout=60).stdout.split()
+
+
+def test_install_and_uninstall_pth(tmp_path):
+    path = BridgeImportHook.install_pth(str(tmp_path), "127.0.0.1:5555", "0.0.0.0:8443", "https://peer:8443")
+    assert path == str(tmp_path / BridgeImportHook.PTH_NAME)
+    lines = (tmp_path / BridgeImportHook.PTH_NAME).read_text().splitlines()
+    assert lines == [BridgeImportHook.BRIDGE_DIRECTORY,
+                     "import BridgeImportHook; BridgeImportHook.install('127.0.0.1:5555', '0.0.0.0:8443', "
+                     "'https://peer:8443')"]
+    assert BridgeImportHook.uninstall_pth(str(tmp_path))
+    assert not os.path.exists(path)
+    assert not BridgeImportHook.uninstall_pth(str(tmp_path))
+
+
+def test_hook_injects_when_zmq_is_imported(tmp_path):
+    BridgeImportHook.install_pth(str(tmp_path), "127.0.0.1:5555", "127.0.0.1:8443", "https://127.0.0.1:8444")
+    assert run_with_hook(tmp_path) == ["_injected_connect", "_injected_bind"]
+
+
+def test_hook_is_configured_by_the_environment(tmp_path):
+    BridgeImportHook.install_pth(str(tmp_path))
+    assert run_with_hook(tmp_path) == ["connect", "bind"]
+    assert run_with_hook(tmp_path, **{BridgeImportHook.ENV_ZMQ_ADDR: "127.0.0.1:5555",
+                                      BridgeImportHook.ENV_HTTP_ADDR: "127.0.0.1:8443",
+                                      BridgeImportHook.ENV_DESTINATION: "https://127.0.0.1:8444"}) \
+        == ["_injected_connect", "_injected_bind"]
+
+
+def test_hook_leaves_disabled_processes_alone(tmp_path):
+    BridgeImportHook.install_pth(str(tmp_path), "127.0.0.1:5555", "127.0.0.1:8443", "https://127.0.0.1:8444")
+    assert run_with_hook(tmp_path, **{BridgeImportHook.ENV_DISABLE: "1"}) == ["connect", "bind"]
+
+
+def test_install_needs_every_address(environment):
+    assert not BridgeImportHook.install("127.0.0.1:5555", "127.0.0.1:8443", None)
+    assert environment == []
+
+
+def test_environment_overrides_install_arguments(environment, monkeypatch):
+    monkeypatch.setenv(BridgeImportHook.ENV_DESTINATION, "https://elsewhere:8443")
+    # zmq has been imported already, so the bridge is injected straight away
+    assert BridgeImportHook.install("127.0.0.1:5555", "127.0.0.1:8443", "https://peer:8443")
+    assert environment == [("127.0.0.1:5555", "127.0.0.1:8443", "https://elsewhere:8443")]
+
+
+def test_finder_only_answers_for_zmq(monkeypatch):
+    finder = BridgeImportHook.BridgeFinder(lambda: None)
+    monkeypatch.setattr(sys, "meta_path", [finder] + sys.meta_path)
+    assert finder.find_spec("json", None) is None
+    assert finder in sys.meta_path
+    spec = finder.find_spec("zmq", None)
+    assert isinstance(spec.loader, BridgeImportHook._InjectingLoader)
+    # zmq is only ever imported once, so the finder steps aside
+    assert finder not in sys.meta_path
@@ -0,0 +1,125 @@
+import sys
+import types
+
+import pytest
+import zmq
+
+import BridgeInjector
+
+
+@pytest.fixture
+def zmq_socket(monkeypatch):
+    # whatever the tests do to zmq.Socket is undone afterwards
+    monkeypatch.setattr(zmq.Socket, "connect", zmq.Socket.connect)
+    monkeypatch.setattr(zmq.Socket, "bind", zmq.Socket.bind)
+    monkeypatch.delattr(zmq.Socket, "__real_connect__", raising=False)
+    monkeypatch.delattr(zmq.Socket, "__real_bind__", raising=False)
+    monkeypatch.setattr(BridgeInjector, "STARTED_BRIDGE", False)
+    # run_bridge would start a whole bridge; only note that it got that far
+    started = []
+    monkeypatch.setitem(sys.modules, "BridgeApplication",
+                        types.SimpleNamespace(start_bridge=lambda *args, **kwargs: started.append(args)))
+    return zmq.Socket, started
+
+
+def run_bridge():
+    BridgeInjector.run_bridge("127.0.0.1", 5555, "127.0.0.1", 8443, "https://127.0.0.1:8444", False, None)
+
+
+def test_run_bridge_restores_the_real_socket_methods(zmq_socket):
+    socket_class, started = zmq_socket
+    connect, bind = socket_class.connect, socket_class.bind
+    # injecting again mustn't lose the real methods
+    for _ in range(2):
+        BridgeInjector.inject_zeromq_bridge("127.0.0.1", 5555, "127.0.0.1", 8443, "https://127.0.0.1:8444")
+    assert socket_class.connect is not connect
+
+    run_bridge()
+    assert socket_class.connect is connect
+    assert socket_class.bind is bind
+    assert len(started) == 1
+
+
+def test_run_bridge_in_a_process_that_never_injected(zmq_socket):
+    # with spawn or forkserver, the bridge process imports zmq afresh
+    socket_class, started = zmq_socket
+    connect, bind = socket_class.connect, socket_class.bind
+    run_bridge()
+    assert socket_class.connect is connect
+    assert socket_class.bind is bind
+    assert len(started) == 1
+
+
+SOURCE = BridgeInjector.INJECT_SOURCE.replace("@__SCRIPT_DIRECTORY__@", "/bridge") \
+    .replace("@__ZMQ_ADDR__@", "127.0.0.1").replace("@__ZMQ_PORT__@", "5555") \
+    .replace("@__HTTP_ADDR__@", "127.0.0.1").replace("@__HTTP_PORT__@", "8443") \
+    .replace("@__DESTINATION__@", "https://127.0.0.1:8444")
+
+
+def scan(path, dry_run: bool = False) -> dict:
+    return BridgeInjector.scan_file((str(path), SOURCE, dry_run))
+
+
+@pytest.mark.parametrize("guard", ["if __name__ == '__main__':", 'if "__main__" == __name__:',
+                                   "if (__name__ ==\n        '__main__'):"])
+def test_scan_file_injects_into_the_guard(tmp_path, guard):
+    path = tmp_path / "app.py"
+    path.write_text("import zmq\n\n%s\n    main()\n" % guard)
+    result = scan(path)
+    assert result["candidate"] and result["error"] is None
+    assert [reinject for line, reinject in result["points"]] == [False]
+
+    source = path.read_text()
+    assert BridgeInjector.INJECT_MARKER in source
+    assert source.endswith("https://127.0.0.1:8444\")\n    main()\n")
+    # the original is kept, and injecting again replaces what was injected rather than adding to it
+    assert (tmp_path / "app.py.noninjected").exists()
+    assert [reinject for line, reinject in scan(path)["points"]] == [True]
+    assert path.read_text() == source
+
+
+def test_scan_file_keeps_line_endings_and_indentation(tmp_path):
+    path = tmp_path / "app.py"
+    path.write_bytes(b"import zmq\r\nif __name__ == '__main__':\r\n\tmain()\r\n")
+    scan(path)
+    lines = path.read_bytes().split(b"\r\n")
+    assert lines[2] == b"\t" + BridgeInjector.INJECT_MARKER.encode()
+    assert all(line.startswith(b"\t") for line in lines[2:-1])
+    assert b"\n" not in path.read_bytes().replace(b"\r\n", b"")
+
+
+@pytest.mark.parametrize("text", [
+    "import zmq\n",
+    # mentions __main__, but has no guard at module level
+    "print('__main__')\n",
+    "def main():\n    if __name__ == '__main__':\n        run()\n",
+    "",
+])
+def test_scan_file_skips_files_without_a_guard(tmp_path, text):
+    path = tmp_path / "module.py"
+    path.write_text(text)
+    result = scan(path)
+    assert not result["candidate"] and result["points"] == [] and result["error"] is None
+    assert path.read_text() == text
+
+
+def test_scan_file_leaves_guards_on_one_line_alone(tmp_path):
+    path = tmp_path / "app.py"
+    path.write_text("if __name__ == '__main__': main()\n")
+    assert scan(path)["points"] == []
+    assert not (tmp_path / "app.py.noninjected").exists()
+
+
+def test_scan_file_dry_run_writes_nothing(tmp_path):
+    path = tmp_path / "app.py"
+    path.write_text("if __name__ == '__main__':\n    main()\n")
+    assert scan(path, dry_run=True)["points"] == [(2, False)]
+    assert path.read_text() == "if __name__ == '__main__':\n    main()\n"
+
+
+def test_scan_file_reports_files_that_dont_parse(tmp_path):
+    path = tmp_path / "broken.py"
+    path.write_text("if __name__ == '__main__':\nmain(\n")
+    result = scan(path)
+    assert result["error"] is not None
+    assert path.read_text() == "if __name__ == '__main__':\nmain(\n"
@@ -0,0 +1,109 @@
+import math
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web.client import Agent, readBody
+
+import BridgeMetrics
+import BridgeTLS
+from bridge_test_support import RecordingBridge, listen, scrape
+
+
+def test_counters_and_gauges_render_with_their_labels():
+    metrics = BridgeMetrics.Metrics()
+    requests = metrics.counter("requests_total", "Requests, by outcome", labels=("result",))
+    requests.inc(1, ("ok",))
+    requests.inc(2, ("ok",))
+    requests.inc(1, ("error",))
+    metrics.gauge("queued", "Queued requests", function=lambda: 7)
+    metrics.gauge("stats", "Stats", labels=("stat",), function=lambda: {"open": 2, "idle": 1})
+
+    assert metrics.render().decode().splitlines() == [
+        "# HELP requests_total Requests, by outcome",
+        "# TYPE requests_total counter",
+        'requests_total{result="ok"} 3',
+        'requests_total{result="error"} 1',
+        "# HELP queued Queued requests",
+        "# TYPE queued gauge",
+        "queued 7",
+        "# HELP stats Stats",
+        "# TYPE stats gauge",
+        'stats{stat="open"} 2',
+        'stats{stat="idle"} 1',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = BridgeMetrics.Metrics()
+    latency = metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        latency.observe(value)
+    samples = scrape(metrics)
+    assert samples == {
+        'latency_seconds_bucket{le="0.1"}': 2,
+        'latency_seconds_bucket{le="1.0"}': 3,
+        'latency_seconds_bucket{le="+Inf"}': 4,
+        "latency_seconds_sum": 5.65,
+        "latency_seconds_count": 4,
+    }
+
+
+def test_label_values_are_escaped():
+    metrics = BridgeMetrics.Metrics()
+    metrics.counter("dropped_total", "Dropped\nmessages", labels=("peer",)).inc(1, ('a "quoted"\\peer\n',))
+    assert metrics.render().decode().splitlines()[::2] == [
+        "# HELP dropped_total Dropped\\nmessages",
+        'dropped_total{peer="a \\"quoted\\"\\\\peer\\n"} 1',
+    ]
+
+
+def test_scoped_metrics_share_a_family():
+    metrics = BridgeMetrics.Metrics()
+    metrics.counter("sent_total", "Sent").inc(1)
+    orders = metrics.scoped(route="orders")
+    orders.counter("sent_total", "Sent").inc(2)
+    # registering again hands back the same counter
+    orders.counter("sent_total", "Sent").inc(3)
+    assert metrics.render().decode().count("# TYPE sent_total") == 1
+    assert scrape(metrics) == {"sent_total": 1, 'sent_total{route="orders"}': 5}
+
+
+def test_float_values():
+    metrics = BridgeMetrics.Metrics()
+    metrics.gauge("ratio", "Ratio", function=lambda: 2.5)
+    metrics.gauge("lag", "Lag", function=lambda: math.inf)
+    assert metrics.render().decode().splitlines()[2::3] == ["ratio 2.5", "lag +Inf"]
+
+
+def test_reactor_lag_monitor_measures_late_timers(monkeypatch):
+    clock = task.Clock()
+    now = [100.0]
+    monkeypatch.setattr(BridgeMetrics.time, "monotonic", lambda: now[0])
+    metrics = BridgeMetrics.Metrics()
+    BridgeMetrics.ReactorLagMonitor(clock, metrics, interval=0.5).start()
+    # the reactor got to the timer 0.2s late
+    now[0] += 0.7
+    clock.advance(0.5)
+    samples = scrape(metrics)
+    assert math.isclose(samples["bridge_reactor_lag_last_seconds"], 0.2)
+    assert samples["bridge_reactor_lag_seconds_count"] == 1
+    assert len(clock.getDelayedCalls()) == 1
+
+
+class MetricsPageTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_metrics_are_served(self):
+        recorder = RecordingBridge()
+        recorder.metrics.counter("bridge_test_total", "A test counter").inc(3)
+        _, port = yield listen(self, recorder)
+        agent = Agent(reactor, contextFactory=BridgeTLS.ClientPolicy())
+
+        # a probe of /zmq shows up in the receiving side's request counter
+        response = yield agent.request(b'GET', b"https://127.0.0.1:%d/zmq" % port)
+        yield readBody(response)
+        response = yield agent.request(b'GET', b"https://127.0.0.1:%d/metrics" % port)
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers.getRawHeaders(b'Content-Type'), [BridgeMetrics.CONTENT_TYPE.encode()])
+        body = (yield readBody(response)).decode()
+        self.assertIn("bridge_test_total 3\n", body)
+        self.assertIn('bridge_http_requests_received_total{code="200"} 1\n', body)
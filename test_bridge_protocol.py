@@ -0,0 +1,231 @@
+import concurrent.futures
+import random
+
+import pytest
+
+import BridgeProtocol
+
+
+SHA256 = BridgeProtocol.make_integrity("sha256")
+
+
+@pytest.mark.parametrize("frames", [
+    [b''],
+    [b'', b''],
+    [b'identity', b'', b'payload'],
+    [bytes(range(256)) * 4096],
+])
+def test_frames_round_trip(frames):
+    assert BridgeProtocol.unpack_frames(BridgeProtocol.pack_frames(frames)) == frames
+
+
+@pytest.mark.parametrize("data", [
+    b'',
+    b'\x00\x00',
+    # no frames at all
+    BridgeProtocol.pack_frames([]),
+    # a frame announced but missing
+    BridgeProtocol.FRAME_LENGTH.pack(2) + BridgeProtocol.FRAME_LENGTH.pack(1) + b'x',
+    # a frame longer than what's left
+    BridgeProtocol.FRAME_LENGTH.pack(1) + BridgeProtocol.FRAME_LENGTH.pack(1 << 31) + b'x',
+    # bytes after the last frame
+    BridgeProtocol.pack_frames([b'x']) + b'y',
+])
+def test_unpack_frames_rejects_malformed(data):
+    with pytest.raises(BridgeProtocol.FramingError):
+        BridgeProtocol.unpack_frames(data)
+
+
+@pytest.mark.parametrize("name", BridgeProtocol.INTEGRITY_ALGORITHMS)
+@pytest.mark.parametrize("messages", [
+    [],
+    [b''],
+    [b'one', b'', b'three'],
+    [b'\xff' * (1024 * 1024)],
+])
+def test_batch_round_trip(name, messages):
+    integrity = BridgeProtocol.make_integrity(name, b'key')
+    body = BridgeProtocol.pack_batch(messages, integrity)
+    assert BridgeProtocol.unpack_batch(body, len(messages), integrity) == messages
+
+
+def test_unpack_batch_rejects_wrong_count():
+    body = BridgeProtocol.pack_batch([b'one', b'two'], SHA256)
+    with pytest.raises(BridgeProtocol.BatchError):
+        BridgeProtocol.unpack_batch(body, 3, SHA256)
+
+
+@pytest.mark.parametrize("cut", [1, BridgeProtocol.RECORD_LENGTH.size + 1, BridgeProtocol.RECORD_LENGTH.size + 32 + 1])
+def test_unpack_batch_rejects_truncated(cut):
+    body = BridgeProtocol.pack_batch([b'one', b'two'], SHA256)
+    with pytest.raises(BridgeProtocol.BatchError):
+        BridgeProtocol.unpack_batch(body[:-cut], 2, SHA256)
+
+
+def test_unpack_batch_rejects_oversized_record():
+    body = BridgeProtocol.RECORD_LENGTH.pack(1 << 31) + SHA256.digest(b'x') + b'x'
+    with pytest.raises(BridgeProtocol.BatchError):
+        BridgeProtocol.unpack_batch(body, 1, SHA256)
+
+
+def test_unpack_batch_rejects_tampered_record():
+    body = bytearray(BridgeProtocol.pack_batch([b'one', b'two'], SHA256))
+    body[-1] ^= 1
+    with pytest.raises(BridgeProtocol.IntegrityError):
+        BridgeProtocol.unpack_batch(bytes(body), 2, SHA256)
+
+
+@pytest.mark.parametrize("body", [b'', b'payload', b'\x00' * 65536])
+def test_raw_request_round_trip(body):
+    headers = [(b'X-Verify-Hash', [b'abcd']), (b'X-Bridge-Correlation', [b'01', b'02'])]
+    data = BridgeProtocol.pack_raw_request(b'POST', b'/zmq/orders', headers, body)
+    assert BridgeProtocol.unpack_raw_request(data) == (
+        b'POST', b'/zmq/orders',
+        [(b'X-Verify-Hash', b'abcd'), (b'X-Bridge-Correlation', b'01'), (b'X-Bridge-Correlation', b'02')], body)
+
+
+def test_raw_request_around_body():
+    head, tail = BridgeProtocol.pack_raw_request_around(b'POST', b'/zmq', [(b'a', [b'b'])], 4)
+    assert head + b'body' + tail == BridgeProtocol.pack_raw_request(b'POST', b'/zmq', [(b'a', [b'b'])], b'body')
+
+
+@pytest.mark.parametrize("body", [b'', b'reply'])
+def test_raw_response_round_trip(body):
+    data = BridgeProtocol.pack_raw_response(200, [(b'Content-Type', [b'text/plain'])], body)
+    assert BridgeProtocol.unpack_raw_response(data) == (200, [(b'Content-Type', b'text/plain')], body)
+
+
+@pytest.mark.parametrize("frames", [[b'POST', b'/zmq'], [b'POST', b'/zmq', b'', b'dangling header']])
+def test_unpack_raw_request_rejects_malformed(frames):
+    with pytest.raises(BridgeProtocol.FramingError):
+        BridgeProtocol.unpack_raw_request(BridgeProtocol.pack_frames(frames))
+
+
+@pytest.mark.parametrize("frames", [[b'200'], [b'OK', b''], [b'200', b'', b'dangling header']])
+def test_unpack_raw_response_rejects_malformed(frames):
+    with pytest.raises(BridgeProtocol.FramingError):
+        BridgeProtocol.unpack_raw_response(BridgeProtocol.pack_frames(frames))
+
+
+def split_randomly(data: bytes, seed: int) -> list:
+    # chunks of 0 to 100 bytes, so base64 groups and compressed blocks end up split every which way
+    rng = random.Random(seed)
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        size = rng.randint(0, 100)
+        chunks.append(data[offset:offset + size])
+        offset += size
+    return chunks
+
+
+def encode(payload: bytes, wire_format: str, codec) -> bytes:
+    if codec is not None:
+        payload = codec.compress(payload)
+    return BridgeProtocol.encode_body(payload, wire_format)
+
+
+@pytest.mark.parametrize("wire_format", BridgeProtocol.WIRE_FORMATS)
+@pytest.mark.parametrize("codec", [None] + BridgeProtocol.available_codecs(),
+                         ids=lambda codec: codec.name if codec is not None else "none")
+@pytest.mark.parametrize("integrity", [None, SHA256, BridgeProtocol.make_integrity("crc32")],
+                         ids=lambda integrity: integrity.name if integrity is not None else "unhashed")
+@pytest.mark.parametrize("payload", [b'', b'x', b'{"symbol": "ABCD", "price": 101.25} ' * 200,
+                                     bytes(random.Random(0).getrandbits(8) for _ in range(5000))],
+                         ids=["empty", "one byte", "text", "random"])
+def test_body_decoder_matches_one_shot_decode(wire_format, codec, integrity, payload):
+    body = encode(payload, wire_format, codec)
+    one_shot = BridgeProtocol.decode_body(body, wire_format)
+    if codec is not None:
+        one_shot = BridgeProtocol.decompress(one_shot, codec)
+    assert one_shot == payload
+
+    for seed in range(5):
+        decoder = BridgeProtocol.BodyDecoder(wire_format, integrity, codec)
+        for chunk in split_randomly(body, seed):
+            decoder.feed(chunk)
+        assert decoder.finish() == one_shot
+        assert decoder.error is None
+        assert decoder.received == len(body)
+        assert decoder.has_digest() == (integrity is not None)
+        if integrity is not None:
+            assert decoder.hexdigest() == integrity.hexdigest(one_shot)
+
+
+@pytest.mark.parametrize("wire_format", BridgeProtocol.WIRE_FORMATS)
+@pytest.mark.parametrize("codec", [None] + BridgeProtocol.available_codecs(),
+                         ids=lambda codec: codec.name if codec is not None else "none")
+def test_body_decoder_ignores_empty_chunks(wire_format, codec):
+    # HTTP/2 ends a body with an empty chunk, after the compressed stream has already ended
+    payload = b'{"symbol": "ABCD", "price": 101.25} ' * 200
+    decoder = BridgeProtocol.BodyDecoder(wire_format, SHA256, codec)
+    decoder.feed(b'')
+    decoder.feed(encode(payload, wire_format, codec))
+    decoder.feed(b'')
+    assert decoder.finish() == payload
+    assert decoder.error is None
+    assert decoder.hexdigest() == SHA256.hexdigest(payload)
+
+
+@pytest.mark.parametrize("codec", BridgeProtocol.available_codecs(), ids=lambda codec: codec.name)
+@pytest.mark.parametrize("split", [False, True], ids=["same chunk", "next chunk"])
+def test_body_decoder_rejects_data_after_the_compressed_stream(codec, split):
+    body = codec.compress(b'payload' * 100)
+    decoder = BridgeProtocol.BodyDecoder(BridgeProtocol.WIRE_FORMAT_BINARY, codec=codec)
+    if split:
+        decoder.feed(body)
+        decoder.feed(b'trailing')
+    else:
+        decoder.feed(body + b'trailing')
+    assert decoder.finish() == b''
+    assert decoder.error == "Data after the end of the %s stream" % codec.name
+
+
+def test_body_decoder_rejects_bad_base64():
+    decoder = BridgeProtocol.BodyDecoder(BridgeProtocol.WIRE_FORMAT_BASE64)
+    decoder.feed(b'aGVsbG8h')
+    decoder.feed(b'*not base64*')
+    assert decoder.finish() == b''
+    assert decoder.error.startswith("Bad base64 data")
+
+
+def test_body_decoder_rejects_truncated_base64():
+    decoder = BridgeProtocol.BodyDecoder(BridgeProtocol.WIRE_FORMAT_BASE64)
+    decoder.feed(b'aGVsbG8hI')
+    decoder.finish()
+    assert decoder.error == "Truncated base64 data"
+
+
+def test_body_decoder_rejects_truncated_compressed_data():
+    codec = BridgeProtocol.make_codec("deflate")
+    decoder = BridgeProtocol.BodyDecoder(BridgeProtocol.WIRE_FORMAT_BINARY, codec=codec)
+    decoder.feed(codec.compress(b'payload' * 100)[:-4])
+    decoder.finish()
+    assert decoder.error == "Truncated deflate data"
+
+
+def test_body_decoder_rejects_bad_compressed_data():
+    decoder = BridgeProtocol.BodyDecoder(BridgeProtocol.WIRE_FORMAT_BINARY, codec=BridgeProtocol.make_codec("deflate"))
+    decoder.feed(b'not deflate at all')
+    assert decoder.finish() == b''
+    assert decoder.error.startswith("Bad deflate data")
+
+
+def test_body_decoder_limits_decompressed_size(monkeypatch):
+    monkeypatch.setattr(BridgeProtocol, "MAX_DECOMPRESSED_SIZE", 1000)
+    codec = BridgeProtocol.make_codec("deflate")
+    decoder = BridgeProtocol.BodyDecoder(BridgeProtocol.WIRE_FORMAT_BINARY, codec=codec)
+    for chunk in split_randomly(codec.compress(b'\x00' * 5000), 0):
+        decoder.feed(chunk)
+    assert decoder.finish() == b''
+    assert decoder.error == "Body decompresses to more than 1000 bytes"
+
+
+@pytest.mark.parametrize("codec", BridgeProtocol.available_codecs(), ids=lambda codec: codec.name)
+def test_codec_compresses_on_several_threads_at_once(codec):
+    # big payloads are compressed on the reactor's thread pool, several at a time, with the same codec
+    payloads = [bytes([number]) * 64 + random.Random(number).randbytes(1024 * 1024) for number in range(8)]
+    with concurrent.futures.ThreadPoolExecutor(len(payloads)) as executor:
+        for _ in range(4):
+            compressed = list(executor.map(codec.compress, payloads))
+            assert [BridgeProtocol.decompress(data, codec) for data in compressed] == payloads
@@ -0,0 +1,164 @@
+import os
+
+import pytest
+
+import BridgeSpool
+
+
+# room for the segment header and two 10 byte records
+SMALL_SEGMENT = BridgeSpool.SEGMENT_HEADER.size + 2 * (BridgeSpool.RECORD_HEADER.size + 10)
+
+
+def record(number: int) -> bytes:
+    return b"record-%03d" % number
+
+
+def segment_paths(directory) -> list:
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(BridgeSpool.SEGMENT_SUFFIX))
+
+
+def drain(spool) -> list:
+    payloads = []
+    while True:
+        popped = spool.pop()
+        if popped is None:
+            return payloads
+        token, payload = popped
+        payloads.append(payload)
+        spool.acknowledge(token)
+
+
+@pytest.mark.parametrize("frames, correlation_id", [
+    ([b'payload'], None),
+    ([b'identity', b'', b'payload'], "00ff"),
+    ([b''], None),
+])
+def test_message_round_trip(frames, correlation_id):
+    data = BridgeSpool.pack_message(frames, correlation_id, "0123456789abcdef")
+    assert BridgeSpool.unpack_message(data) == (frames, correlation_id, "0123456789abcdef")
+
+
+def test_records_come_back_in_order(tmp_path):
+    spool = BridgeSpool.Spool(str(tmp_path), SMALL_SEGMENT)
+    for number in range(5):
+        assert spool.append(record(number))
+    assert spool.pending() == 5
+    assert spool.bytes() == 5 * (BridgeSpool.RECORD_HEADER.size + 10)
+    assert drain(spool) == [record(number) for number in range(5)]
+    assert spool.pending() == 0
+    assert spool.bytes() == 0
+    spool.close()
+
+
+def test_unacknowledged_records_are_replayed_after_reopening(tmp_path):
+    spool = BridgeSpool.Spool(str(tmp_path))
+    for number in range(4):
+        spool.append(record(number))
+    first, _ = spool.pop()
+    second, _ = spool.pop()
+    third, _ = spool.pop()
+    # only the leading run of acknowledged records counts as delivered
+    spool.acknowledge(first)
+    spool.acknowledge(third)
+    spool.close()
+
+    spool = BridgeSpool.Spool(str(tmp_path))
+    assert spool.pending() == 3
+    assert drain(spool) == [record(1), record(2), record(3)]
+    spool.close()
+
+    spool = BridgeSpool.Spool(str(tmp_path))
+    assert spool.pending() == 0
+    assert spool.pop() is None
+    spool.close()
+
+
+@pytest.mark.parametrize("damage", ["truncate", "corrupt"])
+def test_recovery_stops_at_a_damaged_tail_record(tmp_path, damage):
+    spool = BridgeSpool.Spool(str(tmp_path))
+    for number in range(3):
+        spool.append(record(number))
+    spool.close()
+
+    path, = segment_paths(tmp_path)
+    tail = BridgeSpool.SEGMENT_HEADER.size + 2 * (BridgeSpool.RECORD_HEADER.size + 10)
+    if damage == "truncate":
+        # as if we died halfway through writing the last record
+        os.truncate(path, tail + BridgeSpool.RECORD_HEADER.size + 5)
+    else:
+        with open(path, "r+b") as segment_file:
+            segment_file.seek(tail + BridgeSpool.RECORD_HEADER.size + 3)
+            segment_file.write(b"X")
+
+    spool = BridgeSpool.Spool(str(tmp_path))
+    assert spool.pending() == 2
+    # new records take the damaged one's place
+    assert spool.append(record(9))
+    spool.close()
+
+    spool = BridgeSpool.Spool(str(tmp_path))
+    assert drain(spool) == [record(0), record(1), record(9)]
+    spool.close()
+
+
+def test_segments_rotate_and_are_collected_across_reopening(tmp_path):
+    spool = BridgeSpool.Spool(str(tmp_path), SMALL_SEGMENT)
+    for number in range(5):
+        spool.append(record(number))
+    assert len(segment_paths(tmp_path)) == 3
+
+    # delivering the first segment's records removes it; the others stay until theirs are delivered too
+    for _ in range(3):
+        token, _ = spool.pop()
+        spool.acknowledge(token)
+    first, second = segment_paths(tmp_path)
+    spool.close()
+
+    spool = BridgeSpool.Spool(str(tmp_path), SMALL_SEGMENT)
+    assert spool.pending() == 2
+    spool.append(record(5))
+    spool.append(record(6))
+    # new segments are numbered after the ones already on disk
+    assert segment_paths(tmp_path)[:2] == [first, second]
+    assert len(segment_paths(tmp_path)) == 3
+    assert drain(spool) == [record(number) for number in range(3, 7)]
+    # the newest segment is kept to be written to
+    assert len(segment_paths(tmp_path)) == 1
+    spool.close()
+
+
+def test_oversized_record_gets_a_segment_of_its_own(tmp_path):
+    spool = BridgeSpool.Spool(str(tmp_path), SMALL_SEGMENT)
+    big = b"x" * (SMALL_SEGMENT * 3)
+    spool.append(record(0))
+    spool.append(big)
+    spool.append(record(1))
+    assert len(segment_paths(tmp_path)) == 3
+    spool.close()
+
+    spool = BridgeSpool.Spool(str(tmp_path), SMALL_SEGMENT)
+    assert drain(spool) == [record(0), big, record(1)]
+    spool.close()
+
+
+def test_append_refuses_records_past_max_bytes(tmp_path):
+    spool = BridgeSpool.Spool(str(tmp_path), max_bytes=2 * (BridgeSpool.RECORD_HEADER.size + 10))
+    assert spool.append(record(0))
+    assert spool.append(record(1))
+    assert not spool.append(record(2))
+    token, _ = spool.pop()
+    spool.acknowledge(token)
+    assert spool.append(record(2))
+    spool.close()
+
+
+@pytest.mark.parametrize("content", [b"not a spool segment at all", b"", b"000"],
+                         ids=["garbage", "empty", "shorter than the header"])
+def test_files_which_arent_segments_are_skipped(tmp_path, content):
+    (tmp_path / ("0" * 16 + BridgeSpool.SEGMENT_SUFFIX)).write_bytes(content)
+    spool = BridgeSpool.Spool(str(tmp_path))
+    assert spool.pending() == 0
+    spool.append(record(0))
+    assert drain(spool) == [record(0)]
+    spool.close()
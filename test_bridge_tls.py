@@ -0,0 +1,127 @@
+import pytest
+from OpenSSL import SSL
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web.client import Agent, ResponseNeverReceived, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+import BridgeTLS
+from bridge_test_support import listen_tls, make_certificate, temporary_directory
+
+
+def certificate_of(cert_path: str):
+    return BridgeTLS.load_certificates(cert_path)[0]
+
+
+def test_pins_are_fingerprints_or_certificates(tmp_path):
+    cert_path, _ = make_certificate(tmp_path)
+    pin = BridgeTLS.fingerprint(certificate_of(cert_path))
+    colons = ":".join(pin[i:i + 2] for i in range(0, len(pin), 2)).upper()
+    assert BridgeTLS.load_pins([colons]) == {pin}
+    assert BridgeTLS.load_pins([cert_path]) == {pin}
+
+
+def test_every_certificate_in_a_pinned_file_counts(tmp_path):
+    paths = [make_certificate(tmp_path, name)[0] for name in ("leaf", "issuer")]
+    chain = tmp_path / "chain.pem"
+    chain.write_bytes(b"".join(open(path, "rb").read() for path in paths))
+    assert BridgeTLS.load_pins([str(chain)]) == {BridgeTLS.fingerprint(certificate_of(path)) for path in paths}
+
+
+@pytest.mark.parametrize("content", [None, b"", b"not a certificate"])
+def test_pins_which_cant_be_read(tmp_path, content):
+    path = tmp_path / "pin.pem"
+    if content is not None:
+        path.write_bytes(content)
+    with pytest.raises(BridgeTLS.TLSConfigError):
+        BridgeTLS.load_pins([str(path)])
+
+
+def test_acceptable_ciphers():
+    assert BridgeTLS.acceptable_ciphers(None) is None
+    assert BridgeTLS.acceptable_ciphers("ECDHE+AESGCM") is not None
+    with pytest.raises(BridgeTLS.TLSConfigError, match="No cipher suites match"):
+        BridgeTLS.acceptable_ciphers("NO-SUCH-CIPHER")
+
+
+def test_server_options_need_a_matching_key(tmp_path):
+    cert_path, key_path = make_certificate(tmp_path, "one")
+    _, other_key_path = make_certificate(tmp_path, "other")
+    assert BridgeTLS.server_options(cert_path, key_path).getContext() is not None
+    with pytest.raises(BridgeTLS.TLSConfigError, match="Couldn't use"):
+        BridgeTLS.server_options(cert_path, other_key_path)
+    with pytest.raises(BridgeTLS.TLSConfigError, match="No certificate"):
+        BridgeTLS.server_options(key_path, key_path)
+    with pytest.raises(BridgeTLS.TLSConfigError, match="Couldn't read the private key"):
+        BridgeTLS.server_options(cert_path, str(tmp_path / "missing.key"))
+
+
+def test_client_policy_verifies_one_way(tmp_path):
+    cert_path, _ = make_certificate(tmp_path)
+    with pytest.raises(BridgeTLS.TLSConfigError, match="not both"):
+        BridgeTLS.ClientPolicy(ca_path=cert_path, pins=[cert_path])
+    (tmp_path / "empty.pem").write_bytes(b"")
+    with pytest.raises(BridgeTLS.TLSConfigError, match="No CA certificates"):
+        BridgeTLS.ClientPolicy(ca_path=str(tmp_path / "empty.pem"))
+
+
+def test_client_policy_reuses_its_creators():
+    policy = BridgeTLS.ClientPolicy()
+    creator = policy.creatorForNetloc(b"127.0.0.1", 8443)
+    assert isinstance(creator, BridgeTLS.ResumingCreator)
+    assert policy.creatorForNetloc(b"127.0.0.1", 8443) is creator
+    assert policy.creatorForNetloc(b"127.0.0.1", 8444) is not creator
+    assert not isinstance(BridgeTLS.ClientPolicy(resumption=False).creatorForNetloc(b"127.0.0.1", 8443),
+                          BridgeTLS.ResumingCreator)
+
+
+def session_reused(connection: SSL.Connection) -> bool:
+    # pyOpenSSL doesn't wrap SSL_session_reused, but its bindings have it
+    return bool(SSL._lib.SSL_session_reused(connection._ssl))
+
+
+# answers every request with whether its TLS session was resumed
+class SessionResource(Resource):
+    isLeaf = True
+
+    def render(self, request):
+        return b"resumed" if session_reused(request.channel.transport.getHandle()) else b"new"
+
+
+class TLSTest(unittest.TestCase):
+    def setUp(self):
+        directory = temporary_directory(self)
+        self.cert_path, key_path = make_certificate(directory)
+        self.other_cert_path, _ = make_certificate(directory, "other")
+        self.server_options = BridgeTLS.server_options(self.cert_path, key_path)
+
+    @defer.inlineCallbacks
+    def sessions(self, policy: BridgeTLS.ClientPolicy, count: int = 3, server_options=None) -> list:
+        # one request per connection; the agent doesn't keep them open
+        port = listen_tls(self, Site(SessionResource()), server_options or self.server_options)
+        agent = Agent(reactor, contextFactory=policy)
+        sessions = []
+        for _ in range(count):
+            response = yield agent.request(b'GET', b"https://127.0.0.1:%d/" % port)
+            sessions.append((yield readBody(response)))
+        return sessions
+
+    @defer.inlineCallbacks
+    def test_reconnects_resume_the_session(self):
+        self.assertEqual((yield self.sessions(BridgeTLS.ClientPolicy(pins=[self.cert_path]))),
+                         [b"new", b"resumed", b"resumed"])
+
+    @defer.inlineCallbacks
+    def test_resumption_can_be_turned_off(self):
+        self.assertEqual((yield self.sessions(BridgeTLS.ClientPolicy(resumption=False))), [b"new"] * 3)
+        key_path = self.cert_path[:-len(".pem")] + ".key"
+        server_options = BridgeTLS.server_options(self.cert_path, key_path, resumption=False)
+        self.assertEqual((yield self.sessions(BridgeTLS.ClientPolicy(), server_options=server_options)),
+                         [b"new"] * 3)
+
+    @defer.inlineCallbacks
+    def test_certificates_which_arent_pinned_are_refused(self):
+        failure = yield self.assertFailure(self.sessions(BridgeTLS.ClientPolicy(pins=[self.other_cert_path]), 1),
+                                           ResponseNeverReceived)
+        self.assertTrue(failure.reasons[0].check(SSL.Error))
@@ -0,0 +1,74 @@
+from io import BytesIO
+
+from OpenSSL import SSL
+from twisted.internet import defer, protocol, reactor
+from twisted.trial import unittest
+from twisted.web.client import FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+
+import BridgeTLS
+from Http2Agent import Http2Agent
+from bridge_test_support import close_connections, listen_holding, listen_tls, make_certificate, settle, \
+    temporary_directory, wait_for
+
+try:
+    import h2  # noqa: F401
+except ImportError:
+    h2 = None
+
+
+class ContextFactory:
+    def __init__(self, context):
+        self._context = context
+
+    def getContext(self):
+        return self._context
+
+
+class Http2AgentTest(unittest.TestCase):
+    if h2 is None:
+        skip = "h2 isn't installed"
+
+    def setUp(self):
+        self.agent = Http2Agent(reactor, BridgeTLS.ClientPolicy(http2=True))
+        self.addCleanup(close_connections, self.agent)
+
+    @defer.inlineCallbacks
+    def test_requests_are_multiplexed_over_one_connection(self):
+        destination, address = listen_holding(self)
+        url = (address + "/zmq").encode()
+        responses = [self.agent.request(b'POST', url, Headers({b'X-Number': [b'%d' % number]}),
+                                        FileBodyProducer(BytesIO(b'body %d' % number)))
+                     for number in range(5)]
+        yield wait_for(lambda: len(destination.held) == 5)
+        # the streams' bodies are interleaved, so they may be done in any order
+        self.assertEqual(sorted(request.content.read() for request in destination.held),
+                         [b'body %d' % number for number in range(5)])
+        self.assertEqual(len(destination.connections), 1)
+        self.assertEqual(self.agent.stats()["open_streams"], 5)
+
+        destination.release()
+        for response in responses:
+            response = yield response
+            self.assertEqual(response.code, 200)
+            self.assertEqual((yield readBody(response)), b'OK')
+        stats = self.agent.stats()
+        self.assertEqual((stats["requests"], stats["connections_created"], stats["open_streams"]), (5, 1, 0))
+
+    @defer.inlineCallbacks
+    def test_destination_without_h2_fails_the_requests(self):
+        # a TLS server which doesn't do ALPN at all; Twisted's own would rather fail the handshake than pick nothing
+        context = SSL.Context(SSL.TLS_METHOD)
+        cert_path, key_path = make_certificate(temporary_directory(self))
+        context.use_certificate_file(cert_path)
+        context.use_privatekey_file(key_path)
+        port = listen_tls(self, protocol.Factory.forProtocol(protocol.Protocol), ContextFactory(context))
+        responses = [self.agent.request(b'GET', b"https://127.0.0.1:%d/zmq" % port) for _ in range(2)]
+        for response in responses:
+            error = yield self.assertFailure(response, ConnectionError)
+            self.assertIn("didn't negotiate h2", str(error))
+        self.assertEqual(self.agent.stats()["open_connections"], 0)
+        yield settle()
+
+    def test_plain_http_is_refused(self):
+        return self.assertFailure(self.agent.request(b'GET', b"http://127.0.0.1:1/zmq"), ValueError)
@@ -0,0 +1,121 @@
+import struct
+from io import BytesIO
+
+import zmq
+from twisted.internet import defer, error, protocol, reactor
+from twisted.internet.endpoints import HostnameEndpoint, connectProtocol, wrapClientTLS
+from twisted.trial import unittest
+from twisted.web.client import FileBodyProducer, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+import BridgeProtocol
+import BridgeTLS
+import TwistedHttpBridge
+from RawAgent import RawAgent
+from bridge_test_support import Application, RecordingBridge, close_connections, free_port, listen, listen_tls, \
+    scrape, settle, start_zmq_bridge, wait_for
+
+
+# answers each request with its own path, but only once the test lets it through
+class EchoLaterResource(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        self.held = []
+
+    def render(self, request):
+        self.held.append(request)
+        return NOT_DONE_YET
+
+    def release(self, order):
+        for request in order:
+            request.write(request.path + b' ' + request.content.read())
+            request.finish()
+
+
+# sends one frame as soon as it's connected, and notes when the other end hangs up
+class FrameSender(protocol.Protocol):
+    def __init__(self, frame: bytes):
+        self.frame = frame
+        self.lost = defer.Deferred()
+
+    def connectionMade(self):
+        self.transport.write(struct.pack("!I", len(self.frame)) + self.frame)
+
+    def connectionLost(self, reason):
+        self.lost.callback(None)
+
+
+class RawAgentTest(unittest.TestCase):
+    def setUp(self):
+        self.agent = RawAgent(reactor, BridgeTLS.ClientPolicy(raw=True))
+        self.addCleanup(close_connections, self.agent)
+
+    @defer.inlineCallbacks
+    def test_pipelined_responses_come_back_in_order(self):
+        resource = EchoLaterResource()
+        site = TwistedHttpBridge.BridgeSite(resource, TwistedHttpBridge.IntegrityPolicy(b''), {}, raw_ingress=True)
+        port = listen_tls(self, site)
+        responses = [self.agent.request(b'POST', b"https://127.0.0.1:%d/zmq/%d" % (port, number), None,
+                                        FileBodyProducer(BytesIO(b'body %d' % number)))
+                     for number in range(5)]
+        yield wait_for(lambda: len(resource.held) == 5)
+        # whatever order the pages finish in, the responses go out in the order the requests came in
+        resource.release(reversed(resource.held))
+        for number, response in enumerate(responses):
+            response = yield response
+            self.assertEqual(response.code, 200)
+            self.assertEqual((yield readBody(response)), b'/zmq/%d body %d' % (number, number))
+        stats = self.agent.stats()
+        self.assertEqual((stats["requests"], stats["connections_created"], stats["open_requests"]), (5, 1, 0))
+
+    @defer.inlineCallbacks
+    def test_messages_cross_over_raw_framing(self):
+        recorder = RecordingBridge()
+        _, port = yield listen(self, recorder, raw_ingress=True)
+        zmq_port = free_port()
+        sender = start_zmq_bridge(self, zmq_port, "https://127.0.0.1:%d" % port, False, raw_egress=True)
+        application = Application(self, zmq.DEALER, "tcp://127.0.0.1:%d" % zmq_port)
+        for number in range(10):
+            application.send([b'', b'%d' % number])
+        yield wait_for(lambda: len(recorder.received) == 10 and sender.queue_stats()["in_flight"] == 0)
+        self.assertEqual(sorted(received[-1][-1] for received in recorder.received),
+                         sorted(b'%d' % number for number in range(10)))
+        # the probe and every message took the one connection
+        self.assertEqual(sender.connection_stats()["connections_created"], 1)
+        self.assertEqual(scrape(sender.metrics)['bridge_http_requests_sent_total{result="ok"}'], 10)
+
+    @defer.inlineCallbacks
+    def test_malformed_frames_drop_the_connection(self):
+        _, port = yield listen(self, RecordingBridge(), raw_ingress=True)
+        creator = BridgeTLS.ClientPolicy(raw=True).creatorForNetloc(b"127.0.0.1", port)
+        # a method and a path, but no headers or body
+        sender = FrameSender(BridgeProtocol.pack_frames([b'POST', b'/zmq']))
+        yield connectProtocol(wrapClientTLS(creator, HostnameEndpoint(reactor, "127.0.0.1", port)), sender)
+        yield sender.lost
+
+    @defer.inlineCallbacks
+    def test_frames_over_the_limit_drop_the_connection(self):
+        _, port = yield listen(self, RecordingBridge(), raw_ingress=True, raw_max_length=1000)
+        url = b"https://127.0.0.1:%d/zmq" % port
+        response = yield self.agent.request(b'GET', url)
+        self.assertEqual(response.code, 200)
+        yield readBody(response)
+        yield self.assertFailure(self.agent.request(b'POST', url, None, FileBodyProducer(BytesIO(b'x' * 1000))),
+                                 error.ConnectionDone, error.ConnectionLost)
+        yield wait_for(lambda: self.agent.stats()["open_connections"] == 0)
+
+    @defer.inlineCallbacks
+    def test_destination_without_raw_ingress_fails_the_requests(self):
+        _, port = yield listen(self, RecordingBridge())
+        responses = [self.agent.request(b'GET', b"https://127.0.0.1:%d/zmq" % port) for _ in range(2)]
+        for response in responses:
+            failure = yield self.assertFailure(response, ConnectionError)
+            self.assertIn("--raw-ingress", str(failure))
+        self.assertEqual(self.agent.stats()["open_connections"], 0)
+        yield settle()
+
+    def test_plain_http_is_refused(self):
+        return self.assertFailure(self.agent.request(b'GET', b"http://127.0.0.1:1/zmq"), ValueError)
@@ -1,5 +1,15 @@
-killall python3
-python3 debug-zmq-rep.py tcp://127.0.0.1:9933 > rep_out.txt 2>&1 &
-sleep 3
-python3 BridgeApplication.py 127.0.0.1:9933 10.0.1.84:8080 http://10.0.1.38:8080 true
-killall python3
+#!/bin/bash
+# reply side of the bridge test: debug-zmq-rep.py plus a bridge connecting to it. addresses default to localhost so
+# this and test_req_bridge.sh can share one machine; override them to run each half on its own host. any arguments
+# are passed on to the bridge (e.g. --wire-format binary)
+APP_ADDR=${APP_ADDR:-127.0.0.1:9933}
+HTTP_ADDR=${HTTP_ADDR:-127.0.0.1:9443}
+DESTINATION=${DESTINATION:-https://127.0.0.1:8443}
+PYTHON=${PYTHON:-python3}
+
+cd "$(dirname "$0")"
+$PYTHON debug-zmq-rep.py tcp://$APP_ADDR > rep_out.txt 2>&1 &
+REP_PID=$!
+# only stop what this script started
+trap 'kill $REP_PID 2>/dev/null' EXIT
+$PYTHON BridgeApplication.py -z $APP_ADDR -H $HTTP_ADDR -d $DESTINATION -c true "$@"
@@ -1,6 +1,16 @@
-killall python3
-python3 BridgeApplication.py 127.0.0.1:8181 10.0.1.38:8080 http://10.0.1.84:8080 \
-	> req_out.txt 2>&1 &
-sleep 3
-python3 debug-zmq-req.py tcp://127.0.0.1:8181
-killall python3
+#!/bin/bash
+# request side of the bridge test: a bridge for debug-zmq-req.py to connect to, then the client itself. addresses
+# default to localhost so this and test_rep_bridge.sh can share one machine; override them to run each half on its own
+# host. any arguments are passed on to the bridge (e.g. --wire-format binary)
+ZMQ_ADDR=${ZMQ_ADDR:-127.0.0.1:8181}
+HTTP_ADDR=${HTTP_ADDR:-127.0.0.1:8443}
+DESTINATION=${DESTINATION:-https://127.0.0.1:9443}
+PYTHON=${PYTHON:-python3}
+
+cd "$(dirname "$0")"
+$PYTHON BridgeApplication.py -z $ZMQ_ADDR -H $HTTP_ADDR -d $DESTINATION "$@" > req_out.txt 2>&1 &
+BRIDGE_PID=$!
+# only stop what this script started
+trap 'kill $BRIDGE_PID 2>/dev/null' EXIT
+# no need to wait for the bridge; it holds requests until it has reached the other side
+$PYTHON debug-zmq-req.py tcp://$ZMQ_ADDR
@@ -0,0 +1,45 @@
+import zmq
+from twisted.internet import defer
+from twisted.trial import unittest
+
+import BridgeProtocol
+from bridge_test_support import Application, RecordingBridge, free_port, listen, start_zmq_bridge, wait_for
+
+
+PAYLOAD = b'{"symbol": "ABCD", "price": 101.25} ' * 2000
+
+
+class CompressedBodiesTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def _send_compressed(self, compression: str, **options):
+        # a sending bridge the application connects to, compressing everything, and a receiving one that records what
+        # it's handed
+        if compression not in [codec.name for codec in BridgeProtocol.available_codecs()]:
+            raise unittest.SkipTest("%s isn't installed" % compression)
+        recorder = RecordingBridge()
+        _, port = yield listen(self, recorder)
+        zmq_port = free_port()
+        sender = start_zmq_bridge(self, zmq_port, "https://127.0.0.1:%d" % port, False, compression=compression,
+                                  compression_threshold=0, **options)
+
+        application = Application(self, zmq.DEALER, "tcp://127.0.0.1:%d" % zmq_port)
+        for number in range(3):
+            application.send([b'', b'%d' % number + PAYLOAD])
+        # the responses have to be read too, or their connections go back to the pool after it's been closed
+        yield wait_for(lambda: len(recorder.received) == 3 and sender.queue_stats()["in_flight"] == 0)
+        # requests in flight together may be handed on in any order
+        self.assertEqual(sorted(received[-1][-1] for received in recorder.received),
+                         [b'%d' % number + PAYLOAD for number in range(3)])
+        self.assertEqual(sender.compression_stats()["compressed"], 3)
+
+    def test_zstd_over_http2(self):
+        return self._send_compressed("zstd", http2=True)
+
+    def test_lz4_over_http2(self):
+        return self._send_compressed("lz4", http2=True)
+
+    def test_deflate_over_http2(self):
+        return self._send_compressed("deflate", http2=True)
+
+    def test_zstd_over_http11(self):
+        return self._send_compressed("zstd")
@@ -0,0 +1,307 @@
+import pytest
+import zmq
+from twisted.internet import defer, task
+from twisted.trial import unittest
+from twisted.web.client import readBody
+
+import BridgeMetrics
+import BridgeProtocol
+import ZMQBridge
+from bridge_test_support import Application, RecordingBridge, close_connections, free_port, listen, listen_holding, \
+    scrape, settle, start_pair, start_zmq_bridge, wait_for
+
+
+def message(number: int, size: int = 10) -> tuple:
+    # (frames, correlation id, message id), as the bridge hands them to its batcher
+    return [b'identity', b'', (b'%d:' % number).ljust(size, b'x')], None, None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = task.Clock()
+    monkeypatch.setattr(ZMQBridge, "reactor", clock)
+    return clock
+
+
+def batcher(flushed, window: float = 0.5, max_bytes: int = 1000, max_count: int = 3) -> ZMQBridge.MessageBatcher:
+    return ZMQBridge.MessageBatcher(lambda batch: flushed.append([message[0][-1] for message, received in batch]),
+                                    window, max_bytes, max_count)
+
+
+def test_batcher_flushes_once_the_window_expires(clock):
+    flushed = []
+    messages = batcher(flushed)
+    messages.add(message(0), 0.0)
+    clock.advance(0.3)
+    messages.add(message(1), 0.3)
+    # the window starts with the first pending message
+    clock.advance(0.19)
+    assert flushed == []
+    clock.advance(0.01)
+    assert flushed == [[message(0)[0][-1], message(1)[0][-1]]]
+    clock.advance(10)
+    assert len(flushed) == 1
+
+
+def test_batcher_splits_at_max_count(clock):
+    flushed = []
+    messages = batcher(flushed, max_count=3)
+    for number in range(7):
+        messages.add(message(number), 0.0)
+    assert [len(batch) for batch in flushed] == [3, 3]
+    clock.advance(0.5)
+    assert [len(batch) for batch in flushed] == [3, 3, 1]
+    assert [payload for batch in flushed for payload in batch] == [message(number)[0][-1] for number in range(7)]
+    # a full batch leaves no timer behind
+    assert clock.getDelayedCalls() == []
+
+
+def test_batcher_splits_at_max_bytes(clock):
+    flushed = []
+    messages = batcher(flushed, max_bytes=1000, max_count=100)
+    # the frames all count, the envelope included: 8 + 0 + 400 bytes each
+    for number in range(5):
+        messages.add(message(number, 400), 0.0)
+    assert [len(batch) for batch in flushed] == [3]
+    # a message past the limit on its own goes out straight away, with whatever was pending
+    messages.add(message(5, 5000), 0.0)
+    assert [len(batch) for batch in flushed] == [3, 3]
+    messages.flush()
+    assert [len(batch) for batch in flushed] == [3, 3]
+    assert clock.getDelayedCalls() == []
+
+
+class BatchingTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_messages_are_posted_in_batches(self):
+        recorder = RecordingBridge()
+        _, port = yield listen(self, recorder)
+        zmq_port = free_port()
+        sender = start_zmq_bridge(self, zmq_port, "https://127.0.0.1:%d" % port, False, batch_window=0.5,
+                                  batch_max_count=4)
+        application = Application(self, zmq.DEALER, "tcp://127.0.0.1:%d" % zmq_port)
+
+        # the first message is held until the destination has been negotiated with; after that, the rest are batched
+        application.send([b'', b'first'])
+        yield wait_for(lambda: recorder.received)
+        for number in range(10):
+            application.send([b'', b'%d' % number])
+        yield wait_for(lambda: len(recorder.received) == 11 and sender.queue_stats()["in_flight"] == 0)
+
+        payloads = [received[-1][-1] for received in recorder.received]
+        self.assertEqual(payloads[0], b'first')
+        self.assertEqual(sorted(payloads[1:]), sorted(b'%d' % number for number in range(10)))
+        # the first message on its own, then batches of 4, 4 and 2
+        samples = scrape(sender.metrics)
+        self.assertEqual(samples['bridge_http_requests_sent_total{result="ok"}'], 4)
+        self.assertEqual(samples['bridge_http_messages_sent_total'], 11)
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_requests_beyond_the_cap_wait_for_a_connection(self):
+        destination, address = listen_holding(self)
+        url = (address + "/zmq").encode()
+        agent, pool = ZMQBridge.make_agent(False, 2, 240.0, BridgeMetrics.Metrics())
+        self.addCleanup(close_connections, agent, pool)
+
+        responses = [agent.request(b'GET', url) for _ in range(5)]
+        yield wait_for(lambda: len(destination.held) == 2)
+        yield settle()
+        self.assertEqual(len(destination.held), 2)
+        self.assertEqual(pool.stats()["waiting_requests"], 3)
+
+        # each response frees a connection for the next request in line
+        for received in range(3, 6):
+            destination.release(1)
+            yield wait_for(lambda: destination.received == received)
+        destination.release()
+        for response in responses:
+            response = yield response
+            self.assertEqual(response.code, 200)
+            yield readBody(response)
+
+        self.assertEqual(len(destination.connections), 2)
+        stats = pool.stats()
+        self.assertEqual((stats["connections_created"], stats["connections_reused"], stats["waiting_requests"]),
+                         (2, 3, 0))
+
+
+class RoutingTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.near, far, self.client_endpoint, server_endpoint = yield start_pair(self)
+        self.server = Application(self, zmq.ROUTER, server_endpoint, bind=True)
+
+    @defer.inlineCallbacks
+    def answer(self, count: int, reply=lambda body: [b're: ' + frame for frame in body], reverse: bool = False):
+        # the server sees whatever envelope the far bridge gives it, and hands it back untouched
+        requests = []
+        for _ in range(count):
+            frames = yield self.server.receive()
+            delimiter = frames.index(b'')
+            requests.append((frames[:delimiter + 1], frames[delimiter + 1:]))
+        for envelope, body in reversed(requests) if reverse else requests:
+            self.server.send(envelope + reply(body))
+        return [body for envelope, body in requests]
+
+    @defer.inlineCallbacks
+    def test_replies_go_back_to_the_peer_that_asked(self):
+        clients = [Application(self, zmq.DEALER, self.client_endpoint, IDENTITY=b'client-%d' % number)
+                   for number in range(3)]
+        for number, client in enumerate(clients):
+            # every frame of a multipart message makes it across, empty ones included
+            client.send([b'', b'from %d' % number, b'', b'\x00' * 1000])
+        bodies = yield self.answer(3)
+        self.assertEqual(sorted(bodies), [[b'from %d' % number, b'', b'\x00' * 1000] for number in range(3)])
+
+        for number, client in enumerate(clients):
+            reply = yield client.receive()
+            self.assertEqual(reply, [b'', b're: from %d' % number, b're: ', b're: ' + b'\x00' * 1000])
+
+    @defer.inlineCallbacks
+    def test_req_client_takes_turns(self):
+        # a REQ socket adds the delimiter itself, and waits for each reply before it may send again
+        client = Application(self, zmq.REQ, self.client_endpoint)
+        for number in range(3):
+            client.send([b'request %d' % number])
+            yield self.answer(1)
+            self.assertEqual((yield client.receive()), [b're: request %d' % number])
+
+    @defer.inlineCallbacks
+    def test_pipelined_replies_may_come_back_in_any_order(self):
+        # a DEALER client doesn't wait for its replies; the server answers the last request first
+        client = Application(self, zmq.DEALER, self.client_endpoint)
+        for number in range(5):
+            client.send([b'', b'request %d' % number])
+        bodies = yield self.answer(5, reply=lambda body: [body[0].replace(b'request', b'reply')], reverse=True)
+        self.assertEqual(sorted(bodies), [[b'request %d' % number] for number in range(5)])
+
+        replies = []
+        for _ in range(5):
+            replies.append((yield client.receive()))
+        self.assertEqual(sorted(replies), [[b'', b'reply %d' % number] for number in range(5)])
+        # every request was matched up with its reply by its correlation id, and timed
+        samples = scrape(self.near.metrics)
+        self.assertEqual(samples["bridge_correlated_requests_pending"], 0)
+        self.assertEqual(samples["bridge_round_trip_seconds_count"], 5)
+
+    @defer.inlineCallbacks
+    def test_replies_nobody_asked_for_are_dropped(self):
+        client = Application(self, zmq.DEALER, self.client_endpoint)
+        client.send([b'', b'request'])
+        yield self.answer(1)
+        yield client.receive()
+        self.near.transfer_correlated_to_app("ffff", [b'stray reply'])
+        self.assertEqual(scrape(self.near.metrics)['bridge_zmq_messages_dropped_total{reason="uncorrelated"}'], 1)
+
+
+class BackpressureTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def test_in_flight_window_and_paused_reads(self):
+        destination, address = listen_holding(self)
+        zmq_port = free_port()
+        sender = start_zmq_bridge(self, zmq_port, address, False, max_in_flight=2, max_queue=4)
+        application = Application(self, zmq.DEALER, "tcp://127.0.0.1:%d" % zmq_port)
+        # let the capability probe through, then a first message: it's only forwarded once the probe has been answered
+        application.send([b'', b'first'])
+        while destination.received < 2:
+            yield wait_for(lambda: destination.held)
+            destination.release()
+        yield wait_for(lambda: sender.queue_stats()["in_flight"] == 0)
+
+        for number in range(20):
+            application.send([b'', b'%d' % number])
+        yield wait_for(lambda: len(destination.held) == 2 and sender.queue_stats()["reading_paused"])
+        yield settle()
+        stats = sender.queue_stats()
+        # the rest wait in the send queue until it's full, and then in ZeroMQ
+        self.assertEqual((len(destination.held), stats["in_flight"], stats["queued"]), (2, 2, 4))
+        self.assertEqual(stats["reading_pauses"], 1)
+
+        while destination.received < 22:
+            yield wait_for(lambda: destination.held)
+            self.assertLessEqual(len(destination.held), 2)
+            destination.release()
+        yield wait_for(lambda: sender.queue_stats()["in_flight"] == 0)
+        stats = sender.queue_stats()
+        self.assertEqual((stats["queued"], stats["reading_paused"]), (0, False))
+        self.assertEqual(scrape(sender.metrics)['bridge_http_messages_sent_total'], 21)
+
+
+class StreamTest(unittest.TestCase):
+    @defer.inlineCallbacks
+    def start_stream(self, source_type: str, sink_type: str, **options) -> tuple:
+        # a source bridge reading from the application, posting to a sink bridge which hands the messages to the
+        # application's receivers. fires with (source, sink, endpoint for the application's sender, endpoint for its
+        # receivers)
+        source_port, sink_port = free_port(), free_port()
+        sink = start_zmq_bridge(self, sink_port, None, False, socket_type=sink_type)
+        _, port = yield listen(self, sink)
+        # a sub socket connects to the application's publisher; a pull socket binds for its pushers
+        source = start_zmq_bridge(self, source_port, "https://127.0.0.1:%d" % port,
+                                  source_type == BridgeProtocol.SOCKET_SUB, socket_type=source_type, **options)
+        return source, sink, "tcp://127.0.0.1:%d" % source_port, "tcp://127.0.0.1:%d" % sink_port
+
+    @defer.inlineCallbacks
+    def test_pub_sub_fans_out_to_every_subscriber(self):
+        source, sink, publisher_endpoint, subscriber_endpoint = yield self.start_stream(
+            BridgeProtocol.SOCKET_SUB, BridgeProtocol.SOCKET_PUB, topics=(b'prices',))
+        publisher = Application(self, zmq.PUB, publisher_endpoint, bind=True)
+        subscribers = [Application(self, zmq.SUB, subscriber_endpoint, SUBSCRIBE=b'') for _ in range(3)]
+
+        # a publisher drops what it has no subscribers for yet, on both sides of the bridge, so keep publishing until
+        # every subscriber has heard something
+        heard = set()
+
+        def everyone_heard():
+            publisher.send([b'prices', b'warm-up'])
+            for number, subscriber in enumerate(subscribers):
+                while subscriber.try_receive() is not None:
+                    heard.add(number)
+            return len(heard) == len(subscribers)
+
+        yield wait_for(everyone_heard)
+        for number in range(5):
+            # only the topics the source subscribed to make it across
+            publisher.send([b'trades', b'%d' % number])
+            publisher.send([b'prices', b'%d' % number])
+        for subscriber in subscribers:
+            received = []
+            while len(received) < 5:
+                frames = yield subscriber.receive()
+                if frames[-1] != b'warm-up':
+                    received.append(frames)
+            # a stream keeps its order, and each message arrives whole
+            self.assertEqual(received, [[b'prices', b'%d' % number] for number in range(5)])
+        yield settle()
+        self.assertEqual([subscriber.try_receive() for subscriber in subscribers], [None] * len(subscribers))
+        # one-way messages don't wait for a reply
+        self.assertEqual(scrape(source.metrics)["bridge_correlated_requests_pending"], 0)
+
+    @defer.inlineCallbacks
+    def test_push_pull_shares_the_work_out(self):
+        source, sink, pusher_endpoint, worker_endpoint = yield self.start_stream(
+            BridgeProtocol.SOCKET_PULL, BridgeProtocol.SOCKET_PUSH, topics=(b'job',))
+        workers = [Application(self, zmq.PULL, worker_endpoint) for _ in range(2)]
+        pusher = Application(self, zmq.PUSH, pusher_endpoint)
+        # a pull socket can't subscribe, so the source bridge drops what doesn't match itself
+        pusher.send([b'other'])
+        for number in range(10):
+            pusher.send([b'job %d' % number])
+
+        jobs = [[] for _ in workers]
+
+        def all_done():
+            for worker, done in zip(workers, jobs):
+                frames = worker.try_receive()
+                if frames is not None:
+                    done.append(frames)
+            return sum(len(done) for done in jobs) == 10
+
+        yield wait_for(all_done)
+        # each job goes to exactly one worker, and every worker gets some
+        self.assertEqual(sorted(frames for done in jobs for frames in done),
+                         sorted([b'job %d' % number] for number in range(10)))
+        self.assertTrue(all(jobs))
+        self.assertEqual(scrape(source.metrics)["bridge_zmq_messages_filtered_total"], 1)